@@ -0,0 +1,104 @@
+import logging
+import time
+from datetime import datetime, timezone as dt_timezone
+
+import django_rq
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+
+from curtain.models import Curtain, LastAccess
+
+logger = logging.getLogger(__name__)
+
+# Redis hashes of curtain id -> latest access timestamp / number of accesses since the last flush
+ACCESS_TIMESTAMP_KEY = "curtain:last_access:timestamp"
+ACCESS_COUNT_KEY = "curtain:last_access:count"
+
+FLUSH_BATCH_SIZE = 500
+# After Redis fails, accesses are written directly for this many seconds instead of waiting on Redis every time
+BUFFER_RETRY_AFTER = 30
+
+# time.monotonic() before which Redis is not tried again
+_buffer_unavailable_until = 0
+
+
+def record_access(curtain):
+    """
+    Records a session access. With CURTAIN_LAST_ACCESS_BUFFERED the event only touches Redis and is written to
+    LastAccess by flush_access_buffer; if Redis cannot be reached it is written to the database straight away,
+    as are the accesses of the next BUFFER_RETRY_AFTER seconds.
+    """
+    global _buffer_unavailable_until
+    if settings.CURTAIN_LAST_ACCESS_BUFFERED and time.monotonic() >= _buffer_unavailable_until:
+        try:
+            pipeline = django_rq.get_connection("default").pipeline(transaction=False)
+            pipeline.hset(ACCESS_TIMESTAMP_KEY, curtain.id, time.time())
+            pipeline.hincrby(ACCESS_COUNT_KEY, curtain.id, 1)
+            pipeline.execute()
+            return
+        except Exception as e:
+            _buffer_unavailable_until = time.monotonic() + BUFFER_RETRY_AFTER
+            logger.warning(f"Failed to buffer access to curtain {curtain.id}, writing accesses directly for "
+                           f"{BUFFER_RETRY_AFTER}s: {str(e)}")
+    apply_access_events({curtain.id: (datetime.now(dt_timezone.utc), 1)})
+
+
+def flush_access_buffer():
+    """
+    Moves the buffered access events out of Redis and writes them to LastAccess in bulk.
+    The buffer is read and cleared in a single MULTI/EXEC so events arriving during the flush are kept for the next one.
+    Returns the number of curtains updated.
+    """
+    pipeline = django_rq.get_connection("default").pipeline(transaction=True)
+    pipeline.hgetall(ACCESS_TIMESTAMP_KEY)
+    pipeline.hgetall(ACCESS_COUNT_KEY)
+    pipeline.delete(ACCESS_TIMESTAMP_KEY, ACCESS_COUNT_KEY)
+    timestamps, counts, _ = pipeline.execute()
+
+    events = {}
+    for curtain_id, timestamp in timestamps.items():
+        accessed_at = datetime.fromtimestamp(float(timestamp), tz=dt_timezone.utc)
+        events[int(curtain_id)] = (accessed_at, int(counts.get(curtain_id, 1)))
+    return apply_access_events(events)
+
+
+def apply_access_events(events):
+    """
+    Folds access events ({curtain id: (latest access, number of accesses)}) into the latest LastAccess row of each
+    curtain, creating the row for curtains that have none, and moves Curtain.last_accessed_at and its expiry columns forward.
+    Events for deleted curtains are dropped.
+    """
+    curtains = list(Curtain.objects.filter(id__in=list(events)).only(
+        "id", "created", "expiry_duration", "last_accessed_at"))
+    if not curtains:
+        return 0
+    curtain_ids = [curtain.id for curtain in curtains]
+
+    latest_ids = LastAccess.objects.filter(curtain_id__in=curtain_ids).values("curtain_id").annotate(
+        latest_id=Max("id")).values_list("latest_id", flat=True)
+    latest = {access.curtain_id: access for access in LastAccess.objects.filter(id__in=list(latest_ids))}
+
+    to_update = []
+    to_create = []
+    for curtain_id in curtain_ids:
+        accessed_at, count = events[curtain_id]
+        access = latest.get(curtain_id)
+        if access:
+            access.last_access = max(access.last_access, accessed_at)
+            access.access_count += count
+            to_update.append(access)
+        else:
+            to_create.append(LastAccess(curtain_id=curtain_id, last_access=accessed_at, access_count=count))
+
+    for curtain in curtains:
+        accessed_at, _ = events[curtain.id]
+        if curtain.last_accessed_at is None or accessed_at > curtain.last_accessed_at:
+            curtain.last_accessed_at = accessed_at
+        curtain.refresh_expiry()
+
+    with transaction.atomic():
+        LastAccess.objects.bulk_update(to_update, ["last_access", "access_count"], batch_size=FLUSH_BATCH_SIZE)
+        LastAccess.objects.bulk_create(to_create, batch_size=FLUSH_BATCH_SIZE)
+        Curtain.objects.bulk_update(curtains, ["last_accessed_at", "expires_at", "duration_expires_at"], batch_size=FLUSH_BATCH_SIZE)
+    return len(curtain_ids)
@@ -19,8 +19,10 @@ from .datacite_form import DataCiteForm, CreatorForm, TitleForm, SubjectForm, Co
 from .models import (
     DataCite, Curtain, DataFilterList, ExtraProperties, UserAPIKey, UserPublicKey,
     SocialPlatform, KinaseLibraryModel, CurtainAccessToken, DataAESEncryptionFactors,
-    DataHash, LastAccess, Announcement, PermanentLinkRequest, CurtainCollection
+    DataHash, LastAccess, Announcement, PermanentLinkRequest, CurtainCollection, SessionBlob,
+    SessionDerivation
 )
+from .storage import is_content_addressed_storage
 from django.conf import settings
 
 
@@ -131,7 +133,7 @@ def admin_dashboard(request):
 
     permanent_count = Curtain.objects.filter(permanent=True).count()
     enabled_count = Curtain.objects.filter(enable=True).count()
-    expired_count = sum(1 for c in Curtain.objects.filter(permanent=False) if c.is_expired)
+    expired_count = Curtain.objects.duration_expired().count()
 
     pending_requests = PermanentLinkRequest.objects.filter(status='pending').count()
     pending_datacite = DataCite.objects.filter(status='pending').count()
@@ -186,11 +188,9 @@ class ExpiredStatusFilter(admin.SimpleListFilter):
         if self.value() == 'permanent':
             return queryset.filter(permanent=True)
         elif self.value() == 'active':
-            active_ids = [c.id for c in queryset.filter(permanent=False) if not c.is_expired]
-            return queryset.filter(id__in=active_ids)
+            return queryset.duration_unexpired()
         elif self.value() == 'expired':
-            expired_ids = [c.id for c in queryset.filter(permanent=False) if c.is_expired]
-            return queryset.filter(id__in=expired_ids)
+            return queryset.duration_expired()
         return queryset
 
 
@@ -243,13 +243,7 @@ class ExpiringSoonFilter(admin.SimpleListFilter):
             from django.utils import timezone
             days = int(self.value())
             threshold = timezone.now() + timedelta(days=days)
-            expiring_ids = []
-            for c in queryset.filter(permanent=False):
-                if not c.is_expired:
-                    expiry_date = c.created + c.expiry_duration
-                    if expiry_date <= threshold:
-                        expiring_ids.append(c.id)
-            return queryset.filter(id__in=expiring_ids)
+            return queryset.duration_unexpired().filter(duration_expires_at__lte=threshold)
         return queryset
 
 
@@ -274,17 +268,11 @@ class LastAccessFilter(admin.SimpleListFilter):
             from django.utils import timezone
 
             if self.value() == 'never':
-                curtains_with_access = LastAccess.objects.values_list('curtain_id', flat=True).distinct()
-                return queryset.exclude(id__in=curtains_with_access)
+                return queryset.filter(last_accessed_at__isnull=True)
             else:
                 days = int(self.value())
                 threshold = timezone.now() - timedelta(days=days)
-                old_access_ids = []
-                for c in queryset:
-                    last_access = c.last_access.order_by('-last_access').first()
-                    if not last_access or last_access.last_access < threshold:
-                        old_access_ids.append(c.id)
-                return queryset.filter(id__in=old_access_ids)
+                return queryset.filter(models.Q(last_accessed_at__isnull=True) | models.Q(last_accessed_at__lt=threshold))
         return queryset
 
 
@@ -346,7 +334,7 @@ class CurtainAdmin(admin.ModelAdmin):
     list_display = ('link_id_short', 'name_display', 'curtain_type', 'created', 'last_access_display', 'owner_list', 'enable', 'permanent_badge', 'expired_status', 'encrypted', 'quick_actions')
     list_filter = ('curtain_type', 'enable', 'permanent', 'encrypted', ExpiredStatusFilter, ExpiringSoonFilter, LastAccessFilter, OwnerCountFilter, MultipleIDsFilter, 'created', 'updated')
     search_fields = ('link_id', 'name', 'description', 'owners__username')
-    readonly_fields = ('created', 'updated', 'link_id', 'expired_status', 'last_access_display')
+    readonly_fields = ('created', 'updated', 'link_id', 'expired_status', 'last_access_display', 'expires_at', 'duration_expires_at')
     autocomplete_fields = ('owners',)
     date_hierarchy = 'created'
     list_per_page = 20
@@ -370,7 +358,7 @@ class CurtainAdmin(admin.ModelAdmin):
             'fields': ('enable', 'permanent', 'encrypted', 'expiry_duration', 'expired_status')
         }),
         ('Timestamps', {
-            'fields': ('created', 'updated', 'last_access_display'),
+            'fields': ('created', 'updated', 'last_access_display', 'expires_at', 'duration_expires_at'),
             'classes': ('collapse',)
         }),
     )
@@ -396,9 +384,8 @@ class CurtainAdmin(admin.ModelAdmin):
     owner_list.short_description = 'Owners'
 
     def last_access_display(self, obj):
-        last_access_record = obj.last_access.order_by('-last_access').first()
-        if last_access_record:
-            return last_access_record.last_access.strftime('%Y-%m-%d %H:%M:%S')
+        if obj.last_accessed_at:
+            return obj.last_accessed_at.strftime('%Y-%m-%d %H:%M:%S')
         return 'Never'
     last_access_display.short_description = 'Last Access'
 
@@ -413,7 +400,7 @@ class CurtainAdmin(admin.ModelAdmin):
 
     def get_queryset(self, request):
         qs = super().get_queryset(request)
-        return qs.prefetch_related('owners', 'last_access')
+        return qs.prefetch_related('owners')
 
     def batch_add_owner(self, request, queryset):
         selected = queryset.values_list('pk', flat=True)
@@ -570,11 +557,9 @@ class CurtainAdmin(admin.ModelAdmin):
     extend_expiry_6_months.short_description = "Extend expiry to 6 months"
 
     def delete_expired_sessions(self, request, queryset):
-        count = 0
-        for curtain in queryset:
-            if curtain.is_expired:
-                curtain.delete()
-                count += 1
+        expired = queryset.duration_expired()
+        count = expired.count()
+        expired.delete()
         self.message_user(request, f"Deleted {count} expired curtain(s).")
     delete_expired_sessions.short_description = "Delete expired sessions (from selection)"
 
@@ -633,34 +618,28 @@ class CurtainAdmin(admin.ModelAdmin):
         if request.method == 'POST':
             action = request.POST.get('action')
             if action == 'delete_expired':
-                count = 0
-                for curtain in Curtain.objects.filter(permanent=False):
-                    if curtain.is_expired:
-                        curtain.delete()
-                        count += 1
+                expired = Curtain.objects.duration_expired()
+                count = expired.count()
+                expired.delete()
                 self.message_user(request, f"Deleted {count} expired curtain(s).")
             elif action == 'delete_no_access_30':
                 threshold = timezone.now() - timedelta(days=30)
-                count = 0
-                for curtain in Curtain.objects.filter(permanent=False):
-                    last_access = curtain.last_access.order_by('-last_access').first()
-                    if not last_access or last_access.last_access < threshold:
-                        curtain.delete()
-                        count += 1
+                stale = Curtain.objects.filter(permanent=False).filter(
+                    models.Q(last_accessed_at__isnull=True) | models.Q(last_accessed_at__lt=threshold))
+                count = stale.count()
+                stale.delete()
                 self.message_user(request, f"Deleted {count} curtain(s) with no access in 30 days.")
             elif action == 'delete_no_access_90':
                 threshold = timezone.now() - timedelta(days=90)
-                count = 0
-                for curtain in Curtain.objects.filter(permanent=False):
-                    last_access = curtain.last_access.order_by('-last_access').first()
-                    if not last_access or last_access.last_access < threshold:
-                        curtain.delete()
-                        count += 1
+                stale = Curtain.objects.filter(permanent=False).filter(
+                    models.Q(last_accessed_at__isnull=True) | models.Q(last_accessed_at__lt=threshold))
+                count = stale.count()
+                stale.delete()
                 self.message_user(request, f"Deleted {count} curtain(s) with no access in 90 days.")
             return redirect('admin:curtain_curtain_maintenance')
 
         total_curtains = Curtain.objects.count()
-        expired_count = sum(1 for c in Curtain.objects.filter(permanent=False) if c.is_expired)
+        expired_count = Curtain.objects.duration_expired().count()
         permanent_count = Curtain.objects.filter(permanent=True).count()
         enabled_count = Curtain.objects.filter(enable=True).count()
 
@@ -684,6 +663,7 @@ class CurtainAdmin(admin.ModelAdmin):
             new_owner_id = request.POST.get('new_owner')
             copy_owners = request.POST.get('copy_owners') == 'on'
             copy_description = request.POST.get('copy_description') == 'on'
+            share_files = is_content_addressed_storage()
 
             new_owner = None
             if new_owner_id:
@@ -701,13 +681,19 @@ class CurtainAdmin(admin.ModelAdmin):
                     encrypted=False,
                     expiry_duration=original.expiry_duration,
                 )
+                # encryption settings are not copied, so encrypted files would be unreadable in the duplicate
+                if share_files and original.file and not original.encrypted:
+                    new_curtain.share_session_file(original)
                 if copy_owners:
                     new_curtain.owners.set(original.owners.all())
                 if new_owner and new_owner not in new_curtain.owners.all():
                     new_curtain.owners.add(new_owner)
                 duplicated.append(new_curtain)
 
-            self.message_user(request, f"Successfully duplicated {len(duplicated)} curtain(s). Note: Files are not copied - you need to upload new data.")
+            if share_files:
+                self.message_user(request, f"Successfully duplicated {len(duplicated)} curtain(s). The duplicates share the data files of the originals.")
+            else:
+                self.message_user(request, f"Successfully duplicated {len(duplicated)} curtain(s). Note: Files are not copied - you need to upload new data.")
             return redirect('admin:curtain_curtain_changelist')
 
         context = {
@@ -715,6 +701,7 @@ class CurtainAdmin(admin.ModelAdmin):
             'title': 'Duplicate Curtains',
             'curtains': curtains,
             'users': User.objects.all().order_by('username')[:100],
+            'share_files': is_content_addressed_storage(),
             'opts': self.model._meta,
         }
         return render(request, 'admin/curtain/duplicate_curtain.html', context)
@@ -871,6 +858,46 @@ class DataHashAdmin(admin.ModelAdmin):
     hash_preview.short_description = 'Hash'
 
 
+@admin.register(SessionBlob)
+class SessionBlobAdmin(admin.ModelAdmin):
+    list_display = ('id', 'hash_preview', 'size', 'ref_count', 'created')
+    search_fields = ('hash', 'file')
+    readonly_fields = ('created', 'hash', 'file', 'size', 'ref_count')
+    date_hierarchy = 'created'
+
+    def hash_preview(self, obj):
+        return str(obj.hash)[:20] + '...'
+    hash_preview.short_description = 'Hash'
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        # blobs are deleted with the last curtain that refers to them
+        return False
+
+
+@admin.register(SessionDerivation)
+class SessionDerivationAdmin(admin.ModelAdmin):
+    list_display = ('id', 'hash_preview', 'stage', 'status', 'attempts', 'updated')
+    list_filter = ('stage', 'status')
+    search_fields = ('hash',)
+    readonly_fields = ('created', 'updated', 'hash', 'stage', 'status', 'attempts', 'error', 'artifacts')
+    actions = ['retry_derivations']
+
+    def hash_preview(self, obj):
+        return str(obj.hash)[:20] + '...'
+    hash_preview.short_description = 'Hash'
+
+    def has_add_permission(self, request):
+        return False
+
+    def retry_derivations(self, request, queryset):
+        updated = queryset.exclude(status='done').update(status='pending', attempts=0, error='')
+        self.message_user(request, f'{updated} stages will run again with the next derivation job.')
+    retry_derivations.short_description = "Reset selected stages so they run again"
+
+
 @admin.register(LastAccess)
 class LastAccessAdmin(admin.ModelAdmin):
     list_display = ('id', 'curtain_link', 'last_access')
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class CurtainConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'curtain'
+
+    def ready(self):
+        from curtain.compressed_storage import check_at_rest_compression
+        check_at_rest_compression()
@@ -0,0 +1,196 @@
+import contextlib
+import hashlib
+import os
+import platform
+import shutil
+import statistics
+import tempfile
+import time
+
+import django
+import pandas as pd
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from rest_framework.test import APIClient
+
+from curtain.models import Curtain, ExtraProperties
+from curtain.synthetic import generate_primary_ids, generate_session_bytes
+from curtain.worker_tasks import compare_session, compress_curtain_file, index_curtain_file
+
+BENCHMARKS = ("create", "download", "chunked_upload", "compare_session")
+DEFAULT_CHUNK_SIZE = 5 * 1024 * 1024
+
+
+def summarize(timings):
+    return {
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.fmean(timings),
+        "max": max(timings),
+    }
+
+
+def measure(function, repeat):
+    """
+    Calls function repeat times and returns the wall clock time of each call.
+    The throttle counters are cleared before every call so repeated requests are not rejected.
+    """
+    timings = []
+    for _ in range(repeat):
+        cache.clear()
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+@contextlib.contextmanager
+def benchmark_environment():
+    """
+    Runs the enclosed benchmarks against a throwaway test database, a temporary local media directory,
+    the in-memory channel layer and a local memory cache, so nothing touches the configured database, storage or Redis.
+    Access events are written to the database directly instead of being buffered in Redis.
+    Everything runs in one transaction that is rolled back, so no background jobs are queued for the created sessions.
+    compare_session loads the sessions in the calling thread, since pool threads would not see the uncommitted rows.
+    """
+    media_root = tempfile.mkdtemp(prefix="curtain-benchmark-")
+    settings_override = override_settings(
+        STORAGES={
+            "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+            "default": {
+                "BACKEND": "django.core.files.storage.FileSystemStorage",
+                "OPTIONS": {"location": media_root},
+            },
+        },
+        MEDIA_ROOT=media_root,
+        CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+        CURTAIN_LAST_ACCESS_BUFFERED=False,
+        CURTAIN_COMPARE_SESSION_CONCURRENCY=1,
+        CURTAIN_DOWNLOAD_ACCEL_REDIRECT_PREFIX="",
+        DEBUG=False,
+    )
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        with settings_override, transaction.atomic():
+            yield media_root
+            transaction.set_rollback(True)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        teardown_test_environment()
+        shutil.rmtree(media_root, ignore_errors=True)
+
+
+class SessionBenchmark:
+    """
+    Times the session hot paths for one synthetic session size through the same entry points clients use.
+    """
+
+    def __init__(self, rows, samples, comparisons=1, seed=0, repeat=5, chunk_size=DEFAULT_CHUNK_SIZE,
+                 compare_sessions=2, study_size=100):
+        self.rows = rows
+        self.samples = samples
+        self.repeat = repeat
+        self.chunk_size = chunk_size
+        self.compare_sessions = compare_sessions
+        self.study_size = study_size
+        self.payload = generate_session_bytes(rows, samples, comparisons=comparisons, seed=seed)
+        self.study_list = generate_primary_ids(min(study_size, rows), seed)
+        self.user, _ = User.objects.get_or_create(username="curtain-benchmark", defaults={"is_staff": True})
+        ExtraProperties.objects.get_or_create(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def run(self, benchmarks=BENCHMARKS):
+        """
+        Runs the named benchmarks and returns one result per timed case. Anything the views and jobs print is discarded.
+        """
+        results = []
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            for name in benchmarks:
+                for case, timings in getattr(self, f"benchmark_{name}")():
+                    results.append({
+                        "benchmark": case,
+                        "rows": self.rows,
+                        "samples": self.samples,
+                        "bytes": len(self.payload),
+                        "repeat": len(timings),
+                        **summarize(timings),
+                    })
+        return results
+
+    def create_session(self):
+        response = self.client.post("/curtain/", {
+            "file": SimpleUploadedFile("session.json", self.payload, content_type="application/json"),
+            "description": "benchmark",
+            "enable": "True",
+            "curtain_type": "TP",
+        }, format="multipart")
+        self._check(response, "create")
+        return Curtain.objects.get(link_id=response.data["link_id"])
+
+    def download(self, curtain, path="", **headers):
+        response = self.client.get(f"/curtain/{curtain.link_id}/download/token=/{path}", **headers)
+        self._check(response, "download")
+        if response.streaming:
+            return b"".join(response.streaming_content)
+        return response.content
+
+    def benchmark_create(self):
+        yield "create", measure(self.create_session, self.repeat)
+
+    def benchmark_download(self):
+        curtain = self.create_session()
+        yield "download", measure(lambda: self.download(curtain), self.repeat)
+        compress_curtain_file(curtain.id)
+        yield "download_gzip", measure(lambda: self.download(curtain, HTTP_ACCEPT_ENCODING="gzip"), self.repeat)
+        index_curtain_file(curtain.id)
+        yield "download_fields", measure(lambda: self.download(curtain, "?fields=settings"), self.repeat)
+
+    def benchmark_chunked_upload(self):
+        yield "chunked_upload", measure(self.chunked_upload, self.repeat)
+
+    def chunked_upload(self):
+        total = len(self.payload)
+        upload_id = None
+        for start in range(0, total, self.chunk_size):
+            chunk = self.payload[start:start + self.chunk_size]
+            url = f"/curtain-chunked-upload/{upload_id}/" if upload_id else "/curtain-chunked-upload/"
+            response = self.client.put(url, {
+                "file": SimpleUploadedFile("session.json", chunk, content_type="application/octet-stream"),
+                "filename": "session.json",
+            }, format="multipart", HTTP_CONTENT_RANGE=f"bytes {start}-{start + len(chunk) - 1}/{total}")
+            self._check(response, "chunked upload")
+            upload_id = response.data["id"]
+        response = self.client.post(f"/curtain-chunked-upload/{upload_id}/", {
+            "sha256": hashlib.sha256(self.payload).hexdigest(),
+            "description": "benchmark",
+            "permanent": "False",
+        }, format="multipart")
+        self._check(response, "chunked upload completion")
+
+    def benchmark_compare_session(self):
+        link_ids = [self.create_session().link_id for _ in range(self.compare_sessions)]
+        for match_type in ("primaryID", "primaryID-uniprot"):
+            yield f"compare_session_{match_type}", measure(
+                lambda: compare_session(link_ids, self.study_list, match_type, "benchmark"), self.repeat)
+
+    def _check(self, response, action):
+        if response.status_code != 200:
+            raise RuntimeError(f"{action} failed with status {response.status_code}: {getattr(response, 'data', '')}")
+
+
+def environment_info():
+    return {
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "database": connection.vendor,
+        "storage": "local",
+        "channel_layer": "in-memory",
+    }
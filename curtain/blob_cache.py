@@ -0,0 +1,324 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+
+import django_rq
+from django.conf import settings
+from django.core.files.base import ContentFile, File
+
+from curtain.storage import is_local_storage, with_storage_retries
+
+logger = logging.getLogger(__name__)
+
+BLOB_CACHE_STATS_KEY = "curtain:blob_cache:stats"
+COPY_BLOCK_SIZE = 1024 * 1024
+# The disk tier only counts what its own process writes, so it rescans at least this often to see the others' writes
+DISK_SCAN_INTERVAL = 60
+# Counters are added up in process and sent to Redis at most this often, also after a failed attempt
+STATS_FLUSH_INTERVAL = 10
+
+
+class MemoryLRU:
+    """
+    Size-bounded in-process LRU of blobs. Blobs larger than max_item_bytes are never kept.
+    """
+
+    def __init__(self, max_bytes, max_item_bytes):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_item_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is not None:
+                self._items.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        """
+        Stores data and returns the number of blobs evicted to make room.
+        """
+        if len(data) > self.max_item_bytes or len(data) > self.max_bytes:
+            return 0
+        evicted = 0
+        with self._lock:
+            if key in self._items:
+                self.size -= len(self._items.pop(key))
+            self._items[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, old = self._items.popitem(last=False)
+                self.size -= len(old)
+                evicted += 1
+        return evicted
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+
+class DiskLRU:
+    """
+    Local-disk blob cache with a byte budget. Recency is the file mtime, refreshed on every hit, and the least
+    recently used files are removed when the budget is exceeded. Files are written to a temporary name and renamed,
+    so concurrent readers in other processes never see partial blobs.
+    The size of the directory is kept as a running total of what is written and only rescanned when the total goes
+    over the budget or the last scan is older than DISK_SCAN_INTERVAL.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = str(directory)
+        self.max_bytes = max_bytes
+        self.size = None
+        self._scanned_at = 0
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, source):
+        """
+        Streams the file-like source into the cache. Returns (path, number of files evicted).
+        """
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(temp_path, "wb") as destination:
+                shutil.copyfileobj(source, destination, COPY_BLOCK_SIZE)
+                size = destination.tell()
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        with self._lock:
+            if self.size is not None:
+                self.size += size
+            scan = (self.size is None or self.size > self.max_bytes
+                    or time.monotonic() - self._scanned_at >= DISK_SCAN_INTERVAL)
+        return path, self.evict(keep=path) if scan else 0
+
+    def evict(self, keep=None):
+        """
+        Scans the directory, removes the least recently used files until it fits the budget and returns the number
+        of files removed.
+        """
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    file_stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((file_stat.st_mtime, file_stat.st_size, path))
+                total += file_stat.st_size
+        evicted = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+        with self._lock:
+            self.size = total
+            self._scanned_at = time.monotonic()
+        return evicted
+
+
+class BlobCache:
+    """
+    Read-through cache for stored session blobs: in-process LRU, then local disk, then the storage backend.
+    Entries are keyed by the content hash, so a replaced file can never be served from a stale entry.
+    """
+
+    def __init__(self, memory_bytes, memory_item_bytes, disk_directory, disk_bytes):
+        self.memory = MemoryLRU(memory_bytes, memory_item_bytes) if memory_bytes > 0 else None
+        self.disk = DiskLRU(disk_directory, disk_bytes) if disk_bytes > 0 else None
+
+    def read(self, key, field_file):
+        """
+        Returns the content of field_file as bytes.
+        """
+        if self.memory is not None:
+            data = self.memory.get(key)
+            if data is not None:
+                record_stat("memory_hit")
+                return data
+            record_stat("memory_miss")
+        if self.disk is None:
+            # read here rather than through open() so a failed read can be retried from the start
+            record_stat("storage_read")
+            data = with_storage_retries(lambda: _read_stored(field_file))
+        else:
+            with self.open(key, field_file) as f:
+                data = f.read()
+        if self.memory is not None:
+            record_stat("memory_eviction", self.memory.put(key, data))
+        return data
+
+    def open(self, key, field_file):
+        """
+        Returns a File for reading the content of field_file, served from the disk tier when possible.
+        """
+        if self.memory is not None:
+            data = self.memory.get(key)
+            if data is not None:
+                record_stat("memory_hit")
+                return ContentFile(data, name=field_file.name)
+        if self.disk is None:
+            record_stat("storage_read")
+            return File(field_file.storage.open(field_file.name, "rb"), name=field_file.name)
+        path = self.disk.get(key)
+        if path is not None:
+            record_stat("disk_hit")
+        else:
+            record_stat("disk_miss")
+            path, evicted = with_storage_retries(lambda: self._fetch(key, field_file))
+            record_stat("storage_read")
+            record_stat("disk_eviction", evicted)
+        return File(open(path, "rb"), name=field_file.name)
+
+    def _fetch(self, key, field_file):
+        with field_file.storage.open(field_file.name, "rb") as source:
+            return self.disk.put(key, source)
+
+
+_pending_stats = Counter()
+_pending_stats_lock = threading.Lock()
+# time.monotonic() of the last attempt to send the pending counters
+_stats_flushed_at = 0
+
+
+def record_stat(name, amount=1):
+    """
+    Adds to a blob cache counter. Counters live in Redis so every worker process contributes to the same totals,
+    but lookups only add to in-process counters, which flush_stats sends every STATS_FLUSH_INTERVAL seconds.
+    """
+    if not amount:
+        return
+    with _pending_stats_lock:
+        _pending_stats[name] += amount
+        due = time.monotonic() - _stats_flushed_at >= STATS_FLUSH_INTERVAL
+    if due:
+        flush_stats()
+
+
+def flush_stats():
+    """
+    Sends the counters added up in this process to Redis in one round trip. If Redis cannot be reached they are
+    kept for the next attempt, which is not made before STATS_FLUSH_INTERVAL has passed.
+    """
+    global _stats_flushed_at
+    with _pending_stats_lock:
+        _stats_flushed_at = time.monotonic()
+        pending = dict(_pending_stats)
+        _pending_stats.clear()
+    if not pending:
+        return
+    try:
+        pipeline = django_rq.get_connection("default").pipeline(transaction=False)
+        for name, amount in pending.items():
+            pipeline.hincrby(BLOB_CACHE_STATS_KEY, name, amount)
+        pipeline.execute()
+    except Exception as e:
+        logger.debug(f"Failed to record blob cache stats: {str(e)}")
+        with _pending_stats_lock:
+            _pending_stats.update(pending)
+
+
+def get_stats():
+    flush_stats()
+    connection = django_rq.get_connection("default")
+    return {key.decode(): int(value) for key, value in connection.hgetall(BLOB_CACHE_STATS_KEY).items()}
+
+
+def reset_stats():
+    with _pending_stats_lock:
+        _pending_stats.clear()
+    django_rq.get_connection("default").delete(BLOB_CACHE_STATS_KEY)
+
+
+_blob_cache = None
+_blob_cache_lock = threading.Lock()
+
+
+def get_blob_cache():
+    global _blob_cache
+    with _blob_cache_lock:
+        if _blob_cache is None:
+            _blob_cache = BlobCache(
+                settings.CURTAIN_BLOB_CACHE_MEMORY_BYTES,
+                settings.CURTAIN_BLOB_CACHE_MEMORY_ITEM_BYTES,
+                settings.CURTAIN_BLOB_CACHE_DIR,
+                settings.CURTAIN_BLOB_CACHE_DISK_BYTES,
+            )
+        return _blob_cache
+
+
+def _read_stored(field_file):
+    with field_file.storage.open(field_file.name, "rb") as f:
+        return f.read()
+
+
+def _read_unhashed(curtain):
+    """
+    Reads a curtain file that has no recorded content hash straight from storage and records its hash,
+    so the next read can go through the cache.
+    """
+    record_stat("storage_read")
+    data = with_storage_retries(lambda: _read_stored(curtain.file))
+    curtain.set_data_hash(hashlib.sha256(data).hexdigest())
+    return data
+
+
+def read_curtain_file(curtain):
+    """
+    Returns the bytes of a curtain session file. Files on local storage are read directly, remote ones go through
+    the blob cache.
+    """
+    if is_local_storage():
+        with curtain.file.storage.open(curtain.file.name, "rb") as f:
+            return f.read()
+    content_hash = curtain.get_data_hash()
+    if content_hash is None:
+        return _read_unhashed(curtain)
+    return get_blob_cache().read(content_hash, curtain.file)
+
+
+def open_curtain_file(curtain):
+    """
+    Returns a File for reading a curtain session file, going through the blob cache for remote storage.
+    The caller closes it.
+    """
+    if is_local_storage():
+        return File(curtain.file.storage.open(curtain.file.name, "rb"), name=curtain.file.name)
+    content_hash = curtain.get_data_hash()
+    if content_hash is None:
+        return ContentFile(_read_unhashed(curtain), name=curtain.file.name)
+    return get_blob_cache().open(content_hash, curtain.file)
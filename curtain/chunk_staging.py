@@ -0,0 +1,308 @@
+import fcntl
+import io
+import os
+import time
+import uuid
+
+import django_rq
+from django.conf import settings
+from redis.exceptions import WatchError
+
+STAGING_KEY_PREFIX = "curtain:staging:"
+COPY_BLOCK_SIZE = 1024 * 1024
+# Tries of a Redis write that another node's write to the same upload keeps interrupting
+WATCH_ATTEMPTS = 5
+
+
+class StagingConflict(Exception):
+    """
+    Raised when the staged data of an upload is shorter than the offset a chunk is written at, because it was
+    reaped or never reached the backend the chunk was sent to.
+    """
+
+    def __init__(self, staged_size, start):
+        super().__init__(f"Staged data ends at byte {staged_size}, the chunk starts at {start}")
+        self.staged_size = staged_size
+        self.start = start
+
+
+def write_blocks_at(fd, blocks, start):
+    """
+    Writes the blocks to the file descriptor from offset start on and returns the offset after the last byte.
+    """
+    position = start
+    for block in blocks:
+        view = memoryview(block)
+        while view:
+            written = os.pwrite(fd, view, position)
+            view = view[written:]
+            position += written
+    return position
+
+
+class FileStaging:
+    """
+    Stages upload data as files in a directory. Writes take a POSIX lock on the file, which NFS and other shared
+    volumes honour across hosts, so the directory can be shared by every web node and any node accepts any chunk.
+    """
+
+    def __init__(self, directory):
+        self.directory = str(directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _open_locked(self, name):
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(self.path(name), os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        return fd
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def open(self, name):
+        """
+        Opens the staged data for reading, or returns None if there is none.
+        """
+        try:
+            return open(self.path(name), "rb")
+        except FileNotFoundError:
+            return None
+
+    def read(self, name):
+        f = self.open(name)
+        if f is None:
+            return b""
+        with f:
+            return f.read()
+
+    def append(self, name, blocks, start):
+        """
+        Writes the blocks of a sequential chunk at start. Data past start, left by an earlier attempt at the same
+        chunk, is replaced. Raises StagingConflict if less than start bytes are staged.
+        """
+        fd = self._open_locked(name)
+        try:
+            size = os.fstat(fd).st_size
+            if size < start:
+                raise StagingConflict(size, start)
+            if size > start:
+                os.ftruncate(fd, start)
+            return write_blocks_at(fd, blocks, start)
+        finally:
+            os.close(fd)
+
+    def preallocate(self, name, size):
+        fd = self._open_locked(name)
+        try:
+            os.ftruncate(fd, 0)
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+    def write_at(self, name, blocks, start):
+        """
+        Writes the blocks of a parallel chunk at start. Chunks cover distinct ranges, so no lock is taken.
+        """
+        fd = os.open(self.path(name), os.O_WRONLY)
+        try:
+            return write_blocks_at(fd, blocks, start)
+        finally:
+            os.close(fd)
+
+    def replace(self, name, data):
+        """
+        Replaces the staged data at once, through a temporary file, so readers on other nodes never see it partially.
+        """
+        if not data:
+            self.delete(name)
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = f"{self.path(name)}.{uuid.uuid4().hex}.swap"
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.replace(temp_path, self.path(name))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def delete(self, name):
+        try:
+            os.remove(self.path(name))
+        except FileNotFoundError:
+            pass
+
+    def entries(self):
+        """
+        Returns (seconds since the last write, size, name) of every staged item.
+        """
+        now = time.time()
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            try:
+                file_stat = os.stat(self.path(name))
+            except FileNotFoundError:
+                continue
+            entries.append((now - file_stat.st_mtime, file_stat.st_size, name))
+        return entries
+
+
+class RedisStaging:
+    """
+    Stages upload data up to max_bytes in Redis, where every web node sees it without a shared volume. Data that
+    grows past max_bytes is moved to the fallback staging and stays there, so large uploads do not fill Redis.
+    Keys expire max_age seconds after their last write.
+    """
+
+    def __init__(self, max_bytes, max_age, fallback):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fallback = fallback
+
+    @property
+    def connection(self):
+        return django_rq.get_connection("default")
+
+    def key(self, name):
+        return f"{STAGING_KEY_PREFIX}{name}"
+
+    def exists(self, name):
+        return bool(self.connection.exists(self.key(name))) or self.fallback.exists(name)
+
+    def open(self, name):
+        data = self.connection.get(self.key(name))
+        if data is None:
+            return self.fallback.open(name)
+        return io.BytesIO(data)
+
+    def read(self, name):
+        data = self.connection.get(self.key(name))
+        if data is None:
+            return self.fallback.read(name)
+        return data
+
+    def _spill(self, name, data, blocks, start):
+        # data holds the chunk's first bytes, the staged bytes before start go along with it
+        staged = self.connection.getrange(self.key(name), 0, start - 1) if start else b""
+        self.fallback.append(name, [staged], 0)
+        end = self.fallback.append(name, [data], start)
+        end = self.fallback.append(name, blocks, end)
+        self.connection.delete(self.key(name))
+        return end
+
+    def append(self, name, blocks, start):
+        """
+        Appends like FileStaging.append. The chunk is buffered until it is known to fit under max_bytes. A write
+        interrupted by another node writing the same upload is retried, and raises StagingConflict if it keeps being.
+        """
+        if not self.connection.exists(self.key(name)) and (start or self.fallback.exists(name)):
+            return self.fallback.append(name, blocks, start)
+        blocks = iter(blocks)
+        buffer = bytearray()
+        for block in blocks:
+            buffer += block
+            if start + len(buffer) > self.max_bytes:
+                return self._spill(name, buffer, blocks, start)
+        key = self.key(name)
+        with self.connection.pipeline() as pipe:
+            for _ in range(WATCH_ATTEMPTS):
+                pipe.watch(key)
+                size = pipe.strlen(key)
+                if size < start:
+                    raise StagingConflict(size, start)
+                staged = pipe.getrange(key, 0, start - 1) if start else b""
+                pipe.multi()
+                pipe.set(key, staged + bytes(buffer), ex=self.max_age)
+                try:
+                    pipe.execute()
+                except WatchError:
+                    # another node wrote to the upload in between, check what is staged again
+                    continue
+                return start + len(buffer)
+        raise StagingConflict(size, start)
+
+    def preallocate(self, name, size):
+        if size > self.max_bytes:
+            self.fallback.preallocate(name, size)
+            return
+        self.connection.set(self.key(name), bytes(size), ex=self.max_age)
+
+    def write_at(self, name, blocks, start):
+        key = self.key(name)
+        if not self.connection.exists(key):
+            return self.fallback.write_at(name, blocks, start)
+        position = start
+        for block in blocks:
+            self.connection.setrange(key, position, bytes(block))
+            position += len(block)
+        self.connection.expire(key, self.max_age)
+        return position
+
+    def replace(self, name, data):
+        if len(data) > self.max_bytes:
+            self.connection.delete(self.key(name))
+            self.fallback.replace(name, data)
+            return
+        self.fallback.delete(name)
+        if data:
+            self.connection.set(self.key(name), data, ex=self.max_age)
+        else:
+            self.connection.delete(self.key(name))
+
+    def delete(self, name):
+        self.connection.delete(self.key(name))
+        self.fallback.delete(name)
+
+    def entries(self):
+        connection = self.connection
+        entries = []
+        for key in connection.scan_iter(match=f"{STAGING_KEY_PREFIX}*"):
+            with connection.pipeline(transaction=False) as pipe:
+                pipe.object("idletime", key)
+                pipe.strlen(key)
+                idle, size = pipe.execute()
+            if idle is not None:
+                entries.append((idle, size, key.decode("utf-8")[len(STAGING_KEY_PREFIX):]))
+        return entries + self.fallback.entries()
+
+
+def get_chunk_staging():
+    """
+    Returns the staging chunks of uploads to S3/GCS are assembled in, as selected by CURTAIN_CHUNK_STAGING.
+    """
+    file_staging = FileStaging(settings.CURTAIN_CHUNK_STAGING_DIR)
+    if settings.CURTAIN_CHUNK_STAGING == "redis":
+        return RedisStaging(settings.CURTAIN_CHUNK_STAGING_REDIS_MAX_BYTES, settings.CURTAIN_CHUNK_STAGING_MAX_AGE,
+                            file_staging)
+    return file_staging
+
+
+def reap_staged_chunks(staging=None, max_age=None, max_bytes=None):
+    """
+    Removes staged data not written to for max_age seconds, then the least recently written data until at most
+    max_bytes remain. Returns (items removed, bytes freed).
+    """
+    staging = staging or get_chunk_staging()
+    max_age = settings.CURTAIN_CHUNK_STAGING_MAX_AGE if max_age is None else max_age
+    max_bytes = settings.CURTAIN_CHUNK_STAGING_MAX_BYTES if max_bytes is None else max_bytes
+    entries = sorted(staging.entries(), reverse=True)
+    total = sum(size for _, size, _ in entries)
+    removed = 0
+    freed = 0
+    for age, size, name in entries:
+        if age <= max_age and total <= max_bytes:
+            break
+        staging.delete(name)
+        total -= size
+        removed += 1
+        freed += size
+    return removed, freed
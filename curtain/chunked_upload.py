@@ -1,27 +1,37 @@
-import hashlib
+import logging
 import mimetypes
 import os
 from typing import List, Optional, Tuple
 
 from django.conf import settings
-from django.core.files.base import ContentFile
-from django.db import models
+from django.core.files.base import File
+from django.db import models, transaction
+from django.shortcuts import get_object_or_404
 from django.utils import timezone
 from django.contrib.auth.models import AnonymousUser
 
+from drf_chunked_upload import settings as _settings
+from drf_chunked_upload.exceptions import ChunkedUploadError
 from drf_chunked_upload.models import AbstractChunkedUpload
 from drf_chunked_upload.serializers import ChunkedUploadSerializer
 from drf_chunked_upload.views import ChunkedUploadView
-from rest_framework import status
+from rest_framework import serializers, status
 from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
 
+from curtain.chunk_staging import StagingConflict, get_chunk_staging, write_blocks_at
+from curtain.hashing import DATA_HASH_ALGORITHM, discard_stream_digest, get_stream_digest, process_token
 from curtain.models import Curtain
+from curtain.multipart_upload import get_multipart_backend, multipart_part_size
 from curtain.serializers import CurtainSerializer
+from curtain.session_validation import SessionValidationError, SessionValidator, session_validation_enabled
 from curtain.permissions import IsNonUserPostAllow
 from curtain.throttling import ChunkedUploadThrottle
+from curtain.worker_tasks import queue_session_file_jobs
 from rest_framework import permissions
 
+logger = logging.getLogger(__name__)
+
 
 class CurtainChunkedUpload(AbstractChunkedUpload):
     user = models.ForeignKey(
@@ -55,6 +65,36 @@ class CurtainChunkedUpload(AbstractChunkedUpload):
         null=True,
         help_text="Session ID for tracking related uploads",
     )
+    multipart_upload_id = models.TextField(
+        blank=True,
+        null=True,
+        help_text="Upload ID (S3) or session URI (GCS) of the multipart upload the chunks are streamed to",
+    )
+    multipart_parts = models.JSONField(
+        default=list,
+        blank=True,
+        help_text="Parts already sent to the multipart upload",
+    )
+    multipart_offset = models.BigIntegerField(
+        default=0,
+        help_text="Number of bytes already sent to the multipart upload",
+    )
+    chunk_size = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text="Fixed chunk size of a parallel upload, whose chunks may arrive in any order",
+    )
+    received_chunks = models.BinaryField(
+        blank=True,
+        null=True,
+        help_text="Bitmap of the chunks of a parallel upload that have been written",
+    )
+    digest_owner = models.CharField(
+        max_length=255,
+        blank=True,
+        null=True,
+        help_text="Worker process that keeps the incremental digest of the upload",
+    )
 
     class Meta:
         app_label = "curtain"
@@ -62,28 +102,142 @@ class CurtainChunkedUpload(AbstractChunkedUpload):
     @property
     def checksum(self):
         """
-        Override to calculate checksum from temp file for remote storage.
+        Override to take the checksum from the digest updated while chunks are written.
 
-        When using S3/GCS, chunks are stored in a local temp file during upload.
-        The parent's checksum property reads from self.file which would be empty,
-        so we need to read from the temp file instead.
+        The parent's checksum property re-reads self.file, which is empty when the chunks went to a temp file
+        or a multipart upload, and costs a full pass over the file otherwise.
         """
-        temp_dir = os.path.join(settings.BASE_DIR, 'temp_uploads')
-        temp_path = os.path.join(temp_dir, f"temp_{self.id}.tmp")
+        return self.content_digests()[_settings.CHECKSUM_TYPE]
+
+    def _stream_digest(self):
+        # the session is validated on the same in-order pass that hashes it
+        return get_stream_digest(str(self.id), sorted({_settings.CHECKSUM_TYPE, DATA_HASH_ALGORITHM}),
+                                 SessionValidator if session_validation_enabled() else None)
 
-        if os.path.exists(temp_path):
-            checksum_type = getattr(settings, 'DRF_CHUNKED_UPLOAD_CHECKSUM', 'md5')
-            if checksum_type == 'sha256':
-                hasher = hashlib.sha256()
+    def _owns_digest(self):
+        """
+        Whether this process keeps the incremental digest of the upload. The first process to write a chunk claims
+        it; chunks written by other processes are passed through unhashed and read back once by the owner.
+        """
+        token = process_token()
+        if self.digest_owner is None:
+            if type(self).objects.filter(pk=self.pk, digest_owner__isnull=True).update(digest_owner=token):
+                self.digest_owner = token
             else:
-                hasher = hashlib.md5()
+                self.digest_owner = type(self).objects.values_list("digest_owner", flat=True).get(pk=self.pk)
+        return self.digest_owner == token
 
-            with open(temp_path, 'rb') as f:
-                for data in iter(lambda: f.read(8192), b''):
-                    hasher.update(data)
-            return hasher.hexdigest()
+    def _open_assembled_file(self):
+        """
+        Opens the bytes received so far: the local upload file, the staged data or the committed object of a
+        multipart upload. Returns None while a multipart upload is still open or nothing has been written.
+        """
+        if self.multipart_upload_id:
+            return None
+        if self.file and self._is_remote_storage():
+            return self.file.storage.open(self.file.name, 'rb')
+        if not self.file:
+            return get_chunk_staging().open(self._get_staging_name())
+        if not os.path.exists(self.file.path):
+            return None
+        return open(self.file.path, 'rb')
+
+    def _digesting(self, blocks, start):
+        """
+        Passes through the blocks of a chunk written at start, adding them to the upload's digest when this process
+        owns the digest and it has reached start. Earlier bytes it is missing, because another process handled the
+        previous chunks, are read back from the upload file first. Chunks that still cannot be hashed in order, like
+        concurrent chunks of a parallel upload, are caught up by content_digests at completion.
+        """
+        if not self._owns_digest():
+            yield from blocks
+            return
+        digest = self._stream_digest()
+        if not digest.lock.acquire(blocking=False):
+            yield from blocks
+            return
+        hashing = False
+        try:
+            if digest.offset < start and not self.is_parallel:
+                source = self._open_assembled_file()
+                if source is not None:
+                    with source:
+                        digest.catch_up(source, start)
+            hashing = digest.offset == start
+        finally:
+            if not hashing:
+                digest.lock.release()
+        if not hashing:
+            yield from blocks
+            return
+        try:
+            for block in blocks:
+                digest.update(block)
+                yield block
+        except BaseException:
+            # a chunk that was not written completely must not stay in the digest
+            digest.reset()
+            raise
+        finally:
+            digest.lock.release()
+
+    def content_digests(self):
+        """
+        Returns {algorithm: hexdigest} of the upload for the checksum and data hash algorithms.
+        Only the bytes the incremental digest has not seen are read from the file, which is all of it when the
+        upload is completed by a process that does not own the digest.
+        """
+        if getattr(self, '_content_digests', None) is None:
+            digest = self._stream_digest()
+            with digest.lock:
+                if digest.offset != self.offset:
+                    if digest.offset > self.offset:
+                        digest.reset()
+                    with self._open_assembled_file() as source:
+                        digest.catch_up(source)
+                self._content_digests = digest.hexdigests()
+                self._session_validator = digest.observer
+        return self._content_digests
+
+    def session_metadata(self):
+        """
+        Validates the assembled session and returns the metadata gathered while it was hashed.
+        Raises SessionValidationError for a malformed session.
+        """
+        self.content_digests()
+        validator = getattr(self, '_session_validator', None)
+        if validator is None:
+            return None
+        return validator.close()
 
-        return super().checksum
+    def move_to_curtain(self, curtain, save=True):
+        """
+        Hands the assembled file over to the curtain and returns its hash, or None if there was no file.
+        With save=False the curtain is left unsaved and the caller records the hash, as in bulk creation.
+        """
+        digest = self.content_digests()[DATA_HASH_ALGORITHM]
+        if self._is_remote_storage() and self.file:
+            # the chunks were streamed into the final object, so the session takes it over instead of copying it
+            if save:
+                curtain.attach_session_file(self.file.name, digest)
+            else:
+                curtain.link_session_file(self.file.name, digest)
+            self.file = None
+            self.save(update_fields=["file"])
+            return digest
+        if self._is_remote_storage():
+            f = get_chunk_staging().open(self._get_staging_name())
+            if f is None:
+                return None
+        elif self.file:
+            # opened through the storage because the handle left by the checksum still points at the .part path
+            f = self.file.storage.open(self.file.name, 'rb')
+        else:
+            return None
+        with f:
+            if save:
+                return curtain.save_session_file(File(f), digest)
+            return curtain.write_session_file(File(f), digest)
 
     def _is_remote_storage(self):
         return (
@@ -94,28 +248,207 @@ class CurtainChunkedUpload(AbstractChunkedUpload):
             'GoogleCloud' in str(type(self.file.storage))
         )
 
-    def _get_temp_path(self):
-        temp_dir = os.path.join(settings.BASE_DIR, 'temp_uploads')
-        os.makedirs(temp_dir, exist_ok=True)
-        return os.path.join(temp_dir, f"temp_{self.id}.tmp")
+    def _get_staging_name(self):
+        # chunks of uploads to S3/GCS that are not streamed as a multipart upload are assembled in the staging
+        return f"temp_{self.id}.tmp"
 
-    def append_chunk(self, chunk, chunk_size=None, save=True):
-        incoming_size = chunk_size or len(chunk)
+    def stage_chunk(self, chunk, start):
+        """
+        Writes a sequential chunk to the staging at start. Raises ChunkedUploadError if the data staged before it
+        is gone, e.g. because the upload was abandoned long enough for the reaper to remove it.
+        """
+        try:
+            get_chunk_staging().append(self._get_staging_name(), self._digesting(chunk.chunks(), start), start)
+        except StagingConflict as e:
+            raise ChunkedUploadError(
+                status=status.HTTP_400_BAD_REQUEST,
+                detail='The data received earlier for this upload is no longer available, restart the upload',
+                staged_offset=e.staged_size,
+            )
+        self._staged_upload = True
+
+    def _get_multipart_backend(self):
+        if not self._is_remote_storage():
+            return None
+        return get_multipart_backend(self.file.storage)
 
+    def _get_multipart_name(self):
+        """
+        Name of the object the chunks are streamed to. It is created next to the session files so the curtain can
+        take it over on completion.
+        """
+        return Curtain._meta.get_field("file").generate_filename(None, f"{self.id}.json")
+
+    def _get_multipart_spool_name(self):
+        return f"multipart_{self.id}.tmp"
+
+    def _read_multipart_spool(self):
+        return get_chunk_staging().read(self._get_multipart_spool_name())
+
+    def write_multipart_chunk(self, chunk, start):
+        """
+        Streams a chunk into the multipart upload of the remote object, opening the upload on the first chunk.
+        Full parts are sent as soon as they are buffered. The remainder, always smaller than one part, is spooled
+        in the chunk staging until the next chunk arrives because S3 and GCS do not accept arbitrarily small parts.
+        """
+        backend = self._get_multipart_backend()
+        name = self._get_multipart_name()
+        buffer = bytearray(self._read_multipart_spool())
+        if self.multipart_offset + len(buffer) != start:
+            raise ChunkedUploadError(
+                status=status.HTTP_400_BAD_REQUEST,
+                detail='Offsets do not match',
+                expected_offset=self.multipart_offset + len(buffer),
+                provided_offset=start,
+            )
+        if not self.multipart_upload_id:
+            self.multipart_upload_id = backend.start(name)
+            self.save(update_fields=["multipart_upload_id"])
+
+        part_size = multipart_part_size()
+        for subchunk in self._digesting(chunk.chunks(), start):
+            buffer += subchunk
+            while len(buffer) >= part_size:
+                backend.upload_part(name, self.multipart_upload_id, self.multipart_parts, self.multipart_offset,
+                                    bytes(buffer[:part_size]))
+                del buffer[:part_size]
+                self.multipart_offset += part_size
+                self.save(update_fields=["multipart_parts", "multipart_offset"])
+
+        get_chunk_staging().replace(self._get_multipart_spool_name(), bytes(buffer))
+
+    def complete_multipart_upload(self):
+        """
+        Sends the spooled remainder as the last part and commits the remote object, which then becomes self.file.
+        Does nothing if no multipart upload is open.
+        """
+        if not self.multipart_upload_id:
+            return
+        backend = self._get_multipart_backend()
+        name = self._get_multipart_name()
+        data = self._read_multipart_spool()
+        backend.complete(name, self.multipart_upload_id, self.multipart_parts, self.multipart_offset, data)
+        self.multipart_offset += len(data)
+        self.multipart_upload_id = None
+        self.file.name = name
+        self.file_size = self.multipart_offset
+        self.save()
+        get_chunk_staging().delete(self._get_multipart_spool_name())
+
+    def delete_file(self):
+        """
+        Aborts an open multipart upload and removes the staged data as well as the stored file.
+        """
+        if self.multipart_upload_id:
+            try:
+                self._get_multipart_backend().abort(self._get_multipart_name(), self.multipart_upload_id)
+            except Exception as e:
+                logger.warning(f"Failed to abort multipart upload of chunked upload {self.id}: {str(e)}")
+            self.multipart_upload_id = None
+        staging = get_chunk_staging()
+        staging.delete(self._get_multipart_spool_name())
+        staging.delete(self._get_staging_name())
+        if self.file and self._is_remote_storage():
+            self.file.storage.delete(self.file.name)
+            self.file = None
+            return
+        super().delete_file()
+
+    @property
+    def is_parallel(self):
+        return bool(self.chunk_size)
+
+    def chunk_count(self):
+        return -(-self.file_size // self.chunk_size)
+
+    def preallocate(self):
+        """
+        Creates the file of a parallel upload at its full size so chunks can be written at their offsets.
+        Uploads to S3/GCS are assembled in the chunk staging.
+        """
         if self._is_remote_storage():
-            temp_path = self._get_temp_path()
+            get_chunk_staging().preallocate(self._get_staging_name(), self.file_size)
+            return
+        self.file.name = self.file.field.generate_filename(self, self.filename)
+        os.makedirs(os.path.dirname(self.file.path), exist_ok=True)
+        self.save(update_fields=["file"])
+        with open(self.file.path, 'wb') as f:
+            try:
+                os.posix_fallocate(f.fileno(), 0, self.file_size)
+            except (AttributeError, OSError):
+                f.truncate(self.file_size)
 
-            with open(temp_path, 'ab') as temp_file:
-                for subchunk in chunk.chunks():
-                    temp_file.write(subchunk)
+    def write_chunk_at(self, chunk, start):
+        """
+        Writes a chunk of a parallel upload at its offset and marks it as received. Chunks can be written by
+        concurrent requests; only the bitmap update is serialized.
+        """
+        self._content_digests = None
+        blocks = self._digesting(chunk.chunks(), start)
+        if self._is_remote_storage():
+            position = get_chunk_staging().write_at(self._get_staging_name(), blocks, start)
+        else:
+            fd = os.open(self.file.path, os.O_WRONLY)
+            try:
+                position = write_blocks_at(fd, blocks, start)
+            finally:
+                os.close(fd)
+        self._mark_chunk_received(start // self.chunk_size, position - start)
+
+    def _mark_chunk_received(self, index, size):
+        with transaction.atomic():
+            upload = type(self).objects.select_for_update().only("received_chunks", "offset").get(pk=self.pk)
+            bitmap = bytearray(upload.received_chunks or bytes((self.chunk_count() + 7) // 8))
+            if not bitmap[index // 8] & (1 << index % 8):
+                bitmap[index // 8] |= 1 << index % 8
+                upload.offset += size
+                type(self).objects.filter(pk=self.pk).update(received_chunks=bytes(bitmap), offset=upload.offset)
+        self.received_chunks = bytes(bitmap)
+        self.offset = upload.offset
+
+    def missing_ranges(self):
+        """
+        Returns the inclusive byte ranges of a parallel upload that have not been received yet.
+        Sequential uploads have no gaps and always return an empty list.
+        """
+        if not self.is_parallel:
+            return []
+        bitmap = bytes(self.received_chunks or b"")
+        ranges = []
+        for index in range(self.chunk_count()):
+            if index // 8 < len(bitmap) and bitmap[index // 8] & (1 << index % 8):
+                continue
+            start = index * self.chunk_size
+            end = min(start + self.chunk_size, self.file_size) - 1
+            if ranges and ranges[-1][1] == start - 1:
+                ranges[-1][1] = end
+            else:
+                ranges.append([start, end])
+        return ranges
+
+    def delete(self, delete_file=True, *args, **kwargs):
+        # the files are named after the id, which Model.delete clears, so they are removed first
+        if delete_file:
+            self.delete_file()
+        discard_stream_digest(str(self.id))
+        return super().delete(False, *args, **kwargs)
+
+    def append_chunk(self, chunk, chunk_size=None, save=True):
+        incoming_size = chunk_size or len(chunk)
+        start = self.offset
+        self._content_digests = None
 
+        if self._get_multipart_backend():
+            self.write_multipart_chunk(chunk, start)
+            self.offset += incoming_size
+        elif self._is_remote_storage():
+            self.stage_chunk(chunk, start)
             self.offset += incoming_size
-            self._temp_upload_path = temp_path
         else:
             self.offset += incoming_size
             try:
                 self.file.open(mode='ab')
-                for subchunk in chunk.chunks():
+                for subchunk in self._digesting(chunk.chunks(), start):
                     self.file.write(subchunk)
             finally:
                 self.file.close()
@@ -127,12 +460,14 @@ class CurtainChunkedUpload(AbstractChunkedUpload):
         if completed_at is None:
             completed_at = timezone.now()
 
+        self.complete_multipart_upload()
+
         self.status = self.COMPLETE
         self.completed_at = completed_at
         self.save()
+        discard_stream_digest(str(self.id))
 
         if not self._is_remote_storage() and self.file and self.file.name:
-            from drf_chunked_upload import settings as _settings
             if ext is None:
                 ext = _settings.COMPLETE_EXT
             if ext != _settings.INCOMPLETE_EXT:
@@ -148,18 +483,15 @@ class CurtainChunkedUpload(AbstractChunkedUpload):
         if self.filename and not self.mime_type:
             self.mime_type, _ = mimetypes.guess_type(self.filename)
 
-        if self.status == self.COMPLETE and hasattr(self, '_temp_upload_path'):
-            temp_path = self._temp_upload_path
-            if os.path.exists(temp_path):
-                with open(temp_path, 'rb') as temp_file:
+        if self.status == self.COMPLETE and getattr(self, '_staged_upload', False):
+            staging = get_chunk_staging()
+            staged = staging.open(self._get_staging_name())
+            if staged is not None:
+                with staged:
                     filename = self.filename or self.generate_filename()
-                    from django.core.files.base import ContentFile
-                    self.file.save(filename, ContentFile(temp_file.read()), save=False)
-
-                try:
-                    os.remove(temp_path)
-                except OSError:
-                    pass
+                    self.file.save(filename, File(staged), save=False)
+                staging.delete(self._get_staging_name())
+            self._staged_upload = False
 
         if self.status == self.COMPLETE and self.file and not self.file_size:
             try:
@@ -173,14 +505,8 @@ class CurtainChunkedUpload(AbstractChunkedUpload):
         super().save(*args, **kwargs)
 
     def generate_filename(self):
-        if self.file:
-            sha256_hash = hashlib.sha256()
-            self.file.seek(0)
-            for chunk in iter(lambda: self.file.read(4096), b""):
-                sha256_hash.update(chunk)
-            self.file.seek(0)
-
-            hash_prefix = sha256_hash.hexdigest()[:16]
+        if self.file or get_chunk_staging().exists(self._get_staging_name()):
+            hash_prefix = self.content_digests()[DATA_HASH_ALGORITHM][:16]
             timestamp = timezone.now().strftime("%Y%m%d_%H%M%S")
             user_id = self.user.id if self.user else "anonymous"
 
@@ -262,6 +588,13 @@ class CurtainChunkedUpload(AbstractChunkedUpload):
 
         return True, ""
 
+    def validate_session_content(self) -> Tuple[bool, str]:
+        try:
+            self.session_metadata()
+        except SessionValidationError as e:
+            return False, str(e)
+        return True, ""
+
     def validate_upload(self) -> Tuple[bool, str]:
         is_valid, error_msg = self.validate_file_type()
         if not is_valid:
@@ -289,6 +622,8 @@ class CurtainChunkedUploadSerializer(ChunkedUploadSerializer):
             "mime_type",
             "file_size",
             "upload_session_id",
+            "chunk_size",
+            "missing_ranges",
         )
         read_only_fields = (
             "id",
@@ -297,20 +632,25 @@ class CurtainChunkedUploadSerializer(ChunkedUploadSerializer):
             "completed_at",
             "mime_type",
             "file_size",
+            "chunk_size",
         )
 
+    missing_ranges = serializers.SerializerMethodField()
+
+    def get_missing_ranges(self, obj):
+        return obj.missing_ranges()
+
     def create(self, validated_data):
         file_data = validated_data.pop('file', None)
         instance = super().create(validated_data)
 
-        if file_data and instance._is_remote_storage():
-            temp_path = instance._get_temp_path()
-
-            with open(temp_path, 'wb') as temp_file:
-                for chunk in file_data.chunks():
-                    temp_file.write(chunk)
-
-            instance._temp_upload_path = temp_path
+        if instance.is_parallel:
+            # the view preallocates the file and writes the chunk at its offset
+            return instance
+        if file_data and instance._get_multipart_backend():
+            instance.write_multipart_chunk(file_data, 0)
+        elif file_data and instance._is_remote_storage():
+            instance.stage_chunk(file_data, 0)
         elif file_data:
             instance.file = file_data
             instance.save()
@@ -337,6 +677,79 @@ class CurtainChunkedUploadView(ChunkedUploadView):
             return self.model.objects.filter(user__isnull=True)
         return self.model.objects.filter(user=self.request.user)
 
+    def _put_chunk(self, request, pk=None, whole=False, *args, **kwargs):
+        """
+        Handles chunks of parallel uploads, which are created with a chunk_size and accept chunks at any
+        chunk-aligned offset in any order. Everything else goes through the sequential protocol.
+        """
+        if whole:
+            return super()._put_chunk(request, pk=pk, whole=whole, *args, **kwargs)
+        if pk:
+            chunked_upload = get_object_or_404(self.get_queryset(), pk=pk)
+            if not chunked_upload.is_parallel:
+                return super()._put_chunk(request, pk=pk, *args, **kwargs)
+            self.is_valid_chunked_upload(chunked_upload)
+        elif request.data.get("chunk_size"):
+            chunked_upload = None
+        else:
+            return super()._put_chunk(request, *args, **kwargs)
+
+        try:
+            chunk = request.data[self.field_name]
+        except KeyError:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST, detail='No chunk file was submitted')
+        match = self.content_range_pattern.match(request.META.get('HTTP_CONTENT_RANGE', ''))
+        if not match:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST, detail='Error in request headers')
+        start, end, total = int(match.group('start')), int(match.group('end')), int(match.group('total'))
+
+        max_bytes = self.get_max_bytes(request)
+        if end >= total:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST,
+                                     detail='End of chunk exceeds reported total (%s bytes)' % total)
+        if max_bytes is not None and total > max_bytes:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST,
+                                     detail='Size of file exceeds the limit (%s bytes)' % max_bytes)
+        if chunk.size != end - start + 1:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST,
+                                     detail="File size doesn't match headers")
+
+        if chunked_upload is None:
+            chunked_upload = self._create_parallel_upload(request, total)
+        if total != chunked_upload.file_size:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST,
+                                     detail='Total size does not match the upload (%s bytes)' % chunked_upload.file_size)
+        if start % chunked_upload.chunk_size or (chunk.size != chunked_upload.chunk_size and end != total - 1):
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST,
+                                     detail='Chunks must start at a multiple of chunk_size and be chunk_size bytes long')
+
+        chunked_upload.write_chunk_at(chunk, start)
+        return chunked_upload
+
+    def _create_parallel_upload(self, request, total):
+        try:
+            chunk_size = int(request.data["chunk_size"])
+        except ValueError:
+            chunk_size = 0
+        if chunk_size <= 0:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST, detail='chunk_size must be a positive integer')
+        serializer = self.serializer_class(data=request.data)
+        if not serializer.is_valid():
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST, detail=serializer.errors)
+        user = request.user if request.user.is_authenticated else None
+        chunked_upload = serializer.save(offset=0, file_size=total, chunk_size=chunk_size, user=user)
+        chunked_upload.preallocate()
+        return chunked_upload
+
+    def checksum_check(self, chunked_upload, checksum):
+        missing = chunked_upload.missing_ranges()
+        if missing:
+            raise ChunkedUploadError(status=status.HTTP_400_BAD_REQUEST, detail='Upload is incomplete',
+                                     missing_ranges=missing)
+        # chunks streamed to S3/GCS can only be read back once the multipart upload is committed
+        chunked_upload.complete_multipart_upload()
+        super().checksum_check(chunked_upload, checksum)
+
     def on_completion(self, uploaded_file, request):
         try:
             curtain_id = request.data.get("curtain_id")
@@ -377,6 +790,13 @@ class CurtainChunkedUploadView(ChunkedUploadView):
                     status=status.HTTP_403_FORBIDDEN
                 )
 
+            if not encrypted:
+                # encrypted sessions cannot be inspected
+                is_valid, error_msg = uploaded_file.validate_session_content()
+                if not is_valid:
+                    uploaded_file.delete()
+                    return Response(data={"error": error_msg}, status=status.HTTP_400_BAD_REQUEST)
+
             c.name = name
             c.description = description
             c.enable = enable
@@ -384,16 +804,7 @@ class CurtainChunkedUploadView(ChunkedUploadView):
             c.permanent = permanent
             c.encrypted = encrypted
 
-            if uploaded_file._is_remote_storage():
-                temp_path = uploaded_file._get_temp_path()
-                if os.path.exists(temp_path):
-                    with open(temp_path, 'rb') as f:
-                        c.file.save(str(c.link_id) + ".json", ContentFile(f.read()))
-            elif uploaded_file.file:
-                from django.core.files import File as djangoFile
-                uploaded_file.file.open(mode='rb')
-                c.file.save(str(c.link_id) + ".json", djangoFile(uploaded_file.file))
-                uploaded_file.file.close()
+            uploaded_file.move_to_curtain(c)
 
             if expiry_duration:
                 from datetime import timedelta
@@ -407,6 +818,7 @@ class CurtainChunkedUploadView(ChunkedUploadView):
                 c.expiry_duration = timedelta(days=expiry_months * 30)
 
             c.save()
+            queue_session_file_jobs(c)
 
             if not is_update:
                 if type(request.user) != AnonymousUser:
@@ -0,0 +1,160 @@
+import mimetypes
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import File
+from django.core.files.storage import Storage, default_storage
+from django.utils.deconstruct import deconstructible
+
+from curtain.compression import STORED_ENCODINGS, VARIANT_SUFFIXES, available_encodings, compress_stream, \
+    open_decompressed, stored_encoding
+
+# Compressed content is kept in memory up to this size while it is written, larger files spill to a temp file
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# S3 and GCS derive Content-Encoding from the name, so signed URLs of .zst objects are decoded by the client
+if not mimetypes.inited:
+    mimetypes.init()
+mimetypes.encodings_map.setdefault(".zst", "zstd")
+
+
+def at_rest_encoding():
+    """
+    Returns the codec new session files are compressed with, or None when they are stored as they are.
+    """
+    return settings.CURTAIN_AT_REST_COMPRESSION or None
+
+
+def check_at_rest_compression():
+    """
+    Raises ImproperlyConfigured when CURTAIN_AT_REST_COMPRESSION is not a stored codec this environment can write,
+    so the server refuses to start instead of failing every upload.
+    """
+    encoding = at_rest_encoding()
+    if encoding is None:
+        return
+    if encoding not in STORED_ENCODINGS:
+        raise ImproperlyConfigured(f"CURTAIN_AT_REST_COMPRESSION must be one of {', '.join(STORED_ENCODINGS)}, "
+                                   f"not {encoding!r}")
+    if encoding not in available_encodings():
+        raise ImproperlyConfigured(f"CURTAIN_AT_REST_COMPRESSION is {encoding!r}, but the zstandard package is "
+                                   f"not installed")
+
+
+class DecompressedFile(File):
+    """
+    Reads the decompressed content of a stored file. Closing it closes the stored file as well.
+    """
+
+    def __init__(self, stored_file, encoding, name=None):
+        super().__init__(open_decompressed(encoding, stored_file), name)
+        self.stored_file = stored_file
+
+    def close(self):
+        try:
+            self.file.close()
+        finally:
+            self.stored_file.close()
+
+
+@deconstructible(path="curtain.compressed_storage.CompressedStorage")
+class CompressedStorage(Storage):
+    """
+    Wraps the default storage so session files are written compressed with CURTAIN_AT_REST_COMPRESSION.
+    The codec is recorded as the suffix of the stored name (.zst, .gz), and opening such a file reads its
+    decompressed content as a stream. Files without the suffix, e.g. stored before compression was enabled,
+    are read as they are. Everything else is passed through to the wrapped storage.
+    """
+
+    def __init__(self, storage=None):
+        self._wrapped_storage = storage
+
+    @property
+    def storage(self):
+        return self._wrapped_storage if self._wrapped_storage is not None else default_storage
+
+    def __getattr__(self, name):
+        # backend specifics such as connection or bucket_name; guarded so copying an instance cannot recurse
+        if name.startswith("_wrapped"):
+            raise AttributeError(name)
+        return getattr(self.storage, name)
+
+    def save(self, name, content, max_length=None):
+        encoding = at_rest_encoding()
+        if name is None:
+            name = content.name
+        if encoding is None or stored_encoding(name):
+            return self.storage.save(name, content, max_length=max_length)
+        if hasattr(content, "seek"):
+            content.seek(0)
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as compressed:
+            compress_stream(encoding, content, compressed)
+            compressed.seek(0)
+            stored_name = name + VARIANT_SUFFIXES[encoding]
+            return self.storage.save(stored_name, File(compressed, name=stored_name), max_length=max_length)
+
+    def _open(self, name, mode="rb"):
+        f = self.storage.open(name, mode)
+        encoding = stored_encoding(name)
+        if encoding is None or "r" not in mode:
+            return f
+        return DecompressedFile(f, encoding, name)
+
+    def open_stored(self, name):
+        """
+        Opens the file as it is stored, without decompressing it.
+        """
+        return self.storage.open(name, "rb")
+
+    def delete(self, name):
+        return self.storage.delete(name)
+
+    def exists(self, name):
+        return self.storage.exists(name)
+
+    def listdir(self, path):
+        return self.storage.listdir(path)
+
+    def size(self, name):
+        """
+        Size of the stored, possibly compressed, file.
+        """
+        return self.storage.size(name)
+
+    def url(self, name):
+        return self.storage.url(name)
+
+    def path(self, name):
+        return self.storage.path(name)
+
+    def get_valid_name(self, name):
+        return self.storage.get_valid_name(name)
+
+    def get_alternative_name(self, file_root, file_ext):
+        return self.storage.get_alternative_name(file_root, file_ext)
+
+    def get_available_name(self, name, max_length=None):
+        return self.storage.get_available_name(name, max_length=max_length)
+
+    def generate_filename(self, filename):
+        return self.storage.generate_filename(filename)
+
+    def get_accessed_time(self, name):
+        return self.storage.get_accessed_time(name)
+
+    def get_created_time(self, name):
+        return self.storage.get_created_time(name)
+
+    def get_modified_time(self, name):
+        return self.storage.get_modified_time(name)
+
+
+def open_stored_file(field_file):
+    """
+    Opens a session file as it is stored, so compressed files can be passed through without decoding them.
+    """
+    storage = field_file.storage
+    if isinstance(storage, CompressedStorage):
+        return storage.open_stored(field_file.name)
+    return storage.open(field_file.name, "rb")
@@ -0,0 +1,186 @@
+import gzip
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# Content-Encoding token -> file suffix of the precompressed sibling.
+# The suffixes match the conventions of nginx gzip_static/brotli_static/zstd_static.
+VARIANT_SUFFIXES = {
+    "br": ".br",
+    "zstd": ".zst",
+    "gzip": ".gz",
+}
+
+# Preferred order when the client accepts several encodings with the same q-value
+ENCODING_PREFERENCE = ("br", "zstd", "gzip")
+
+# Codecs session files can be stored with (see curtain.compressed_storage), most preferred first
+STORED_ENCODINGS = ("zstd", "gzip")
+
+accept_encoding_regex = re.compile(r"\s*([A-Za-z0-9_*-]+)\s*(?:;\s*q\s*=\s*([0-9.]+))?\s*")
+
+
+def available_encodings():
+    """
+    Returns the encodings that can be produced with the libraries installed in this environment.
+    gzip is always available, brotli and zstd need the optional brotli and zstandard packages.
+    """
+    encodings = []
+    if brotli is not None:
+        encodings.append("br")
+    if zstandard is not None:
+        encodings.append("zstd")
+    encodings.append("gzip")
+    return encodings
+
+
+def variant_path(path, encoding):
+    return path + VARIANT_SUFFIXES[encoding]
+
+
+def is_variant_fresh(path, encoding):
+    """
+    Checks that the precompressed sibling exists and is not older than the original file.
+    """
+    compressed_path = variant_path(path, encoding)
+    try:
+        return os.path.getmtime(compressed_path) >= os.path.getmtime(path)
+    except OSError:
+        return False
+
+
+def _compress_to(encoding, source, destination):
+    if encoding == "gzip":
+        with gzip.GzipFile(fileobj=destination, mode="wb", compresslevel=9, mtime=0) as gz:
+            shutil.copyfileobj(source, gz, COPY_BLOCK_SIZE)
+    elif encoding == "br":
+        compressor = brotli.Compressor(quality=9)
+        for block in iter(lambda: source.read(COPY_BLOCK_SIZE), b""):
+            destination.write(compressor.process(block))
+        destination.write(compressor.finish())
+    elif encoding == "zstd":
+        zstandard.ZstdCompressor(level=19).copy_stream(source, destination, read_size=COPY_BLOCK_SIZE)
+    else:
+        raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+def compress_stream(encoding, source, destination):
+    """
+    Compresses source into destination at the codec's default level, which is fast enough for the upload path.
+    """
+    if encoding == "gzip":
+        with gzip.GzipFile(fileobj=destination, mode="wb", mtime=0) as gz:
+            shutil.copyfileobj(source, gz, COPY_BLOCK_SIZE)
+    elif encoding == "zstd":
+        zstandard.ZstdCompressor().copy_stream(source, destination, read_size=COPY_BLOCK_SIZE)
+    else:
+        raise ValueError(f"Unsupported stored encoding: {encoding}")
+
+
+def open_decompressed(encoding, f):
+    """
+    Returns a file object reading the decompressed content of f as a stream. Closing it does not close f.
+    """
+    if encoding == "gzip":
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    if encoding == "zstd":
+        return zstandard.ZstdDecompressor().stream_reader(f, read_size=COPY_BLOCK_SIZE, closefd=False)
+    raise ValueError(f"Unsupported stored encoding: {encoding}")
+
+
+def stored_encoding(name):
+    """
+    Returns the codec a session file was stored with, recorded as the suffix of its name, or None for a plain file.
+    """
+    for encoding in STORED_ENCODINGS:
+        if name.endswith(VARIANT_SUFFIXES[encoding]):
+            return encoding
+    return None
+
+
+def strip_stored_suffix(name):
+    encoding = stored_encoding(name)
+    return name[:-len(VARIANT_SUFFIXES[encoding])] if encoding else name
+
+
+def write_compressed_variants(path, force=False):
+    """
+    Writes a precompressed sibling of the file at path for every available encoding.
+    Each variant is streamed into a temporary file and moved into place, so readers never see a partial variant.
+    Returns the list of encodings that were (re)generated.
+    """
+    written = []
+    for encoding in available_encodings():
+        if not force and is_variant_fresh(path, encoding):
+            continue
+        compressed_path = variant_path(path, encoding)
+        temp_path = compressed_path + ".tmp"
+        try:
+            with open(path, "rb") as source, open(temp_path, "wb") as destination:
+                _compress_to(encoding, source, destination)
+            os.replace(temp_path, compressed_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        written.append(encoding)
+    return written
+
+
+def remove_compressed_variants(path):
+    for encoding in VARIANT_SUFFIXES:
+        try:
+            os.remove(variant_path(path, encoding))
+        except FileNotFoundError:
+            pass
+
+
+def parse_accept_encoding(header):
+    """
+    Parses an Accept-Encoding header into a dict of encoding -> q-value.
+    """
+    accepted = {}
+    for part in (header or "").split(","):
+        match = accept_encoding_regex.fullmatch(part)
+        if not match:
+            continue
+        try:
+            q = float(match.group(2)) if match.group(2) is not None else 1.0
+        except ValueError:
+            continue
+        accepted[match.group(1).lower()] = q
+    return accepted
+
+
+def accepts_encoding(accept_encoding, encoding):
+    accepted = parse_accept_encoding(accept_encoding)
+    return accepted.get(encoding, accepted.get("*", 0.0)) > 0
+
+
+def select_variant(path, accept_encoding):
+    """
+    Picks the best fresh precompressed sibling of path allowed by the client's Accept-Encoding header.
+    Returns (encoding, path_to_serve); encoding is None when the original file should be served.
+    """
+    accepted = parse_accept_encoding(accept_encoding)
+    candidates = []
+    for encoding in ENCODING_PREFERENCE:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > 0 and is_variant_fresh(path, encoding):
+            candidates.append((q, encoding))
+    if not candidates:
+        return None, path
+    # max() keeps the first of equal q-values, which follows ENCODING_PREFERENCE
+    _, encoding = max(candidates, key=lambda candidate: candidate[0])
+    return encoding, variant_path(path, encoding)
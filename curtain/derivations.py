@@ -0,0 +1,294 @@
+import io
+import json
+import logging
+from datetime import timedelta
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db.models import F, Q
+from django.utils import timezone
+
+from curtain.blob_cache import read_curtain_file
+from curtain.models import DataHash, SessionDerivation
+from curtain.storage import is_local_storage, with_storage_retries
+from curtain.utils import parse_uniprot_accessions
+
+logger = logging.getLogger(__name__)
+
+DERIVED_PREFIX = "media/files/derived/"
+TABLES = ("processed", "raw")
+
+# Artifacts written by each stage, in the order the stages run
+STAGES = {
+    "tables": tuple(f"{table}.parquet" for table in TABLES),
+    "manifest": ("manifest.json",),
+    "protein_ids": ("protein_ids.json",),
+}
+
+# A stage left running for longer than this belongs to a worker that died and may be claimed again
+STALE_RUNNING_AFTER = timedelta(minutes=30)
+# Runs of a stage before it is left failed until derive_session_artifacts --retry-failed
+MAX_ATTEMPTS = 3
+# A session read before its artifacts exist has their derivation queued at most once in this many seconds
+DERIVATIONS_QUEUED_FOR = 10 * 60
+
+
+class DerivationError(Exception):
+    pass
+
+
+def derivations_enabled():
+    return settings.CURTAIN_DERIVE_SESSION_ARTIFACTS
+
+
+def artifact_name(digest, filename):
+    return f"{DERIVED_PREFIX}{digest}/{filename}"
+
+
+class ParsedSession:
+    """
+    The session and its tables, each parsed at most once however many stages use them.
+    """
+
+    def __init__(self, curtain):
+        self.curtain = curtain
+        self._data = None
+        self._tables = {}
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = json.loads(read_curtain_file(self.curtain))
+            if not isinstance(self._data, dict):
+                raise DerivationError("Session file is not a JSON object")
+        return self._data
+
+    def table(self, name, columns=None):
+        """
+        Returns the parsed table, or a copy of the requested columns it has.
+        """
+        if name not in self._tables:
+            content = self.data.get(name)
+            self._tables[name] = pd.read_csv(io.StringIO(content), sep="\t") if content else pd.DataFrame()
+        if columns is None:
+            return self._tables[name]
+        df = self._tables[name]
+        return df[[column for column in dict.fromkeys(columns) if column in df.columns]]
+
+
+def _read_remote_table(name, columns):
+    with default_storage.open(name, "rb") as f:
+        return pq.read_table(f, columns=columns)
+
+
+class DerivedSession:
+    """
+    Reads a session from its derived artifacts instead of the session file: the forms and sample settings from the
+    manifest and the tables from their Parquet files. Only the requested columns are read, from a memory map on
+    local storage.
+    """
+
+    def __init__(self, digest, manifest):
+        self.digest = digest
+        self.manifest = manifest
+
+    @property
+    def data(self):
+        # the parts of the session the manifest holds, shaped like the session file
+        return {
+            "differentialForm": self.manifest["differentialForm"],
+            "rawForm": self.manifest["rawForm"],
+            "settings": {key: self.manifest[key] for key in ("sampleOrder", "sampleMap", "conditionOrder")
+                         if self.manifest.get(key) is not None},
+        }
+
+    def table(self, name, columns=None):
+        if columns is not None:
+            stored = {column["name"] for column in self.manifest["tables"][name]["columns"]}
+            columns = [column for column in dict.fromkeys(columns) if column in stored]
+        artifact = artifact_name(self.digest, f"{name}.parquet")
+        if is_local_storage():
+            table = pq.read_table(default_storage.path(artifact), columns=columns, memory_map=True)
+        else:
+            table = with_storage_retries(lambda: _read_remote_table(artifact, columns))
+        # without the pandas metadata missing strings come back as None, like in the parsed table, instead of pd.NA
+        return table.to_pandas(ignore_metadata=True)
+
+
+def _save_artifact(name, data):
+    # artifacts are named by content hash, so an existing one is from an earlier, interrupted run
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    return default_storage.save(name, ContentFile(data))
+
+
+def table_to_parquet(df):
+    """
+    Serializes a table to Parquet. Columns mixing types, which pandas keeps as objects, are stored as strings.
+    """
+    buffer = io.BytesIO()
+    try:
+        df.to_parquet(buffer, engine="pyarrow", index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError):
+        mixed = {column: "string" for column in df.columns if df[column].dtype == object}
+        buffer = io.BytesIO()
+        df.astype(mixed).to_parquet(buffer, engine="pyarrow", index=False)
+    return buffer.getvalue()
+
+
+def derive_tables(session, digest):
+    return [_save_artifact(artifact_name(digest, f"{table}.parquet"), table_to_parquet(session.table(table)))
+            for table in TABLES]
+
+
+def derive_manifest(session, digest):
+    """
+    Writes what consumers need to know about the session without parsing it: its forms, the sample layout and the
+    columns, types and row counts of its tables.
+    """
+    data = session.data
+    session_settings = data.get("settings") or {}
+    manifest = {
+        "hash": digest,
+        "keys": list(data),
+        "differentialForm": data.get("differentialForm"),
+        "rawForm": data.get("rawForm"),
+        "sampleOrder": session_settings.get("sampleOrder"),
+        "sampleMap": session_settings.get("sampleMap"),
+        "conditionOrder": session_settings.get("conditionOrder"),
+        "tables": {
+            table: {
+                "rows": len(session.table(table)),
+                "columns": [{"name": str(column), "dtype": str(dtype)} for column, dtype in session.table(table).dtypes.items()],
+            }
+            for table in TABLES
+        },
+    }
+    return [_save_artifact(artifact_name(digest, "manifest.json"), json.dumps(manifest).encode("utf-8"))]
+
+
+def derive_protein_ids(session, digest):
+    """
+    Writes the distinct primary ids of the differential table with the UniProt accession parsed from each.
+    """
+    differential_form = session.data.get("differentialForm") or {}
+    primary_id_column = differential_form.get("_primaryIDs")
+    df = session.table("processed")
+    if primary_id_column not in df.columns:
+        raise DerivationError(f"Primary id column {primary_id_column!r} is not in the processed table")
+    primary_ids = df[primary_id_column].dropna().astype(str).unique().tolist()
+    accessions = [accession if pd.notnull(accession) else None for accession in parse_uniprot_accessions(primary_ids)]
+    protein_ids = {"primaryIDs": primary_ids, "accessions": accessions}
+    return [_save_artifact(artifact_name(digest, "protein_ids.json"), json.dumps(protein_ids).encode("utf-8"))]
+
+
+STAGE_FUNCTIONS = {
+    "tables": derive_tables,
+    "manifest": derive_manifest,
+    "protein_ids": derive_protein_ids,
+}
+
+
+def claim_stage(digest, stage):
+    """
+    Marks a stage as running for this worker. Returns False when it is done, already running elsewhere or has used
+    up its attempts, so a stage is never derived twice at once or again once it succeeded.
+    """
+    derivation, _ = SessionDerivation.objects.get_or_create(hash=digest, stage=stage)
+    stale = timezone.now() - STALE_RUNNING_AFTER
+    return bool(SessionDerivation.objects.filter(pk=derivation.pk).filter(
+        Q(status="pending") | Q(status="failed", attempts__lt=MAX_ATTEMPTS) | Q(status="running", updated__lt=stale)
+    ).update(status="running", attempts=F("attempts") + 1, error="", updated=timezone.now()))
+
+
+def run_derivations(curtain, stages=None, session=None):
+    """
+    Runs the derivation stages that are not done yet for the curtain's current content and returns
+    {stage: status}. Every stage is attempted. If any of them fails DerivationError is raised afterwards,
+    so the job is retried and the stages that did succeed are skipped on the next run.
+    A ParsedSession of the curtain can be passed in to reuse what it already parsed.
+    """
+    digest = curtain.get_data_hash() or curtain.update_data_hash()
+    session = session or ParsedSession(curtain)
+    statuses = {}
+    failed = []
+    for stage in stages or STAGES:
+        if not claim_stage(digest, stage):
+            statuses[stage] = SessionDerivation.objects.get(hash=digest, stage=stage).status
+            continue
+        try:
+            artifacts = STAGE_FUNCTIONS[stage](session, digest)
+        except Exception as e:
+            logger.warning(f"Deriving {stage} of {digest} failed: {str(e)}")
+            SessionDerivation.objects.filter(hash=digest, stage=stage).update(
+                status="failed", error=str(e), updated=timezone.now())
+            statuses[stage] = "failed"
+            failed.append(stage)
+            continue
+        SessionDerivation.objects.filter(hash=digest, stage=stage).update(
+            status="done", artifacts=artifacts, updated=timezone.now())
+        statuses[stage] = "done"
+    if failed:
+        raise DerivationError(f"Deriving {', '.join(failed)} of {digest} failed")
+    return statuses
+
+
+def load_manifest(digest):
+    """
+    Returns the derived manifest of the content hash or None if it is missing.
+    """
+    try:
+        with default_storage.open(artifact_name(digest, "manifest.json"), "rb") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def queue_derivations(curtain, digest):
+    """
+    Queues derive_session_artifacts for a session read before its artifacts exist, at most once in
+    DERIVATIONS_QUEUED_FOR seconds per content hash however often it is read meanwhile.
+    """
+    # worker_tasks imports this module
+    from curtain.worker_tasks import derive_session_artifacts, enqueue_job
+    try:
+        queued = cache.add(f"curtain:derivations_queued:{digest}", True, DERIVATIONS_QUEUED_FOR)
+    except Exception as e:
+        logger.warning(f"Failed to mark the derivations of {digest} as queued: {str(e)}")
+        return
+    if queued:
+        enqueue_job(derive_session_artifacts, curtain.id)
+
+
+def open_session(curtain):
+    """
+    Returns what to read the forms and tables of an unencrypted session from: a DerivedSession when its tables and
+    manifest are derived, otherwise the ParsedSession. Missing artifacts are queued to be derived in the background
+    rather than derived on the spot, so the reader does not wait for every table to be written as Parquet.
+    """
+    session = ParsedSession(curtain)
+    digest = curtain.get_data_hash()
+    if digest is None or curtain.encrypted or not derivations_enabled():
+        return session
+    stages = ("tables", "manifest")
+    if SessionDerivation.objects.filter(hash=digest, stage__in=stages, status="done").count() < len(stages):
+        queue_derivations(curtain, digest)
+        return session
+    manifest = load_manifest(digest)
+    if manifest is None:
+        return session
+    return DerivedSession(digest, manifest)
+
+
+def prune_derivations():
+    """
+    Deletes the artifacts and states of content hashes no curtain uses anymore. Returns the number of hashes pruned.
+    """
+    orphaned = set(SessionDerivation.objects.exclude(hash__in=DataHash.objects.values("hash"))
+                   .values_list("hash", flat=True))
+    return SessionDerivation.discard(orphaned)
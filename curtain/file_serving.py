@@ -0,0 +1,379 @@
+import json
+import os
+import uuid
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags, quote_etag, http_date, parse_http_date_safe, content_disposition_header
+
+from curtain.compressed_storage import open_stored_file
+from curtain.compression import accepts_encoding, select_variant, stored_encoding, strip_stored_suffix, VARIANT_SUFFIXES
+from curtain.session_index import get_session_index
+
+RANGE_BLOCK_SIZE = 64 * 1024
+
+# Requests asking for more ranges than this get the whole file instead
+MAX_RANGES = 16
+
+# How long the decompressed size of a file stored compressed is remembered for range requests
+DECOMPRESSED_SIZE_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def get_accel_redirect_path(path):
+    """
+    Returns the internal nginx location for a file under MEDIA_ROOT, or None when X-Accel-Redirect
+    is not configured or the file lives outside the media root.
+    """
+    prefix = settings.CURTAIN_DOWNLOAD_ACCEL_REDIRECT_PREFIX
+    if not prefix:
+        return None
+    relative_path = os.path.relpath(path, settings.MEDIA_ROOT)
+    if relative_path.startswith(".."):
+        return None
+    return prefix.rstrip("/") + "/" + quote(relative_path.replace(os.sep, "/"))
+
+
+def make_etag(content_hash, encoding=None):
+    """
+    Builds a strong ETag from a content hash. Each content-coding gets its own suffix since the encoded bytes differ.
+    """
+    return quote_etag(f"{content_hash}-{encoding}" if encoding else content_hash)
+
+
+def get_matching_etag(request, content_hash):
+    """
+    Returns the If-None-Match entry that refers to any representation of content_hash, or None.
+    Uses the weak comparison required for If-None-Match, so ETags weakened by GZipMiddleware still match.
+    """
+    header = request.META.get("HTTP_IF_NONE_MATCH")
+    if not header:
+        return None
+    for etag in parse_etags(header):
+        if etag == "*":
+            return make_etag(content_hash)
+        value = etag[2:] if etag.startswith("W/") else etag
+        base, _, encoding = value.strip('"').partition("-")
+        if base == content_hash and (not encoding or encoding in VARIANT_SUFFIXES):
+            return etag
+    return None
+
+
+def if_match_satisfied(request, content_hash):
+    """
+    Evaluates If-Match with the strong comparison, so an update only applies to the version the client last saw.
+    A missing header is satisfied.
+    """
+    header = request.META.get("HTTP_IF_MATCH")
+    if not header:
+        return True
+    for etag in parse_etags(header):
+        if etag == "*" or (content_hash and etag == make_etag(content_hash)):
+            return True
+    return False
+
+
+def get_not_modified_response(request, content_hash):
+    """
+    Returns a 304 response when the client already holds the content identified by content_hash.
+    Only the request headers are inspected, so this is safe to call before touching the file.
+    """
+    if not content_hash or request.method not in ("GET", "HEAD"):
+        return None
+    etag = get_matching_etag(request, content_hash)
+    if etag is None:
+        return None
+    response = HttpResponseNotModified()
+    response["ETag"] = etag
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
+def parse_range_header(header, size):
+    """
+    Parses a Range header into a list of inclusive (start, end) byte offsets within a file of the given size.
+    Returns None when the header is malformed or asks for too many ranges, in which case the whole file is served,
+    and an empty list when none of the ranges can be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or not spec.strip():
+        return None
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, separator, last = part.partition("-")
+        first, last = first.strip(), last.strip()
+        if not separator:
+            return None
+        if not first:
+            if not last.isdigit():
+                return None
+            suffix_length = int(last)
+            if suffix_length > 0 and size > 0:
+                ranges.append((max(size - suffix_length, 0), size - 1))
+            continue
+        if not first.isdigit() or (last and not last.isdigit()):
+            return None
+        start = int(first)
+        if last and int(last) < start:
+            return None
+        if start < size:
+            ranges.append((start, min(int(last), size - 1) if last else size - 1))
+    if len(ranges) > MAX_RANGES:
+        return None
+    return ranges
+
+
+def if_range_matches(request, content_hash, mtime):
+    """
+    Evaluates If-Range. Entity tags use the strong comparison and dates must equal Last-Modified exactly,
+    as a range of a changed file would be spliced onto stale bytes. Without an mtime dates never match.
+    """
+    header = request.META.get("HTTP_IF_RANGE", "").strip()
+    if not header:
+        return True
+    if header.startswith('"') or header.startswith("W/"):
+        return bool(content_hash) and header == make_etag(content_hash)
+    return mtime is not None and parse_http_date_safe(header) == int(mtime)
+
+
+def _iter_file_range(f, start, end):
+    f.seek(start)
+    remaining = end - start + 1
+    while remaining > 0:
+        data = f.read(min(RANGE_BLOCK_SIZE, remaining))
+        if not data:
+            break
+        remaining -= len(data)
+        yield data
+
+
+def _iter_ranges(open_file, ranges, size, content_type, boundary):
+    f = open_file()
+    try:
+        if boundary is None:
+            start, end = ranges[0]
+            yield from _iter_file_range(f, start, end)
+            return
+        for start, end in ranges:
+            yield _multipart_part_header(boundary, content_type, start, end, size)
+            if start < f.tell():
+                # decompressed streams only seek forward, so earlier ranges are read from a fresh stream
+                f.close()
+                f = open_file()
+            yield from _iter_file_range(f, start, end)
+            yield b"\r\n"
+        yield f"--{boundary}--\r\n".encode("ascii")
+    finally:
+        f.close()
+
+
+def _multipart_part_header(boundary, content_type, start, end, size):
+    return (
+        f"--{boundary}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n"
+    ).encode("ascii")
+
+
+def build_range_response(open_file, ranges, size, content_type, filename):
+    """
+    Builds a 206 response that seeks into the file returned by open_file for each requested range instead of
+    reading it whole. A single range is sent as-is, several ranges as multipart/byteranges. No satisfiable range
+    gives a 416.
+    """
+    if not ranges:
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    if len(ranges) == 1:
+        start, end = ranges[0]
+        response = StreamingHttpResponse(
+            _iter_ranges(open_file, ranges, size, content_type, None), status=206, content_type=content_type
+        )
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+        response["Content-Length"] = str(end - start + 1)
+    else:
+        boundary = uuid.uuid4().hex
+        content_length = len(f"--{boundary}--\r\n")
+        for start, end in ranges:
+            content_length += len(_multipart_part_header(boundary, content_type, start, end, size))
+            content_length += end - start + 1 + 2
+        response = StreamingHttpResponse(
+            _iter_ranges(open_file, ranges, size, content_type, boundary),
+            status=206,
+            content_type=f"multipart/byteranges; boundary={boundary}"
+        )
+        response["Content-Length"] = str(content_length)
+    response["Content-Disposition"] = content_disposition_header(False, filename)
+    return response
+
+
+def serve_stored_file(request, field_file, content_type="application/json", filename=None, content_hash=None):
+    """
+    Serves a file from local storage as-is, without parsing or re-serializing it.
+    When CURTAIN_DOWNLOAD_ACCEL_REDIRECT_PREFIX is set the transfer is handed off to nginx (which picks
+    precompressed siblings itself with gzip_static/brotli_static), otherwise the best precompressed
+    sibling allowed by Accept-Encoding is streamed, falling back to the original file.
+    When content_hash is given it is sent as the ETag and a matching If-None-Match gets a 304 without any file I/O.
+    Range requests (subject to If-Range) are answered with 206 from the uncompressed file.
+    Raises FileNotFoundError if the file is missing from storage.
+    """
+    not_modified = get_not_modified_response(request, content_hash)
+    if not_modified:
+        return not_modified
+
+    if stored_encoding(field_file.name):
+        return serve_compressed_file(request, field_file, content_type, filename, content_hash)
+
+    path = field_file.path
+    file_stat = os.stat(path)
+    filename = filename or os.path.basename(path)
+
+    accel_path = get_accel_redirect_path(path)
+    if accel_path:
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = accel_path
+        response["Content-Disposition"] = f'inline; filename="{filename}"'
+        if content_hash:
+            response["ETag"] = make_etag(content_hash)
+        return response
+
+    range_header = request.META.get("HTTP_RANGE") if request.method == "GET" else None
+    if range_header and if_range_matches(request, content_hash, file_stat.st_mtime):
+        ranges = parse_range_header(range_header, file_stat.st_size)
+        if ranges is not None:
+            response = build_range_response(lambda: open(path, "rb"), ranges, file_stat.st_size, content_type, filename)
+            _set_validators(response, content_hash, None, file_stat.st_mtime)
+            return response
+
+    encoding, serve_path = select_variant(path, request.META.get("HTTP_ACCEPT_ENCODING", ""))
+    response = FileResponse(open(serve_path, "rb"), content_type=content_type, filename=filename)
+    if encoding:
+        response["Content-Encoding"] = encoding
+    else:
+        # byte ranges always refer to the uncompressed file
+        response["Accept-Ranges"] = "bytes"
+    _set_validators(response, content_hash, encoding, file_stat.st_mtime)
+    return response
+
+
+def _iter_blocks(f):
+    with f:
+        while block := f.read(RANGE_BLOCK_SIZE):
+            yield block
+
+
+def get_decompressed_size(field_file, content_hash=None):
+    """
+    Returns the size of the content of a file stored compressed, which takes one pass over the decompressed stream.
+    The result is cached per stored name and content hash.
+    """
+    key = f"curtain:decompressed_size:{content_hash or ''}:{field_file.name}"
+    size = cache.get(key)
+    if size is None:
+        size = 0
+        with field_file.storage.open(field_file.name, "rb") as f:
+            while block := f.read(RANGE_BLOCK_SIZE):
+                size += len(block)
+        cache.set(key, size, DECOMPRESSED_SIZE_CACHE_TIMEOUT)
+    return size
+
+
+def serve_compressed_file(request, field_file, content_type="application/json", filename=None, content_hash=None):
+    """
+    Serves a file stored compressed (see curtain.compressed_storage). Clients accepting its codec get the stored
+    bytes as they are with a matching Content-Encoding, others get the content decompressed as a stream.
+    Works on any storage backend. As for plain files, range requests (subject to an If-Range ETag) are answered
+    with 206 from the decompressed content, whose size is found with get_decompressed_size.
+    """
+    encoding = stored_encoding(field_file.name)
+    filename = filename or os.path.basename(strip_stored_suffix(field_file.name))
+
+    def open_decompressed_file():
+        return field_file.storage.open(field_file.name, "rb")
+
+    range_header = request.META.get("HTTP_RANGE") if request.method == "GET" else None
+    if range_header and if_range_matches(request, content_hash, None):
+        size = get_decompressed_size(field_file, content_hash)
+        ranges = parse_range_header(range_header, size)
+        if ranges is not None:
+            response = build_range_response(open_decompressed_file, ranges, size, content_type, filename)
+            if content_hash:
+                response["ETag"] = make_etag(content_hash)
+            patch_vary_headers(response, ("Accept-Encoding",))
+            return response
+
+    if accepts_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""), encoding):
+        response = FileResponse(open_stored_file(field_file), content_type=content_type, filename=filename)
+        response["Content-Encoding"] = encoding
+    else:
+        response = StreamingHttpResponse(_iter_blocks(open_decompressed_file()), content_type=content_type)
+        response["Content-Disposition"] = content_disposition_header(False, filename)
+        # byte ranges always refer to the decompressed content
+        response["Accept-Ranges"] = "bytes"
+        encoding = None
+    if content_hash:
+        response["ETag"] = make_etag(content_hash, encoding)
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
+
+
+def _set_validators(response, content_hash, encoding, mtime):
+    if content_hash:
+        response["ETag"] = make_etag(content_hash, encoding)
+    response["Last-Modified"] = http_date(mtime)
+    patch_vary_headers(response, ("Accept-Encoding",))
+
+
+def serve_session_file(request, field_file, content_hash=None):
+    """
+    Serves a stored curtain session file as JSON.
+    """
+    return serve_stored_file(request, field_file, content_type="application/json", content_hash=content_hash)
+
+
+def _iter_projected_fields(path, spans, fields):
+    yield b"{"
+    with open(path, "rb") as f:
+        separator = b""
+        for field in fields:
+            start, end = spans[field]
+            yield separator + json.dumps(field).encode("utf-8") + b":"
+            if end > start:
+                yield from _iter_file_range(f, start, end - 1)
+            separator = b","
+    yield b"}"
+
+
+def serve_session_fields(request, field_file, fields):
+    """
+    Serves a JSON object holding only the requested top-level keys of a stored session file.
+    The byte span of each key comes from the sidecar index (built on the spot if missing), so only those
+    spans are read. Requested keys that are not in the session are left out.
+    Raises FileNotFoundError if the file is missing and ValueError if it is not a JSON object.
+    """
+    if stored_encoding(field_file.name):
+        # the index refers to offsets in the plain file, so compressed sessions are parsed whole
+        with field_file.storage.open(field_file.name, "rb") as f:
+            session = json.load(f)
+        if not isinstance(session, dict):
+            raise ValueError("Session file is not a JSON object")
+        projected = {field: session[field] for field in dict.fromkeys(fields) if field in session}
+        response = HttpResponse(json.dumps(projected), content_type="application/json")
+        patch_vary_headers(response, ("Accept-Encoding",))
+        return response
+    path = field_file.path
+    index = get_session_index(path)
+    if index is None:
+        raise ValueError("Session file is not a JSON object")
+    spans = index["keys"]
+    fields = [field for field in dict.fromkeys(fields) if field in spans]
+    response = StreamingHttpResponse(_iter_projected_fields(path, spans, fields), content_type="application/json")
+    patch_vary_headers(response, ("Accept-Encoding",))
+    return response
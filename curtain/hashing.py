@@ -0,0 +1,162 @@
+import hashlib
+import os
+import socket
+import threading
+from collections import OrderedDict
+
+from django.core.files.base import File
+
+DATA_HASH_ALGORITHM = "sha256"
+HASH_BLOCK_SIZE = 1024 * 1024
+MAX_STREAM_DIGESTS = 1024
+
+
+class HashingFile(File):
+    """
+    Wraps a file so its content hash is computed while the storage backend reads it for writing.
+    Seeking back to the start resets the digest, so backends that read the content more than once still end up
+    with the hash of a single full pass. Any other seek invalidates the digest and complete becomes False.
+    """
+
+    def __init__(self, file, name=None, algorithm=DATA_HASH_ALGORITHM):
+        super().__init__(file, name)
+        self.algorithm = algorithm
+        self._reset()
+
+    def _reset(self):
+        self._hasher = hashlib.new(self.algorithm)
+        self._hashed_size = 0
+
+    def read(self, *args, **kwargs):
+        data = self.file.read(*args, **kwargs)
+        if self._hasher is not None:
+            self._hasher.update(data.encode("utf-8") if isinstance(data, str) else data)
+            self._hashed_size += len(data)
+        return data
+
+    def seek(self, offset, whence=0):
+        result = self.file.seek(offset, whence)
+        if offset == 0 and whence == 0:
+            self._reset()
+        elif self._hasher is not None and self.file.tell() != self._hashed_size:
+            self._hasher = None
+        return result
+
+    @property
+    def complete(self):
+        """
+        True when every byte of the file went through the hasher exactly once.
+        """
+        return self._hasher is not None and self._hashed_size == self.size
+
+    def hexdigest(self):
+        return self._hasher.hexdigest() if self._hasher is not None else None
+
+
+def hash_stored_file(field_file, algorithm=DATA_HASH_ALGORITHM):
+    """
+    Computes the content hash of a file already in storage by reading it in blocks.
+    """
+    hasher = hashlib.new(algorithm)
+    with field_file.storage.open(field_file.name, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def hash_content(content, algorithm=DATA_HASH_ALGORITHM):
+    """
+    Computes the hash of a file-like object from its start and rewinds it so it can still be saved.
+    """
+    hasher = hashlib.new(algorithm)
+    content.seek(0)
+    while block := content.read(HASH_BLOCK_SIZE):
+        hasher.update(block.encode("utf-8") if isinstance(block, str) else block)
+    content.seek(0)
+    return hasher.hexdigest()
+
+
+def save_hashed_file(field_file, name, content, save=True):
+    """
+    Saves content to a FileField and returns the hash of what was written.
+    Falls back to re-reading the stored file when the backend did not read the content in a single pass.
+    """
+    hashing_file = HashingFile(content)
+    field_file.save(name, hashing_file, save=save)
+    if hashing_file.complete:
+        return hashing_file.hexdigest()
+    return hash_stored_file(field_file)
+
+
+class StreamDigest:
+    """
+    Digests of a byte stream that is written in order over several requests. hashlib state cannot be stored
+    outside the process, so it is kept in process memory and offset records how far the stream has been hashed.
+    Callers pick one process to own the digest of a stream (see process_token) so that bytes written by other
+    processes are read back once by the owner instead of once by every process that sees a chunk.
+    """
+
+    def __init__(self, algorithms, observer_factory=None):
+        self.algorithms = tuple(algorithms)
+        self.observer_factory = observer_factory
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.hashers = {algorithm: hashlib.new(algorithm) for algorithm in self.algorithms}
+        # anything else that wants to see the stream once, in order, e.g. a validator
+        self.observer = self.observer_factory() if self.observer_factory is not None else None
+        self.offset = 0
+
+    def update(self, data):
+        for hasher in self.hashers.values():
+            hasher.update(data)
+        if self.observer is not None:
+            self.observer.update(data)
+        self.offset += len(data)
+
+    def catch_up(self, f, end=None):
+        """
+        Hashes the bytes of f from offset up to end (or the end of the file) that have not been hashed yet.
+        """
+        f.seek(self.offset)
+        while end is None or self.offset < end:
+            size = HASH_BLOCK_SIZE if end is None else min(HASH_BLOCK_SIZE, end - self.offset)
+            block = f.read(size)
+            if not block:
+                break
+            self.update(block)
+
+    def hexdigests(self):
+        return {algorithm: hasher.hexdigest() for algorithm, hasher in self.hashers.items()}
+
+
+def process_token():
+    """
+    Identifies the current worker process, e.g. to record which process keeps the digest of a stream.
+    """
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+_stream_digests = OrderedDict()
+_stream_digests_lock = threading.Lock()
+
+
+def get_stream_digest(key, algorithms, observer_factory=None):
+    """
+    Returns the digest of the stream identified by key, creating it if this process has not seen the stream yet.
+    Only the most recently used MAX_STREAM_DIGESTS streams are kept.
+    """
+    with _stream_digests_lock:
+        digest = _stream_digests.get(key)
+        if digest is None or digest.algorithms != tuple(algorithms) or digest.observer_factory != observer_factory:
+            digest = _stream_digests[key] = StreamDigest(algorithms, observer_factory)
+        _stream_digests.move_to_end(key)
+        while len(_stream_digests) > MAX_STREAM_DIGESTS:
+            _stream_digests.popitem(last=False)
+        return digest
+
+
+def discard_stream_digest(key):
+    with _stream_digests_lock:
+        _stream_digests.pop(key, None)
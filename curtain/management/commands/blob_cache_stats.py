@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand
+
+from curtain.blob_cache import get_stats, reset_stats
+
+
+class Command(BaseCommand):
+    help = 'Show the hit/miss/eviction counters of the session blob cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reset',
+            action='store_true',
+            help='Reset the counters after showing them',
+        )
+
+    def handle(self, *args, **options):
+        stats = get_stats()
+        for name in sorted(stats):
+            self.stdout.write(f'{name}: {stats[name]}')
+        for tier in ('memory', 'disk'):
+            hits = stats.get(f'{tier}_hit', 0)
+            lookups = hits + stats.get(f'{tier}_miss', 0)
+            if lookups:
+                self.stdout.write(f'{tier} hit rate: {hits / lookups:.1%}')
+        if options['reset']:
+            reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
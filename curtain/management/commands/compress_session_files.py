@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand
+
+from curtain.models import Curtain, DataCite
+from curtain.storage import is_local_storage
+from curtain.worker_tasks import compress_curtain_file, compress_datacite_file, index_curtain_file
+
+
+class Command(BaseCommand):
+    help = 'Write precompressed (gzip/brotli/zstd) siblings, content hashes and key indexes of stored session and DataCite files'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Regenerate variants even if they are up to date',
+        )
+        parser.add_argument(
+            '--queue',
+            action='store_true',
+            help='Queue a background job per file instead of compressing in this process',
+        )
+
+    def handle(self, *args, **options):
+        processed = 0
+        if is_local_storage():
+            for curtain_id, encrypted in Curtain.objects.exclude(file="").values_list("id", "encrypted").iterator():
+                self._process(compress_curtain_file, curtain_id, options)
+                if not encrypted:
+                    self._index(curtain_id, options)
+                processed += 1
+        else:
+            self.stdout.write('Session files are not on local storage, skipping curtains')
+
+        for datacite_id in DataCite.objects.exclude(local_file="").exclude(local_file__isnull=True).values_list("id", flat=True).iterator():
+            self._process(compress_datacite_file, datacite_id, options)
+            processed += 1
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} files'))
+
+    def _process(self, task, object_id, options):
+        if options['queue']:
+            task.delay(object_id, options['force'])
+            return
+        written = task(object_id, options['force'])
+        if written:
+            self.stdout.write(f'{task.__name__}({object_id}): {", ".join(written)}')
+
+    def _index(self, curtain_id, options):
+        if options['queue']:
+            index_curtain_file.delay(curtain_id)
+        else:
+            index_curtain_file(curtain_id)
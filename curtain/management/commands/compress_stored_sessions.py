@@ -0,0 +1,75 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models
+
+from curtain.compressed_storage import at_rest_encoding
+from curtain.compression import STORED_ENCODINGS, VARIANT_SUFFIXES
+from curtain.models import Curtain, SessionBlob
+from curtain.worker_tasks import compress_stored_session
+
+
+class Command(BaseCommand):
+    help = ('Compress stored session files with CURTAIN_AT_REST_COMPRESSION. '
+            'Each file is switched over as soon as it is compressed, so an interrupted run resumes where it stopped')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=4, help='Files compressed in parallel')
+        parser.add_argument('--dry-run', action='store_true', help='List the files that would be compressed')
+
+    def handle(self, *args, **options):
+        if at_rest_encoding() is None:
+            raise CommandError('CURTAIN_AT_REST_COMPRESSION is not set')
+        names = self._pending_names()
+        self.stdout.write(f'{len(names)} session files to compress')
+        if options['dry_run']:
+            for name in names:
+                self.stdout.write(name)
+            return
+
+        compressed = 0
+        stored_size = 0
+        compressed_size = 0
+        if options['workers'] > 1:
+            with ThreadPoolExecutor(max_workers=options['workers']) as executor:
+                results = list(executor.map(self._compress_in_thread, names))
+        else:
+            results = map(self._try_compress, names)
+        for name, result in zip(names, results):
+            if result is None:
+                self.stdout.write(f'{name}: skipped')
+                continue
+            new_name, size, new_size = result
+            compressed += 1
+            stored_size += size
+            compressed_size += new_size
+            self.stdout.write(f'{name} -> {new_name}: {size} -> {new_size} bytes')
+        self.stdout.write(self.style.SUCCESS(
+            f'Compressed {compressed} files from {stored_size} to {compressed_size} bytes'))
+
+    def _pending_names(self):
+        """
+        Distinct names of plain session files used by unencrypted curtains or by blobs. Encrypted content does not
+        compress, so it is left alone.
+        """
+        compressed = models.Q()
+        for encoding in STORED_ENCODINGS:
+            compressed |= models.Q(file__endswith=VARIANT_SUFFIXES[encoding])
+        names = set(Curtain.objects.exclude(file="").filter(encrypted=False).exclude(compressed)
+                    .values_list("file", flat=True))
+        names.update(SessionBlob.objects.exclude(compressed).values_list("file", flat=True))
+        return sorted(names)
+
+    def _compress_in_thread(self, name):
+        try:
+            return self._try_compress(name)
+        finally:
+            # each worker thread has its own database connection
+            connection.close()
+
+    def _try_compress(self, name):
+        try:
+            return compress_stored_session(name)
+        except Exception as e:
+            self.stderr.write(f'{name}: {str(e)}')
+            return None
@@ -1,12 +1,9 @@
 from django.core.management.base import BaseCommand
-from django.utils import timezone
-from datetime import timedelta
-from curtain.models import Curtain, LastAccess
-from django.db.models import Max
+from curtain.models import Curtain
 
 
 class Command(BaseCommand):
-    help = 'Delete curtains with last access older than 90 days'
+    help = 'Delete non-permanent curtains with last access older than 90 days'
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -16,20 +13,13 @@ class Command(BaseCommand):
         )
 
     def handle(self, *args, **options):
-        # Get the date 90 days ago
-        ninety_days_ago = timezone.now() - timedelta(days=90)
-
-        # Get the latest LastAccess for each Curtain
-        latest_last_accesses = LastAccess.objects.values('curtain').annotate(max_last_access=Max('last_access')).filter(
-            max_last_access__lte=ninety_days_ago)
-
-        # Get the curtains to delete that is older than 90 days
-        curtains_to_delete = Curtain.objects.filter(last_access__in=latest_last_accesses)
+        # Get the curtains last accessed more than 90 days ago, curtains never accessed are kept
+        curtains_to_delete = Curtain.objects.expired()
 
         if options['dry_run']:
             self.stdout.write('Dry run mode enabled. The following curtains would be deleted:')
             for curtain in curtains_to_delete:
-                self.stdout.write(f'Curtain ID: {curtain.id}, Last Access: {curtain.last_access}')
+                self.stdout.write(f'Curtain ID: {curtain.id}, Last Access: {curtain.last_accessed_at}')
         else:
             # Delete these curtains
             curtains_to_delete.delete()
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand
+
+from curtain.derivations import DerivationError, STAGES, prune_derivations, run_derivations
+from curtain.models import Curtain, SessionDerivation
+from curtain.worker_tasks import derive_session_artifacts
+
+
+class Command(BaseCommand):
+    help = 'Derive the Parquet tables, manifest and protein id list of stored sessions that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--queue',
+            action='store_true',
+            help='Queue a background job per session instead of deriving in this process',
+        )
+        parser.add_argument(
+            '--retry-failed',
+            action='store_true',
+            help='Give stages that used up their attempts another chance',
+        )
+        parser.add_argument(
+            '--prune',
+            action='store_true',
+            help='Delete the artifacts of content no curtain uses anymore',
+        )
+        parser.add_argument('--stage', action='append', choices=list(STAGES), help='Only run these stages')
+
+    def handle(self, *args, **options):
+        if options['prune']:
+            pruned = prune_derivations()
+            self.stdout.write(self.style.SUCCESS(f'Pruned the artifacts of {pruned} content hashes'))
+            return
+        if options['retry_failed']:
+            reset = SessionDerivation.objects.filter(status="failed").update(attempts=0)
+            self.stdout.write(f'Reset {reset} failed stages')
+
+        processed = 0
+        failed = 0
+        for curtain in Curtain.objects.exclude(file="").filter(encrypted=False).iterator():
+            if options['queue']:
+                derive_session_artifacts.delay(curtain.id, options['stage'])
+            else:
+                try:
+                    run_derivations(curtain, options['stage'])
+                except (DerivationError, OSError) as e:
+                    self.stderr.write(f'{curtain.link_id}: {str(e)}')
+                    failed += 1
+            processed += 1
+        self.stdout.write(self.style.SUCCESS(f'Processed {processed} sessions, {failed} failed'))
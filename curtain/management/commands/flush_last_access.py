@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from curtain.worker_tasks import flush_last_access
+
+
+class Command(BaseCommand):
+    help = 'Write the session access events buffered in Redis to LastAccess'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--queue',
+            action='store_true',
+            help='Queue the flush on the RQ workers instead of running it in this process',
+        )
+
+    def handle(self, *args, **options):
+        if options['queue']:
+            flush_last_access.delay()
+            self.stdout.write(self.style.SUCCESS('Queued last access flush'))
+            return
+        updated = flush_last_access()
+        self.stdout.write(self.style.SUCCESS(f'Updated last access of {updated} curtains'))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from curtain.chunk_staging import reap_staged_chunks
+from curtain.worker_tasks import reap_staged_chunks as reap_staged_chunks_job
+
+
+class Command(BaseCommand):
+    help = ('Remove staged upload chunks not written to for CURTAIN_CHUNK_STAGING_MAX_AGE seconds, then the oldest '
+            'ones until the staging is within CURTAIN_CHUNK_STAGING_MAX_BYTES')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--queue',
+            action='store_true',
+            help='Queue the reaper on the RQ workers instead of running it in this process',
+        )
+        parser.add_argument('--max-age', type=int, help='Override CURTAIN_CHUNK_STAGING_MAX_AGE, in seconds')
+        parser.add_argument('--max-bytes', type=int, help='Override CURTAIN_CHUNK_STAGING_MAX_BYTES')
+
+    def handle(self, *args, **options):
+        if options['queue']:
+            reap_staged_chunks_job.delay()
+            self.stdout.write(self.style.SUCCESS('Queued staged chunk reaper'))
+            return
+        removed, freed = reap_staged_chunks(max_age=options['max_age'], max_bytes=options['max_bytes'])
+        self.stdout.write(self.style.SUCCESS(f'Removed {removed} staged items, freeing {freed} bytes'))
@@ -0,0 +1,56 @@
+import json
+from datetime import datetime, timezone
+
+from django.core.management.base import BaseCommand
+
+from curtain.benchmarks import BENCHMARKS, DEFAULT_CHUNK_SIZE, SessionBenchmark, benchmark_environment, environment_info
+
+
+class Command(BaseCommand):
+    help = ('Benchmark session create, download, chunked upload and compare on synthetic sessions. '
+            'Runs against a throwaway database and local storage and prints the timings as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10000], help='Proteins per session')
+        parser.add_argument('--samples', type=int, nargs='+', default=[6], help='Samples per session')
+        parser.add_argument('--comparisons', type=int, default=1, help='Comparisons in the differential table')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per benchmark')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic session generator')
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE, help='Chunk size of the chunked upload in bytes')
+        parser.add_argument('--compare-sessions', type=int, default=2, help='Sessions compared by compare_session')
+        parser.add_argument('--study-size', type=int, default=100, help='Primary IDs searched by compare_session')
+        parser.add_argument('--benchmark', choices=BENCHMARKS, nargs='+', default=list(BENCHMARKS),
+                            help='Benchmarks to run')
+        parser.add_argument('--output', type=str, help='Write the results to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        results = []
+        with benchmark_environment():
+            environment = environment_info()
+            for rows in options['rows']:
+                for samples in options['samples']:
+                    self.stderr.write(f'Benchmarking {rows} rows x {samples} samples')
+                    benchmark = SessionBenchmark(
+                        rows, samples,
+                        comparisons=options['comparisons'],
+                        seed=options['seed'],
+                        repeat=options['repeat'],
+                        chunk_size=options['chunk_size'],
+                        compare_sessions=options['compare_sessions'],
+                        study_size=options['study_size'],
+                    )
+                    results.extend(benchmark.run(options['benchmark']))
+
+        report = json.dumps({
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "environment": environment,
+            "parameters": {key: options[key] for key in (
+                'rows', 'samples', 'comparisons', 'repeat', 'seed', 'chunk_size', 'compare_sessions', 'study_size')},
+            "results": results,
+        }, indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+            self.stderr.write(self.style.SUCCESS(f'Wrote {len(results)} results to {options["output"]}'))
+        else:
+            self.stdout.write(report)
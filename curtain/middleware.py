@@ -0,0 +1,16 @@
+from django.middleware.gzip import GZipMiddleware
+
+
+class RangeAwareGZipMiddleware(GZipMiddleware):
+    """
+    GZipMiddleware that leaves partial content alone. Byte ranges are computed on the uncompressed file,
+    so compressing a 206 body would corrupt it, and a response compressed on the fly no longer supports ranges.
+    """
+
+    def process_response(self, request, response):
+        if response.status_code == 206 or response.has_header("Content-Range"):
+            return response
+        response = super().process_response(request, response)
+        if response.get("Content-Encoding") == "gzip" and response.has_header("Accept-Ranges"):
+            del response["Accept-Ranges"]
+        return response
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('curtain', '0021_add_name_field_to_curtain'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='datacite',
+            name='local_file_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+    ]
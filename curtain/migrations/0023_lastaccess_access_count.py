@@ -0,0 +1,24 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:05
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('curtain', '0022_datacite_local_file_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='lastaccess',
+            name='access_count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AlterField(
+            model_name='lastaccess',
+            name='last_access',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('curtain', '0023_lastaccess_access_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='curtain',
+            name='duration_expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='curtain',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='curtain',
+            name='last_accessed_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.db import migrations, models
+from django.db.models import ExpressionWrapper, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def backfill_expires_at(apps, schema_editor):
+    Curtain = apps.get_model('curtain', 'Curtain')
+    LastAccess = apps.get_model('curtain', 'LastAccess')
+
+    latest_last_access = LastAccess.objects.filter(
+        curtain=OuterRef('pk')
+    ).order_by('-last_access').values('last_access')[:1]
+    Curtain.objects.update(last_accessed_at=Subquery(latest_last_access))
+    # expires_at ends the 90 day access window and stays null for curtains never accessed
+    Curtain.objects.update(expires_at=ExpressionWrapper(
+        F('last_accessed_at') + timedelta(days=90),
+        output_field=models.DateTimeField()
+    ))
+    Curtain.objects.update(duration_expires_at=ExpressionWrapper(
+        Coalesce(F('last_accessed_at'), F('created')) + F('expiry_duration'),
+        output_field=models.DateTimeField()
+    ))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('curtain', '0024_curtain_last_accessed_at_expires_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_expires_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('curtain', '0025_backfill_curtain_expires_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='curtainchunkedupload',
+            name='multipart_offset',
+            field=models.BigIntegerField(default=0, help_text='Number of bytes already sent to the multipart upload'),
+        ),
+        migrations.AddField(
+            model_name='curtainchunkedupload',
+            name='multipart_parts',
+            field=models.JSONField(blank=True, default=list, help_text='Parts already sent to the multipart upload'),
+        ),
+        migrations.AddField(
+            model_name='curtainchunkedupload',
+            name='multipart_upload_id',
+            field=models.TextField(blank=True, help_text='Upload ID (S3) or session URI (GCS) of the multipart upload the chunks are streamed to', null=True),
+        ),
+    ]
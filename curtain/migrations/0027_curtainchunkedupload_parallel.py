@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('curtain', '0026_curtainchunkedupload_multipart'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='curtainchunkedupload',
+            name='chunk_size',
+            field=models.PositiveIntegerField(blank=True, help_text='Fixed chunk size of a parallel upload, whose chunks may arrive in any order', null=True),
+        ),
+        migrations.AddField(
+            model_name='curtainchunkedupload',
+            name='received_chunks',
+            field=models.BinaryField(blank=True, help_text='Bitmap of the chunks of a parallel upload that have been written', null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('curtain', '0027_curtainchunkedupload_parallel'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(upload_to='media/files/blobs/')),
+                ('size', models.BigIntegerField(default=0)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
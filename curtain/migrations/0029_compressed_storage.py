@@ -0,0 +1,24 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:31
+
+import curtain.compressed_storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('curtain', '0028_sessionblob'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='curtain',
+            name='file',
+            field=models.FileField(storage=curtain.compressed_storage.CompressedStorage(), upload_to='media/files/curtain_upload/'),
+        ),
+        migrations.AlterField(
+            model_name='sessionblob',
+            name='file',
+            field=models.FileField(storage=curtain.compressed_storage.CompressedStorage(), upload_to='media/files/blobs/'),
+        ),
+    ]
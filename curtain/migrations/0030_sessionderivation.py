@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-17 02:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('curtain', '0029_compressed_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SessionDerivation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('hash', models.CharField(max_length=64)),
+                ('stage', models.CharField(max_length=20)),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, default='')),
+                ('artifacts', models.JSONField(blank=True, default=list)),
+            ],
+            options={
+                'unique_together': {('hash', 'stage')},
+            },
+        ),
+    ]
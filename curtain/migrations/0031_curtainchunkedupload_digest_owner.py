@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-17 03:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('curtain', '0030_sessionderivation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='curtainchunkedupload',
+            name='digest_owner',
+            field=models.CharField(blank=True, help_text='Worker process that keeps the incremental digest of the upload', max_length=255, null=True),
+        ),
+    ]
@@ -1,15 +1,23 @@
 import uuid
 from datetime import timedelta
 
+from django.core.files.storage import default_storage
 from django.core.mail import send_mail
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.utils import timezone
 from rest_framework_api_key.crypto import KeyGenerator
 
 from curtainbe import settings
 from rest_framework_api_key.models import AbstractAPIKey, BaseAPIKeyManager
-from curtain.storage import DataCiteLocalStorage
+from curtain.compressed_storage import CompressedStorage
+from curtain.compression import remove_compressed_variants, strip_stored_suffix
+from curtain.hashing import hash_content, save_hashed_file, hash_stored_file
+from curtain.session_index import remove_session_index
+from curtain.signed_urls import invalidate_signed_url
+from curtain.storage import DataCiteLocalStorage, is_content_addressed_storage, is_local_storage
 
 
 def get_default_expiry_duration():
@@ -63,6 +71,35 @@ class UserPublicKey(models.Model):
     public_key = models.BinaryField()
 
 
+# A non-permanent curtain is no longer served this long after its last access. Curtains never accessed stay served.
+ACCESS_EXPIRY_WINDOW = timedelta(days=90)
+
+
+class CurtainQuerySet(models.QuerySet):
+
+    def unexpired(self):
+        """
+        Curtains that are served: permanent ones, ones never accessed and ones whose expires_at is still in the future.
+        """
+        return self.filter(
+            models.Q(permanent=True) | models.Q(expires_at__isnull=True) | models.Q(expires_at__gte=timezone.now()))
+
+    def expired(self):
+        return self.filter(permanent=False, expires_at__lt=timezone.now())
+
+    def duration_unexpired(self):
+        """
+        Non-permanent curtains that is_expired reports as not expired, i.e. whose duration_expires_at is still ahead.
+        """
+        return self.filter(permanent=False, duration_expires_at__gte=timezone.now())
+
+    def duration_expired(self):
+        """
+        Non-permanent curtains that is_expired reports as expired.
+        """
+        return self.filter(permanent=False, duration_expires_at__lt=timezone.now())
+
+
 class Curtain(models.Model):
     """
     This model represents a Curtain, which includes fields for creation and update timestamps, a unique link ID,
@@ -71,7 +108,7 @@ class Curtain(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
     link_id = models.TextField(unique=True, default=uuid.uuid4, null=False)
-    file = models.FileField(upload_to="media/files/curtain_upload/")
+    file = models.FileField(upload_to="media/files/curtain_upload/", storage=CompressedStorage())
     name = models.TextField(blank=True, default="")
     description = models.TextField()
     owners = models.ManyToManyField(User, related_name="curtain")
@@ -90,6 +127,11 @@ class Curtain(models.Model):
     permanent = models.BooleanField(default=True)
     encrypted = models.BooleanField(default=False)
     expiry_duration = models.DurationField(default=get_default_expiry_duration, null=False)
+    last_accessed_at = models.DateTimeField(blank=True, null=True, db_index=True)
+    expires_at = models.DateTimeField(blank=True, null=True, db_index=True)
+    duration_expires_at = models.DateTimeField(blank=True, null=True, db_index=True)
+
+    objects = CurtainQuerySet.as_manager()
 
     @property
     def is_expired(self):
@@ -100,14 +142,143 @@ class Curtain(models.Model):
         """
         if self.permanent:
             return False
+        return timezone.now() > self.compute_duration_expires_at()
+
+    def compute_expires_at(self):
+        """
+        When the curtain stops being served unless it is permanent: ACCESS_EXPIRY_WINDOW after its last access, or
+        None for curtains that were never accessed.
+        """
+        if self.last_accessed_at is None:
+            return None
+        return self.last_accessed_at + ACCESS_EXPIRY_WINDOW
 
-        last_access_record = self.last_access.order_by('-last_access').first()
-        if last_access_record:
-            expiry_time = last_access_record.last_access + self.expiry_duration
-            return timezone.now() > expiry_time
+    def compute_duration_expires_at(self):
+        """
+        When is_expired starts reporting the curtain as expired: expiry_duration after its last access, or after its
+        creation for curtains that were never accessed.
+        """
+        return (self.last_accessed_at or self.created or timezone.now()) + self.expiry_duration
+
+    def refresh_expiry(self):
+        """
+        Recomputes expires_at and duration_expires_at, for callers that write the curtain without save().
+        """
+        self.expires_at = self.compute_expires_at()
+        self.duration_expires_at = self.compute_duration_expires_at()
+
+    def save(self, *args, **kwargs):
+        self.refresh_expiry()
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None and {"expiry_duration", "last_accessed_at"} & set(update_fields):
+            kwargs["update_fields"] = set(update_fields) | {"expires_at", "duration_expires_at"}
+        super().save(*args, **kwargs)
+
+    def save_session_file(self, content, digest=None):
+        """
+        Saves the session file and records the hash of its content, computed while the file is written unless the
+        caller already knows it. With content-addressed storage the content is hashed first and nothing is written
+        when a blob with that hash already exists.
+        """
+        previous_name = self.file.name
+        digest = self.write_session_file(content, digest)
+        self.save()
+        self._replaced_session_file(previous_name)
+        self.set_data_hash(digest)
+        return digest
+
+    def write_session_file(self, content, digest=None):
+        """
+        Writes the session file like save_session_file but leaves saving the curtain and recording the returned
+        hash to the caller, e.g. to create many curtains at once.
+        """
+        if is_content_addressed_storage():
+            if digest is None:
+                digest = hash_content(content)
+            self.file.name = SessionBlob.acquire(digest, content=content).file.name
+        elif digest is None:
+            digest = save_hashed_file(self.file, str(self.link_id) + ".json", content, save=False)
+        else:
+            self.file.save(str(self.link_id) + ".json", content, save=False)
+        return digest
+
+    def attach_session_file(self, name, digest=None):
+        """
+        Points the session at a file already in storage, e.g. one written by a multipart upload, without copying it.
+        The hash is computed from the stored file when digest is not given. With content-addressed storage the file
+        becomes a blob, or is deleted in favour of the existing blob with the same hash.
+        """
+        previous_name = self.file.name
+        digest = self.link_session_file(name, digest)
+        self.save()
+        self._replaced_session_file(previous_name)
+        self.set_data_hash(digest)
+        return digest
+
+    def link_session_file(self, name, digest=None):
+        """
+        Points the session at a file already in storage like attach_session_file but leaves saving the curtain and
+        recording the returned hash to the caller.
+        """
+        self.file.name = name
+        if digest is None:
+            digest = hash_stored_file(self.file)
+        if is_content_addressed_storage():
+            self.file.name = SessionBlob.acquire(digest, name=name).file.name
+        return digest
+
+    def share_session_file(self, source):
+        """
+        Gives the session the same file as source. When source's file is a blob this only takes another reference
+        to it, otherwise the content is copied.
+        """
+        blob = SessionBlob.objects.filter(file=source.file.name).first()
+        if blob is not None:
+            previous_name = self.file.name
+            self._use_blob(SessionBlob.acquire(blob.hash))
+            self._replaced_session_file(previous_name)
+            self.set_data_hash(blob.hash)
+            return blob.hash
+        with source.file.storage.open(source.file.name, "rb") as f:
+            return self.save_session_file(f, source.get_data_hash())
+
+    def _use_blob(self, blob):
+        self.file.name = blob.file.name
+        self.save()
+
+    def discard_session_file(self):
+        """
+        Deletes the file write_session_file wrote for a curtain that was not saved after all, e.g. because its
+        transaction rolled back. A file a blob still refers to is kept.
+        """
+        if self.file.name:
+            SessionBlob._delete_file(self.file.name)
+
+    def _replaced_session_file(self, previous_name):
+        invalidate_signed_url(previous_name)
+        invalidate_signed_url(self.file.name)
+        SessionBlob.release(previous_name)
+
+    def set_data_hash(self, digest):
+        previous = set(DataHash.objects.filter(curtain=self).values_list("hash", flat=True)) - {digest}
+        DataHash.objects.filter(curtain=self).delete()
+        DataHash.objects.create(curtain=self, hash=digest)
+        if previous:
+            SessionDerivation.discard(previous)
+
+    def get_data_hash(self):
+        """
+        Returns the hash of the current session file or None if it has not been recorded yet.
+        """
+        return self.data_hash.order_by("-id").values_list("hash", flat=True).first()
 
-        expiry_time = self.created + self.expiry_duration
-        return timezone.now() > expiry_time
+    def update_data_hash(self):
+        """
+        Computes and records the hash of a session file that was stored without one.
+        """
+        digest = hash_stored_file(self.file)
+        self.set_data_hash(digest)
+        return digest
 
     def __str__(self):
         owners = "None"
@@ -121,6 +292,122 @@ class Curtain(models.Model):
             owners = ",".join([i.username for i in self.owners.all()])
         return f"{self.link_id} - {self.curtain_type} - Created: {self.created} - owners: {owners}"
 
+class SessionBlob(models.Model):
+    """
+    A session file stored once under the hash of its content. Curtains with that content point their file at the
+    blob and are counted in ref_count. The blob and its file are deleted when the last curtain lets go of it.
+    """
+    created = models.DateTimeField(auto_now_add=True)
+    hash = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to="media/files/blobs/", storage=CompressedStorage())
+    size = models.BigIntegerField(default=0)
+    ref_count = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def acquire(cls, digest, content=None, name=None):
+        """
+        Takes a reference to the blob with this hash. A missing blob is written from content, or adopts name,
+        a file already in storage. Such a file is deleted instead when the blob already exists.
+        """
+        if cls.objects.filter(hash=digest).update(ref_count=models.F("ref_count") + 1):
+            if name is not None:
+                cls._delete_file(name)
+            return cls.objects.get(hash=digest)
+        blob = cls(hash=digest, ref_count=1)
+        if name is None:
+            blob.file.save(f"{digest}.json", content, save=False)
+        else:
+            blob.file.name = name
+        blob.size = blob.file.size
+        try:
+            with transaction.atomic():
+                blob.save()
+        except IntegrityError:
+            # another request stored the same content first, so take a reference to its blob and drop our copy
+            return cls.acquire(digest, name=blob.file.name)
+        return blob
+
+    @classmethod
+    def release(cls, name):
+        """
+        Drops a reference to the blob stored under name and deletes the blob when it was the last one.
+        Files that are not blobs are left alone.
+        """
+        if not name:
+            return
+        with transaction.atomic():
+            blob = cls.objects.select_for_update().filter(file=name).first()
+            if blob is None:
+                return
+            if blob.ref_count > 1:
+                cls.objects.filter(pk=blob.pk).update(ref_count=models.F("ref_count") - 1)
+                return
+            blob.delete()
+            transaction.on_commit(lambda: cls._delete_file(name))
+
+    @classmethod
+    def _delete_file(cls, name):
+        # a blob created again with the same content may have been written under the same name in the meantime
+        if cls.objects.filter(file=name).exists():
+            return
+        storage = cls._meta.get_field("file").storage
+        if is_local_storage():
+            path = storage.path(name)
+            remove_compressed_variants(path)
+            remove_session_index(path)
+        storage.delete(name)
+        invalidate_signed_url(name)
+
+    def __str__(self):
+        return f"{self.hash} ({self.ref_count} references)"
+
+
+@receiver(post_delete, sender=Curtain)
+def release_session_blob(sender, instance, **kwargs):
+    SessionBlob.release(instance.file.name)
+
+
+class SessionDerivation(models.Model):
+    """
+    State of one stage of the derivation pipeline run on a session after it is saved (see curtain.derivations).
+    Artifacts are keyed by the content hash, so curtains with the same content share them and a changed file gets
+    new ones.
+    """
+    status_choices = [
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("done", "Done"),
+        ("failed", "Failed"),
+    ]
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+    hash = models.CharField(max_length=64)
+    stage = models.CharField(max_length=20)
+    status = models.CharField(max_length=10, choices=status_choices, default="pending")
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, default="")
+    artifacts = models.JSONField(default=list, blank=True)
+
+    class Meta:
+        unique_together = ['hash', 'stage']
+
+    @classmethod
+    def discard(cls, hashes):
+        """
+        Deletes the artifacts and states of the content hashes no curtain uses anymore, so nothing derived from a
+        replaced file outlives it. Returns the number of hashes discarded.
+        """
+        unused = set(hashes) - set(DataHash.objects.filter(hash__in=hashes).values_list("hash", flat=True))
+        names = [name for artifacts in cls.objects.filter(hash__in=unused).values_list("artifacts", flat=True)
+                 for name in artifacts]
+        cls.objects.filter(hash__in=unused).delete()
+        transaction.on_commit(lambda: [default_storage.delete(name) for name in names])
+        return len(unused)
+
+    def __str__(self):
+        return f"{self.hash} {self.stage}: {self.status}"
+
+
 class SocialPlatform(models.Model):
     """
     This model represents a social platform with a name field.
@@ -235,10 +522,35 @@ class DataCite(models.Model):
         null=True,
         help_text="Local file storage for DataCite data (stored on host, not cloud)"
     )
+    local_file_hash = models.CharField(max_length=64, blank=True, null=True)
 
     class Meta:
         ordering = ["-updated"]
 
+    def share_local_file(self, digest):
+        """
+        Points local_file at the snapshot of another DataCite with the same content hash, if there is one, so the
+        content does not have to be copied. Only done with content-addressed storage. Snapshots back published DOIs
+        and are never deleted, so they can be shared without reference counting. The instance is not saved.
+        """
+        if not digest or not is_content_addressed_storage():
+            return False
+        existing = DataCite.objects.filter(local_file_hash=digest).exclude(local_file="").exclude(
+            local_file__isnull=True).values_list("local_file", flat=True).first()
+        if existing is None:
+            return False
+        self.local_file.name = existing
+        self.local_file_hash = digest
+        return True
+
+    def save_local_file(self, name, content):
+        """
+        Snapshots content, the decompressed session, into local_file and records its hash. The suffix of the codec
+        the session is stored with is dropped from the name, so the snapshot is served as the plain file it holds.
+        The instance is not saved.
+        """
+        self.local_file_hash = save_hashed_file(self.local_file, strip_stored_suffix(name), content, save=False)
+
     def send_notification(self):
         send_mail(
             'Curtain Data Cite Notification',
@@ -253,7 +565,8 @@ class LastAccess(models.Model):
     This model represents the last access timestamp for a Curtain.
     """
     curtain = models.ForeignKey(Curtain, on_delete=models.CASCADE, related_name="last_access")
-    last_access = models.DateTimeField(auto_now=True)
+    last_access = models.DateTimeField(default=timezone.now)
+    access_count = models.PositiveIntegerField(default=1)
 
 
 class Announcement(models.Model):
@@ -0,0 +1,128 @@
+import mimetypes
+
+import requests
+from django.conf import settings
+from storages.utils import clean_name
+
+S3_STORAGE_BACKENDS = ("storages.backends.s3.S3Storage", "storages.backends.s3boto3.S3Boto3Storage")
+GCS_STORAGE_BACKENDS = ("storages.backends.gcloud.GoogleCloudStorage",)
+
+# GCS only accepts intermediate chunks that are a multiple of 256 KiB
+GCS_CHUNK_ALIGNMENT = 256 * 1024
+GCS_REQUEST_TIMEOUT = 300
+
+
+class MultipartUploadError(Exception):
+    pass
+
+
+class S3MultipartBackend:
+    """
+    Writes an object through an S3 multipart upload. The upload state is the UploadId and the list of uploaded
+    parts, both of which are plain values that can be stored between requests.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    @property
+    def client(self):
+        return self.storage.connection.meta.client
+
+    def key(self, name):
+        return self.storage._normalize_name(clean_name(name))
+
+    def start(self, name):
+        key = self.key(name)
+        params = self.storage._get_write_parameters(key)
+        response = self.client.create_multipart_upload(Bucket=self.storage.bucket_name, Key=key, **params)
+        return response["UploadId"]
+
+    def upload_part(self, name, upload_id, parts, offset, data):
+        part_number = len(parts) + 1
+        response = self.client.upload_part(
+            Bucket=self.storage.bucket_name, Key=self.key(name), UploadId=upload_id,
+            PartNumber=part_number, Body=data,
+        )
+        parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+
+    def complete(self, name, upload_id, parts, offset, data):
+        """
+        Uploads the remaining data as the last part and commits the object.
+        """
+        if data or not parts:
+            self.upload_part(name, upload_id, parts, offset, data)
+        self.client.complete_multipart_upload(
+            Bucket=self.storage.bucket_name, Key=self.key(name), UploadId=upload_id,
+            MultipartUpload={"Parts": parts},
+        )
+
+    def abort(self, name, upload_id):
+        self.client.abort_multipart_upload(Bucket=self.storage.bucket_name, Key=self.key(name), UploadId=upload_id)
+
+
+class GCSResumableBackend:
+    """
+    Writes an object through a GCS resumable upload session. The upload state is the session URI, which
+    authorizes the upload by itself, so parts are sent with plain requests.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def key(self, name):
+        return self.storage._normalize_name(clean_name(name))
+
+    def start(self, name):
+        key = self.key(name)
+        blob = self.storage.bucket.blob(key)
+        for prop, value in self.storage.get_object_parameters(key).items():
+            setattr(blob, prop, value)
+        content_type, _ = mimetypes.guess_type(key)
+        return blob.create_resumable_upload_session(
+            content_type=content_type or "application/octet-stream",
+            client=self.storage.client,
+            predefined_acl=self.storage.default_acl,
+        )
+
+    def upload_part(self, name, upload_id, parts, offset, data):
+        if len(data) % GCS_CHUNK_ALIGNMENT:
+            raise MultipartUploadError(f"GCS upload chunks must be a multiple of {GCS_CHUNK_ALIGNMENT} bytes")
+        self._put(upload_id, data, f"bytes {offset}-{offset + len(data) - 1}/*", (308,))
+
+    def complete(self, name, upload_id, parts, offset, data):
+        total = offset + len(data)
+        content_range = f"bytes {offset}-{total - 1}/{total}" if data else f"bytes */{total}"
+        self._put(upload_id, data, content_range, (200, 201))
+
+    def abort(self, name, upload_id):
+        requests.delete(upload_id, timeout=GCS_REQUEST_TIMEOUT)
+
+    def _put(self, session_uri, data, content_range, expected_status):
+        response = requests.put(session_uri, data=data, headers={"Content-Range": content_range},
+                                timeout=GCS_REQUEST_TIMEOUT)
+        if response.status_code not in expected_status:
+            raise MultipartUploadError(f"GCS resumable upload failed with status {response.status_code}: {response.text}")
+
+
+def get_multipart_backend(storage):
+    """
+    Returns the multipart writer for the storage backend or None if uploads to it cannot be streamed part by part.
+    """
+    if not settings.CURTAIN_MULTIPART_UPLOADS:
+        return None
+    # storage.__class__ rather than type() so default_storage resolves to the configured backend
+    backend_path = f"{storage.__class__.__module__}.{storage.__class__.__name__}"
+    if backend_path in S3_STORAGE_BACKENDS:
+        return S3MultipartBackend(storage)
+    if backend_path in GCS_STORAGE_BACKENDS:
+        return GCSResumableBackend(storage)
+    return None
+
+
+def multipart_part_size():
+    """
+    Size of the parts sent to the storage backend. At least 5 MiB (the S3 minimum) and a multiple of 256 KiB for GCS.
+    """
+    part_size = max(settings.CURTAIN_MULTIPART_PART_SIZE, 5 * 1024 * 1024)
+    return part_size - part_size % GCS_CHUNK_ALIGNMENT
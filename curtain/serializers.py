@@ -56,10 +56,7 @@ class CurtainSerializer(serializers.ModelSerializer):
         return record.is_expired
 
     def get_last_access_date(self, record):
-        last_access_record = record.last_access.order_by('-last_access').first()
-        if last_access_record:
-            return last_access_record.last_access
-        return None
+        return record.last_accessed_at
 
     def get_expiry_duration_months(self, record):
         return int(record.expiry_duration.days / 30)
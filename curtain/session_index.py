@@ -0,0 +1,138 @@
+import json
+import mmap
+import os
+import re
+import uuid
+
+INDEX_SUFFIX = ".index.json"
+
+# Matches JSON strings (unrolled loop so long strings such as the raw/processed tables are skipped quickly)
+# and the brackets that change nesting depth. Commas, numbers and literals are never looked at.
+token_regex = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{}]', re.DOTALL)
+
+WHITESPACE = b" \t\r\n"
+OPENING = frozenset(b"[{")
+CLOSING = frozenset(b"]}")
+QUOTE = ord('"')
+COLON = ord(":")
+COMMA = ord(",")
+
+
+def _skip_whitespace(data, pos, size):
+    while pos < size and data[pos] in WHITESPACE:
+        pos += 1
+    return pos
+
+
+def _strip_trailing(data, end):
+    """
+    Moves end back over whitespace and at most one separating comma so data[start:end] is exactly the value.
+    """
+    while end > 0 and data[end - 1] in WHITESPACE:
+        end -= 1
+    if end > 0 and data[end - 1] == COMMA:
+        end -= 1
+        while end > 0 and data[end - 1] in WHITESPACE:
+            end -= 1
+    return end
+
+
+def scan_top_level_spans(data):
+    """
+    Finds the byte span [start, end) of the value of every top-level key of a JSON object without parsing it.
+    data can be bytes or an mmap. Returns None if data is not a JSON object.
+    """
+    size = len(data)
+    start = _skip_whitespace(data, 0, size)
+    if start >= size or data[start] != ord("{"):
+        return None
+
+    spans = {}
+    depth = 0
+    current_key = None
+    value_start = None
+    for match in token_regex.finditer(data, start):
+        position = match.start()
+        first = data[position]
+        if first == QUOTE:
+            if depth != 1:
+                continue
+            after = _skip_whitespace(data, match.end(), size)
+            if after >= size or data[after] != COLON:
+                # a string value of a top-level key, not a key
+                continue
+            if current_key is not None:
+                spans[current_key] = (value_start, _strip_trailing(data, position))
+            current_key = json.loads(bytes(data[position:match.end()]))
+            value_start = _skip_whitespace(data, after + 1, size)
+        elif first in OPENING:
+            depth += 1
+        elif first in CLOSING:
+            depth -= 1
+            if depth == 0:
+                if current_key is not None:
+                    spans[current_key] = (value_start, _strip_trailing(data, position))
+                return spans
+    return None
+
+
+def index_path(path):
+    return path + INDEX_SUFFIX
+
+
+def build_session_index(path):
+    """
+    Scans the session file at path and writes its sidecar index. Returns the index or None if the file is not a
+    JSON object (e.g. an encrypted session).
+    """
+    file_stat = os.stat(path)
+    if file_stat.st_size == 0:
+        return None
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        spans = scan_top_level_spans(data)
+    if spans is None:
+        return None
+
+    index = {
+        "size": file_stat.st_size,
+        "mtime_ns": file_stat.st_mtime_ns,
+        "keys": {key: list(span) for key, span in spans.items()},
+    }
+    temp_path = f"{index_path(path)}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, "w") as f:
+            json.dump(index, f)
+        os.replace(temp_path, index_path(path))
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return index
+
+
+def load_session_index(path):
+    """
+    Reads the sidecar index of the session file at path. Returns None if it is missing or the file changed since.
+    """
+    try:
+        with open(index_path(path)) as f:
+            index = json.load(f)
+        file_stat = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if index.get("size") != file_stat.st_size or index.get("mtime_ns") != file_stat.st_mtime_ns:
+        return None
+    return index
+
+
+def get_session_index(path):
+    """
+    Returns the sidecar index of the session file at path, building it first if it is missing or stale.
+    """
+    return load_session_index(path) or build_session_index(path)
+
+
+def remove_session_index(path):
+    try:
+        os.remove(index_path(path))
+    except FileNotFoundError:
+        pass
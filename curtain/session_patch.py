@@ -0,0 +1,277 @@
+import copy
+import hashlib
+import json
+import mmap
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from rest_framework.parsers import JSONParser
+
+from curtain.compression import stored_encoding
+from curtain.hashing import DATA_HASH_ALGORITHM, HASH_BLOCK_SIZE
+from curtain.session_index import get_session_index, scan_top_level_spans
+from curtain.session_validation import REQUIRED_SESSION_KEYS, session_validation_enabled
+from curtain.storage import is_local_storage
+
+# The patched session is kept in memory up to this size while it is written, larger sessions spill to a temp file
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+MERGE_PATCH_MEDIA_TYPE = "application/merge-patch+json"
+JSON_PATCH_MEDIA_TYPE = "application/json-patch+json"
+
+# Marks a top-level key the patch removes
+REMOVED = object()
+
+
+class SessionPatchError(ValueError):
+    pass
+
+
+class MergePatchParser(JSONParser):
+    media_type = MERGE_PATCH_MEDIA_TYPE
+
+
+class JSONPatchParser(JSONParser):
+    media_type = JSON_PATCH_MEDIA_TYPE
+
+
+def merge_patch(target, patch):
+    """
+    Applies a JSON merge patch (RFC 7386) to target and returns the result. target is not modified.
+    """
+    if not isinstance(patch, dict):
+        return patch
+    result = dict(target) if isinstance(target, dict) else {}
+    for key, value in patch.items():
+        if value is None:
+            result.pop(key, None)
+        else:
+            result[key] = merge_patch(result.get(key), value)
+    return result
+
+
+def _parse_pointer(pointer):
+    if not isinstance(pointer, str) or not pointer.startswith("/"):
+        raise SessionPatchError(f"Invalid JSON pointer: {pointer!r}, only paths below the top-level keys can be patched")
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def _array_index(container, token, pointer, allow_end=False):
+    if allow_end and token == "-":
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token[0] == "0"):
+        raise SessionPatchError(f"Invalid array index in {pointer}")
+    index = int(token)
+    if index > len(container) or (index == len(container) and not allow_end):
+        raise SessionPatchError(f"Array index out of range in {pointer}")
+    return index
+
+
+def _resolve_parent(document, tokens, pointer):
+    container = document
+    for token in tokens[:-1]:
+        if isinstance(container, dict) and token in container:
+            container = container[token]
+        elif isinstance(container, list):
+            container = container[_array_index(container, token, pointer)]
+        else:
+            raise SessionPatchError(f"Path not found: {pointer}")
+    return container, tokens[-1]
+
+
+def _get(document, pointer):
+    tokens = _parse_pointer(pointer)
+    container, token = _resolve_parent(document, tokens, pointer)
+    if isinstance(container, dict):
+        if token not in container:
+            raise SessionPatchError(f"Path not found: {pointer}")
+        return container[token]
+    if isinstance(container, list):
+        return container[_array_index(container, token, pointer)]
+    raise SessionPatchError(f"Path not found: {pointer}")
+
+
+def _add(document, pointer, value):
+    tokens = _parse_pointer(pointer)
+    container, token = _resolve_parent(document, tokens, pointer)
+    if isinstance(container, dict):
+        container[token] = value
+    elif isinstance(container, list):
+        container.insert(_array_index(container, token, pointer, allow_end=True), value)
+    else:
+        raise SessionPatchError(f"Path not found: {pointer}")
+
+
+def _remove(document, pointer):
+    tokens = _parse_pointer(pointer)
+    container, token = _resolve_parent(document, tokens, pointer)
+    if isinstance(container, dict):
+        if token not in container:
+            raise SessionPatchError(f"Path not found: {pointer}")
+        return container.pop(token)
+    if isinstance(container, list):
+        return container.pop(_array_index(container, token, pointer))
+    raise SessionPatchError(f"Path not found: {pointer}")
+
+
+def apply_json_patch(document, operations):
+    """
+    Applies JSON Patch (RFC 6902) operations to document in place. The patch is applied as a whole or not at all,
+    so a failing operation raises SessionPatchError and document must then be discarded.
+    """
+    for operation in operations:
+        if not isinstance(operation, dict) or "path" not in operation:
+            raise SessionPatchError("Each JSON patch operation needs an op and a path")
+        op = operation.get("op")
+        path = operation["path"]
+        if op in ("add", "replace", "test") and "value" not in operation:
+            raise SessionPatchError(f"{op} operation on {path} has no value")
+        if op in ("move", "copy") and "from" not in operation:
+            raise SessionPatchError(f"{op} operation on {path} has no from")
+        if op == "add":
+            _add(document, path, operation["value"])
+        elif op == "remove":
+            _remove(document, path)
+        elif op == "replace":
+            _remove(document, path)
+            _add(document, path, operation["value"])
+        elif op == "move":
+            if path.startswith(operation["from"] + "/"):
+                raise SessionPatchError(f"Cannot move {operation['from']} into itself")
+            _add(document, path, _remove(document, operation["from"]))
+        elif op == "copy":
+            _add(document, path, copy.deepcopy(_get(document, operation["from"])))
+        elif op == "test":
+            if _get(document, path) != operation["value"]:
+                raise SessionPatchError(f"Test failed for {path}")
+        else:
+            raise SessionPatchError(f"Unsupported JSON patch operation: {op!r}")
+
+
+def _top_level_key(pointer):
+    return _parse_pointer(pointer)[0]
+
+
+@contextmanager
+def open_session_data(field_file):
+    """
+    Yields the bytes of a stored session as an mmap together with the span of every top-level value.
+    Plain local files are mapped directly and use their sidecar index. Compressed or remote files are first
+    copied, decompressed, to a temporary file.
+    """
+    if is_local_storage() and not stored_encoding(field_file.name):
+        path = field_file.path
+        with open(path, "rb") as f:
+            index = get_session_index(path)
+            if index is None:
+                raise SessionPatchError("Session file is not a JSON object")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                yield data, index["keys"]
+        return
+    with tempfile.TemporaryFile() as temp:
+        with field_file.storage.open(field_file.name, "rb") as f:
+            shutil.copyfileobj(f, temp, HASH_BLOCK_SIZE)
+        temp.flush()
+        if temp.tell() == 0:
+            raise SessionPatchError("Session file is not a JSON object")
+        with mmap.mmap(temp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            spans = scan_top_level_spans(data)
+            if spans is None:
+                raise SessionPatchError("Session file is not a JSON object")
+            yield data, spans
+
+
+def _load_value(data, spans, key):
+    start, end = spans[key]
+    try:
+        return json.loads(bytes(data[start:end]))
+    except ValueError:
+        raise SessionPatchError(f"The stored value of {key} is not valid JSON")
+
+
+def session_changes(data, spans, patch, json_patch=False):
+    """
+    Returns the new value, or REMOVED, of every top-level key the patch touches. Only those values are parsed,
+    and for a merge patch only the ones it merges into rather than replaces.
+    """
+    if json_patch:
+        if not isinstance(patch, list):
+            raise SessionPatchError("A JSON patch must be a list of operations")
+        keys = set()
+        for operation in patch:
+            if isinstance(operation, dict):
+                for field in ("path", "from"):
+                    if field in operation:
+                        keys.add(_top_level_key(operation[field]))
+        document = {key: _load_value(data, spans, key) for key in keys if key in spans}
+        apply_json_patch(document, patch)
+        return {key: document.get(key, REMOVED) for key in keys}
+
+    if not isinstance(patch, dict):
+        raise SessionPatchError("A merge patch must be a JSON object")
+    changes = {}
+    for key, value in patch.items():
+        if value is None:
+            changes[key] = REMOVED
+        elif isinstance(value, dict) and key in spans:
+            changes[key] = merge_patch(_load_value(data, spans, key), value)
+        else:
+            changes[key] = merge_patch(None, value)
+    return changes
+
+
+def write_patched_session(data, spans, changes, destination):
+    """
+    Writes the session with changes applied to destination and returns the hash of what was written.
+    Unchanged values are copied byte for byte in their original order, new keys are appended.
+    """
+    hasher = hashlib.new(DATA_HASH_ALGORITHM)
+
+    def write(chunk):
+        hasher.update(chunk)
+        destination.write(chunk)
+
+    write(b"{")
+    separator = b""
+    ordered = sorted(spans.items(), key=lambda item: item[1][0])
+    for key, (start, end) in ordered:
+        if changes.get(key) is REMOVED:
+            continue
+        write(separator + json.dumps(key).encode("utf-8") + b": ")
+        if key in changes:
+            write(json.dumps(changes[key]).encode("utf-8"))
+        else:
+            for offset in range(start, end, HASH_BLOCK_SIZE):
+                write(data[offset:min(offset + HASH_BLOCK_SIZE, end)])
+        separator = b", "
+    for key, value in changes.items():
+        if key in spans or value is REMOVED:
+            continue
+        write(separator + json.dumps(key).encode("utf-8") + b": " + json.dumps(value).encode("utf-8"))
+        separator = b", "
+    write(b"}")
+    return hasher.hexdigest()
+
+
+def build_patched_session(field_file, patch, json_patch=False):
+    """
+    Applies a merge patch, or JSON patch operations, to the top-level keys of a stored session.
+    Returns the patched session as a file positioned at its start, and its hash. The caller closes the file.
+    Raises SessionPatchError if the patch cannot be applied or would remove a required key.
+    """
+    patched = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    try:
+        with open_session_data(field_file) as (data, spans):
+            changes = session_changes(data, spans, patch, json_patch)
+            if session_validation_enabled():
+                missing = [key for key in REQUIRED_SESSION_KEYS
+                           if changes.get(key) is REMOVED or (key not in spans and key not in changes)]
+                if missing:
+                    raise SessionPatchError(f"Session file is missing required keys: {', '.join(missing)}")
+            digest = write_patched_session(data, spans, changes, patched)
+    except BaseException:
+        patched.close()
+        raise
+    patched.seek(0)
+    return patched, digest
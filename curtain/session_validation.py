@@ -0,0 +1,253 @@
+import json
+import re
+
+from django.conf import settings
+
+REQUIRED_SESSION_KEYS = ("processed", "raw", "differentialForm", "rawForm", "settings")
+
+# Top-level values up to this size are parsed and returned with the metadata, larger ones only get their size
+MAX_METADATA_VALUE_SIZE = 64 * 1024
+# Nesting depth is bounded so the container stack, and with it memory, stays constant
+MAX_DEPTH = 512
+# Longest number or literal that may be split between two chunks
+MAX_PARTIAL_TOKEN = 1024
+
+WHITESPACE_RE = re.compile(rb"[ \t\r\n]*")
+# Body of a JSON string up to the closing quote, the end of the data or the first invalid character or escape.
+# Unrolled like the index scanner so the long TSV strings are consumed by the regex engine in one go.
+STRING_BODY_RE = re.compile(rb'[^"\\\x00-\x1f]*(?:\\(?:["\\/bfnrt]|u[0-9a-fA-F]{4})[^"\\\x00-\x1f]*)*')
+NUMBER_RE = re.compile(rb"-?(?:0|[1-9][0-9]*)(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?")
+LITERALS = {b"true": "boolean", b"false": "boolean", b"null": "null"}
+NUMBER_START = frozenset(b"-0123456789")
+NUMBER_CHARACTERS_RE = re.compile(rb"[-+.eE0-9]*")
+QUOTE = ord('"')
+BACKSLASH = ord("\\")
+OPEN_OBJECT, CLOSE_OBJECT = ord("{"), ord("}")
+OPEN_ARRAY, CLOSE_ARRAY = ord("["), ord("]")
+COLON = ord(":")
+COMMA = ord(",")
+
+# What the parser expects next
+VALUE, VALUE_OR_END, KEY, KEY_OR_END, KEY_SEPARATOR, SEPARATOR_OR_END, DONE = range(7)
+
+
+class SessionValidationError(ValueError):
+    pass
+
+
+class SessionValidator:
+    """
+    Checks that a session file is a well-formed JSON object holding the required top-level keys, fed with
+    update() as its bytes arrive. Only a partial token and the container stack are kept between calls, strings
+    are checked without being collected, so memory does not grow with the file.
+    update() never raises. The first error stops the check and is raised by close(), which returns the
+    metadata gathered on the way: the type and byte size of every top-level value, and the parsed value of
+    the small ones.
+    """
+
+    def __init__(self, required_keys=REQUIRED_SESSION_KEYS):
+        self.required_keys = tuple(required_keys)
+        self.error = None
+        self.keys = {}
+        self.values = {}
+        self._buffer = b""
+        self._offset = 0
+        self._stack = []
+        self._expect = VALUE
+        self._in_string = False
+        self._string_is_key = False
+        self._key = None
+        self._key_parts = None
+        self._value_start = None
+        self._capture = None
+        self._capture_from = 0
+
+    def update(self, data):
+        if self.error is not None:
+            return
+        self._buffer = self._buffer + bytes(data) if self._buffer else bytes(data)
+        self._scan(final=False)
+
+    def close(self):
+        """
+        Finishes the check and returns the metadata, or raises SessionValidationError.
+        """
+        if self.error is None:
+            self._scan(final=True)
+        if self.error is None and (self._expect != DONE or self._in_string):
+            self._fail("Session file ends before the JSON is complete")
+        if self.error is not None:
+            raise SessionValidationError(self.error)
+        missing = [key for key in self.required_keys if key not in self.keys]
+        if missing:
+            raise SessionValidationError(f"Session file is missing required keys: {', '.join(missing)}")
+        return {"size": self._offset, "keys": self.keys, "values": self.values}
+
+    def _fail(self, message, position=None):
+        if position is not None:
+            message = f"{message} at byte {self._offset + position}"
+        self.error = message
+        self._buffer = b""
+
+    def _scan(self, final):
+        data = self._buffer
+        size = len(data)
+        pos = 0
+        while self.error is None:
+            if self._in_string:
+                end = STRING_BODY_RE.match(data, pos).end()
+                if self._key_parts is not None:
+                    self._key_parts.append(data[pos:end])
+                if end < size and data[end] == QUOTE:
+                    self._in_string = False
+                    pos = end + 1
+                    self._end_string(data, pos)
+                    continue
+                if end == size or (not final and data[end] == BACKSLASH and size - end < 6):
+                    # the string, or an escape sequence in it, continues in the next chunk
+                    pos = end
+                    break
+                self._fail("Invalid character in string", end)
+                return
+            pos = WHITESPACE_RE.match(data, pos).end()
+            if pos >= size:
+                break
+            byte = data[pos]
+            if byte == QUOTE:
+                self._start_string(data, pos)
+                pos += 1
+            elif byte in (OPEN_OBJECT, OPEN_ARRAY):
+                self._open(data, pos, byte)
+                pos += 1
+            elif byte in (CLOSE_OBJECT, CLOSE_ARRAY):
+                pos += 1
+                self._close(data, pos, byte)
+            elif byte == COLON:
+                if self._expect != KEY_SEPARATOR:
+                    self._fail("Unexpected ':'", pos)
+                self._expect = VALUE
+                pos += 1
+            elif byte == COMMA:
+                if self._expect != SEPARATOR_OR_END:
+                    self._fail("Unexpected ','", pos)
+                self._expect = KEY if self._stack[-1] == OPEN_OBJECT else VALUE
+                pos += 1
+            else:
+                end, value_type = self._match_scalar(data, pos, final)
+                if end is None:
+                    if value_type is None:
+                        self._fail("Invalid JSON token", pos)
+                    break
+                self._start_value(data, pos, value_type)
+                if self.error is None:
+                    pos = end
+                    self._end_value(data, pos)
+
+        if self.error is not None:
+            return
+        if self._capture is not None:
+            if self._fits_capture(pos):
+                self._capture += data[self._capture_from:pos]
+                self._capture_from = 0
+            else:
+                self._capture = None
+        self._offset += pos
+        self._buffer = data[pos:]
+        if len(self._buffer) > MAX_PARTIAL_TOKEN:
+            self._fail("Invalid JSON token", 0)
+
+    def _match_scalar(self, data, pos, final):
+        """
+        Returns (end, type) of the number or literal at pos, (None, type) when it may continue in the next chunk
+        and (None, None) when it is invalid.
+        """
+        if data[pos] in NUMBER_START:
+            if not final and NUMBER_CHARACTERS_RE.match(data, pos).end() == len(data):
+                return None, "number"
+            match = NUMBER_RE.match(data, pos)
+            return (match.end(), "number") if match else (None, None)
+        for literal, value_type in LITERALS.items():
+            if data.startswith(literal, pos):
+                return pos + len(literal), value_type
+            if not final and len(data) - pos < len(literal) and literal.startswith(data[pos:]):
+                return None, value_type
+        return None, None
+
+    def _start_string(self, data, pos):
+        if self._expect in (KEY, KEY_OR_END):
+            self._string_is_key = True
+            # only top-level keys are kept
+            self._key_parts = [] if len(self._stack) == 1 else None
+        else:
+            self._start_value(data, pos, "string")
+            self._string_is_key = False
+        self._in_string = True
+
+    def _end_string(self, data, pos):
+        if not self._string_is_key:
+            self._end_value(data, pos)
+            return
+        if self._key_parts is not None:
+            self._key = json.loads(b'"' + b"".join(self._key_parts) + b'"')
+            self._key_parts = None
+        self._expect = KEY_SEPARATOR
+
+    def _open(self, data, pos, byte):
+        self._start_value(data, pos, "object" if byte == OPEN_OBJECT else "array")
+        if self.error is not None:
+            return
+        if len(self._stack) >= MAX_DEPTH:
+            self._fail("Session file is nested too deeply", pos)
+            return
+        self._stack.append(byte)
+        self._expect = KEY_OR_END if byte == OPEN_OBJECT else VALUE_OR_END
+
+    def _close(self, data, pos, byte):
+        opening = OPEN_OBJECT if byte == CLOSE_OBJECT else OPEN_ARRAY
+        allowed = (KEY_OR_END, SEPARATOR_OR_END) if byte == CLOSE_OBJECT else (VALUE_OR_END, SEPARATOR_OR_END)
+        if not self._stack or self._stack[-1] != opening or self._expect not in allowed:
+            self._fail(f"Unexpected '{chr(byte)}'", pos - 1)
+            return
+        self._stack.pop()
+        self._end_value(data, pos)
+
+    def _start_value(self, data, pos, value_type):
+        if self._expect not in (VALUE, VALUE_OR_END):
+            self._fail(f"Unexpected {value_type}", pos)
+            return
+        if not self._stack and value_type != "object":
+            self._fail("Session file is not a JSON object", pos)
+            return
+        if len(self._stack) == 1:
+            self.keys[self._key] = {"type": value_type, "size": 0}
+            self._value_start = self._offset + pos
+            self._capture = bytearray()
+            self._capture_from = pos
+
+    def _fits_capture(self, pos):
+        return len(self._capture) + pos - self._capture_from <= MAX_METADATA_VALUE_SIZE
+
+    def _end_value(self, data, pos):
+        if len(self._stack) == 1:
+            self.keys[self._key]["size"] = self._offset + pos - self._value_start
+            if self._capture is not None and self._fits_capture(pos):
+                self._capture += data[self._capture_from:pos]
+                self.values[self._key] = json.loads(bytes(self._capture))
+            self._capture = None
+        self._expect = SEPARATOR_OR_END if self._stack else DONE
+
+
+def validate_session_stream(f, required_keys=None):
+    """
+    Validates an uploaded session file chunk by chunk and rewinds it so it can be saved afterwards.
+    Returns the metadata or raises SessionValidationError.
+    """
+    validator = SessionValidator(REQUIRED_SESSION_KEYS if required_keys is None else required_keys)
+    for chunk in f.chunks():
+        validator.update(chunk)
+    f.seek(0)
+    return validator.close()
+
+
+def session_validation_enabled():
+    return settings.CURTAIN_VALIDATE_SESSION_UPLOADS
@@ -0,0 +1,57 @@
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+SIGNED_URL_CACHE_PREFIX = "curtain:signed_url:"
+
+
+def signed_url_cache_timeout():
+    """
+    How long a signed URL may be handed out from the cache. Kept below CURTAIN_SIGNED_URL_LIFETIME so a client never
+    receives a URL that expires right away.
+    """
+    lifetime = settings.CURTAIN_SIGNED_URL_LIFETIME
+    return lifetime - max(lifetime // 10, 30)
+
+
+def _cache_key(name):
+    return SIGNED_URL_CACHE_PREFIX + hashlib.sha256(name.encode("utf-8")).hexdigest()
+
+
+def get_signed_url(field_file):
+    """
+    Returns the signed URL of a stored file, reusing one signed earlier for the same file while it is still valid.
+    Cache failures fall back to signing a new URL.
+    """
+    timeout = signed_url_cache_timeout()
+    if timeout <= 0:
+        return field_file.url
+    key = _cache_key(field_file.name)
+    try:
+        url = cache.get(key)
+    except Exception as e:
+        logger.warning(f"Failed to read signed URL cache: {str(e)}")
+        return field_file.url
+    if url is None:
+        url = field_file.url
+        try:
+            cache.set(key, url, timeout=timeout)
+        except Exception as e:
+            logger.warning(f"Failed to write signed URL cache: {str(e)}")
+    return url
+
+
+def invalidate_signed_url(name):
+    """
+    Drops the cached signed URL of the file stored under name, e.g. after the file was replaced.
+    """
+    if not name:
+        return
+    try:
+        cache.delete(_cache_key(name))
+    except Exception as e:
+        logger.warning(f"Failed to invalidate signed URL cache: {str(e)}")
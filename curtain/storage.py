@@ -1,5 +1,53 @@
+import logging
+import time
+
+from botocore.exceptions import BotoCoreError
 from django.core.files.storage import FileSystemStorage
 from django.conf import settings
+from google.api_core.exceptions import ServerError, TooManyRequests
+
+logger = logging.getLogger(__name__)
+
+LOCAL_STORAGE_BACKEND = "django.core.files.storage.FileSystemStorage"
+
+# Failures of a read from S3/GCS that are worth another attempt: timeouts, dropped connections and server errors.
+# Missing files and denied access are OSErrors too but are raised at once.
+TRANSIENT_STORAGE_ERRORS = (OSError, BotoCoreError, ServerError, TooManyRequests)
+PERMANENT_STORAGE_ERRORS = (FileNotFoundError, PermissionError, IsADirectoryError)
+# Wait before the second attempt, doubled for every further one
+STORAGE_RETRY_DELAY = 0.5
+
+
+def is_local_storage():
+    """
+    Returns True when curtain session files are kept on the local file system.
+    """
+    return settings.STORAGES["default"]["BACKEND"] == LOCAL_STORAGE_BACKEND
+
+
+def is_content_addressed_storage():
+    """
+    Returns True when new session files are stored once per content hash and shared between curtains.
+    """
+    return settings.CURTAIN_CONTENT_ADDRESSED_STORAGE
+
+
+def with_storage_retries(read, attempts=None):
+    """
+    Returns read(), calling it again after a transient storage failure for up to CURTAIN_STORAGE_READ_ATTEMPTS
+    attempts. read must open and consume what it reads itself, so a retry never continues from a broken stream.
+    """
+    attempts = attempts or settings.CURTAIN_STORAGE_READ_ATTEMPTS
+    for attempt in range(1, attempts + 1):
+        try:
+            return read()
+        except PERMANENT_STORAGE_ERRORS:
+            raise
+        except TRANSIENT_STORAGE_ERRORS as e:
+            if attempt == attempts:
+                raise
+            logger.warning(f"Storage read failed on attempt {attempt} of {attempts}, retrying: {str(e)}")
+            time.sleep(STORAGE_RETRY_DELAY * 2 ** (attempt - 1))
 
 
 class DataCiteLocalStorage(FileSystemStorage):
@@ -0,0 +1,131 @@
+import io
+import json
+import string
+
+import numpy as np
+import pandas as pd
+
+PRIMARY_ID_COLUMN = "Index"
+GENE_NAME_COLUMN = "Gene names"
+FOLD_CHANGE_COLUMN = "log2 Fold Change"
+SIGNIFICANT_COLUMN = "p-value"
+COMPARISON_COLUMN = "Comparison"
+
+UPPERCASE = np.array(list(string.ascii_uppercase))
+
+
+def generate_primary_ids(rows, seed=0, isoform_fraction=0.05):
+    """
+    Returns rows unique UniProt-style accessions ([OPQ][0-9][A-Z0-9]{3}[0-9]). A fraction of them carry an isoform
+    suffix so accession parsing has something to strip.
+    """
+    alphabet = string.digits + string.ascii_uppercase
+    rng = np.random.default_rng(seed)
+    ids = []
+    for i in range(rows):
+        middle = i // 30
+        code = ""
+        for _ in range(3):
+            middle, remainder = divmod(middle, 36)
+            code = alphabet[remainder] + code
+        ids.append(f"{'OPQ'[i % 3]}{(i // 3) % 10}{code}{middle % 10}")
+    isoforms = rng.random(rows) < isoform_fraction
+    isoform_numbers = rng.integers(2, 6, rows)
+    return [f"{accession}-{isoform_numbers[i]}" if isoforms[i] else accession for i, accession in enumerate(ids)]
+
+
+def generate_gene_names(rows, seed=0):
+    rng = np.random.default_rng(seed + 1)
+    prefixes = ["".join(letters) for letters in UPPERCASE[rng.integers(0, 26, (rows, 3))]]
+    return [f"{prefix}{i % 997 + 1}" for i, prefix in enumerate(prefixes)]
+
+
+def sample_names(samples, conditions):
+    """
+    Splits samples into conditions as evenly as possible and returns {condition: [sample names]}.
+    """
+    sample_order = {f"Condition{i + 1}": [] for i in range(conditions)}
+    for i in range(samples):
+        names = sample_order[f"Condition{i % conditions + 1}"]
+        names.append(f"Condition{i % conditions + 1}.{len(names) + 1:02d}")
+    return sample_order
+
+
+def generate_session(rows=10000, samples=6, conditions=2, comparisons=1, missing_fraction=0.05, seed=0):
+    """
+    Builds a synthetic proteomics session dict in the shape the frontend saves: a differential analysis table
+    (processed), a searched intensity table (raw) and the forms and settings that describe their columns.
+    The differential table holds one row per protein and comparison. Deterministic for a given seed.
+    """
+    if conditions < 2 or samples < conditions:
+        raise ValueError("need at least two conditions and one sample per condition")
+    if not 0 < comparisons < conditions:
+        raise ValueError("comparisons must be between 1 and conditions - 1")
+    rng = np.random.default_rng(seed)
+    primary_ids = generate_primary_ids(rows, seed)
+    gene_names = generate_gene_names(rows, seed)
+    sample_order = sample_names(samples, conditions)
+    comparison_labels = [f"Condition{i + 2}-Condition1" for i in range(comparisons)]
+
+    processed = pd.DataFrame({
+        PRIMARY_ID_COLUMN: np.tile(primary_ids, comparisons),
+        GENE_NAME_COLUMN: np.tile(gene_names, comparisons),
+        FOLD_CHANGE_COLUMN: rng.normal(0, 1.5, rows * comparisons).round(4),
+        SIGNIFICANT_COLUMN: rng.beta(0.6, 2, rows * comparisons).round(6),
+        COMPARISON_COLUMN: np.repeat(comparison_labels, rows),
+    })
+
+    intensities = rng.lognormal(20, 2, (rows, samples)).round(2)
+    intensities[rng.random((rows, samples)) < missing_fraction] = np.nan
+    raw = pd.DataFrame(intensities, columns=[name for names in sample_order.values() for name in names])
+    raw.insert(0, GENE_NAME_COLUMN, gene_names)
+    raw.insert(0, PRIMARY_ID_COLUMN, primary_ids)
+
+    sample_map = {}
+    for condition, names in sample_order.items():
+        for replicate, name in enumerate(names, start=1):
+            sample_map[name] = {"condition": condition, "replicate": str(replicate), "name": name}
+
+    return {
+        "processed": _to_tsv(processed),
+        "raw": _to_tsv(raw),
+        "differentialForm": {
+            "_primaryIDs": PRIMARY_ID_COLUMN,
+            "_geneNames": GENE_NAME_COLUMN,
+            "_foldChange": FOLD_CHANGE_COLUMN,
+            "_significant": SIGNIFICANT_COLUMN,
+            "_comparison": COMPARISON_COLUMN,
+            "_comparisonSelect": comparison_labels,
+            "_transformFC": False,
+            "_transformSignificant": True,
+            "_reverseFoldChange": False,
+        },
+        "rawForm": {
+            "_primaryIDs": PRIMARY_ID_COLUMN,
+            "_samples": list(sample_map),
+            "_log2": False,
+        },
+        "settings": {
+            "title": f"Synthetic session ({rows} rows, {samples} samples)",
+            "pCutoff": 0.05,
+            "log2FCCutoff": 0.6,
+            "sampleOrder": sample_order,
+            "sampleMap": sample_map,
+            "conditionOrder": list(sample_order),
+            "sampleVisible": {name: True for name in sample_map},
+            "selections": {},
+            "selectionsMap": {},
+        },
+        "fetchUniprot": True,
+        "extraData": {},
+    }
+
+
+def generate_session_bytes(*args, **kwargs):
+    return json.dumps(generate_session(*args, **kwargs)).encode("utf-8")
+
+
+def _to_tsv(df):
+    buffer = io.StringIO()
+    df.to_csv(buffer, sep="\t", index=False)
+    return buffer.getvalue()
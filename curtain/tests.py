@@ -1,7 +1,51 @@
-from django.test import TestCase
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from botocore.stub import ANY, Stubber
+from redis.exceptions import WatchError
+
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
 from django.contrib.auth.models import User
+from drf_chunked_upload.exceptions import ChunkedUploadError
 from django.db import IntegrityError
-from curtain.models import ExtraProperties, SocialPlatform, UserPublicKey
+from rest_framework.test import APIClient
+from uniprotparser.betaparser import UniprotSequence
+from curtain import access_log, blob_cache
+from curtain.access_log import apply_access_events
+from curtain.benchmarks import SessionBenchmark
+from curtain.blob_cache import BlobCache, DiskLRU, MemoryLRU, open_curtain_file
+from curtain.chunk_staging import FileStaging, RedisStaging, StagingConflict, get_chunk_staging, reap_staged_chunks
+from curtain.chunked_upload import CurtainChunkedUpload
+from curtain.compressed_storage import check_at_rest_compression
+from curtain.hashing import StreamDigest, discard_stream_digest
+from curtain.derivations import DerivationError, DerivedSession, ParsedSession, artifact_name, load_manifest, \
+    open_session, run_derivations
+from curtain.compression import write_compressed_variants, available_encodings, variant_path, select_variant
+from curtain.session_index import scan_top_level_spans
+from curtain.session_validation import SessionValidationError, SessionValidator
+from curtain.signed_urls import get_signed_url, invalidate_signed_url
+from curtain.synthetic import generate_session
+from curtain.utils import parse_uniprot_accessions
+from curtain.worker_tasks import compress_session_at_rest, match_gene_names, queue_session_file_jobs, \
+    transform_fold_change
+from curtain.models import ExtraProperties, SocialPlatform, UserPublicKey, Curtain, LastAccess, SessionBlob, \
+    SessionDerivation, DataCite, DataHash, ACCESS_EXPIRY_WINDOW
 from curtainbe import settings
 
 
@@ -130,4 +174,1333 @@ class ExtraPropertiesModelTest(TestCase):
         )
         
         self.assertIsNone(extra_props.social_platform)
-        self.assertIsNone(extra_props.default_public_key)
\ No newline at end of file
+        self.assertIsNone(extra_props.default_public_key)
+
+
+TEST_MEDIA_ROOT = tempfile.mkdtemp()
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": TEST_MEDIA_ROOT},
+        },
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MEDIA_ROOT=TEST_MEDIA_ROOT,
+    CURTAIN_LAST_ACCESS_BUFFERED=False,
+)
+class CurtainDownloadTest(TestCase):
+
+    def setUp(self):
+        """Set up a public curtain with a stored session file."""
+        self.client = APIClient()
+        self.session = {"processed": "a\tb\n1\t2\n", "raw": "a\tb\n1\t2\n", "settings": {"title": "test"}}
+        self.payload = json.dumps(self.session, indent=2).encode("utf-8")
+        self.curtain = Curtain.objects.create(description="test")
+        self.curtain.save_session_file(ContentFile(self.payload))
+
+    def download_url(self):
+        return f"/curtain/{self.curtain.link_id}/download/token=/"
+
+    def test_download_streams_stored_bytes(self):
+        """Test that local downloads return the stored file unchanged."""
+        response = self.client.get(self.download_url())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "application/json")
+        self.assertEqual(b"".join(response.streaming_content), self.payload)
+
+    @override_settings(CURTAIN_DOWNLOAD_ACCEL_REDIRECT_PREFIX="/protected-media/")
+    def test_download_accel_redirect(self):
+        """Test that downloads are handed off to nginx when X-Accel-Redirect is configured."""
+        response = self.client.get(self.download_url())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Accel-Redirect"], "/protected-media/" + self.curtain.file.name)
+
+    def test_unhashed_download_queues_jobs_once(self):
+        """Test that repeated downloads of a session without a hash queue its file jobs only once."""
+        self.curtain.data_hash.all().delete()
+
+        with mock.patch("curtain.worker_tasks.queue_session_file_jobs") as queue:
+            for _ in range(3):
+                self.assertEqual(self.client.get(self.download_url()).status_code, 200)
+
+        queue.assert_called_once()
+
+    def test_download_missing_file(self):
+        """Test that a missing session file returns 404."""
+        os.remove(self.curtain.file.path)
+        response = self.client.get(self.download_url())
+
+        self.assertEqual(response.status_code, 404)
+
+    def test_download_precompressed_variant(self):
+        """Test that a fresh gzip sibling is served when the client accepts gzip."""
+        self.assertIn("gzip", write_compressed_variants(self.curtain.file.path))
+        response = self.client.get(self.download_url(), HTTP_ACCEPT_ENCODING="gzip, deflate")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertIn("Accept-Encoding", response["Vary"])
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), self.payload)
+
+    def test_stale_variant_ignored(self):
+        """Test that a sibling older than the session file is not selected."""
+        write_compressed_variants(self.curtain.file.path)
+        for encoding in available_encodings():
+            os.utime(variant_path(self.curtain.file.path, encoding), (0, 0))
+
+        self.assertEqual(select_variant(self.curtain.file.path, "br, zstd, gzip"), (None, self.curtain.file.path))
+
+    def test_download_etag_from_data_hash(self):
+        """Test that the hash recorded while saving the session is sent as a strong ETag."""
+        content_hash = hashlib.sha256(self.payload).hexdigest()
+        self.assertEqual(self.curtain.get_data_hash(), content_hash)
+
+        response = self.client.get(self.download_url())
+
+        self.assertEqual(response["ETag"], f'"{content_hash}"')
+        self.assertIn("no-cache", response["Cache-Control"])
+
+    def test_download_not_modified(self):
+        """Test that a matching If-None-Match gets a 304 without opening the session file."""
+        etag = f'"{self.curtain.get_data_hash()}"'
+        os.remove(self.curtain.file.path)
+        response = self.client.get(self.download_url(), HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+    def test_download_single_range(self):
+        """Test that a byte range is answered with 206 and only the requested bytes."""
+        response = self.client.get(self.download_url(), HTTP_RANGE="bytes=2-9", HTTP_ACCEPT_ENCODING="gzip")
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 2-9/{len(self.payload)}")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(b"".join(response.streaming_content), self.payload[2:10])
+
+    def test_download_multiple_ranges(self):
+        """Test that several ranges are sent as multipart/byteranges."""
+        response = self.client.get(self.download_url(), HTTP_RANGE="bytes=0-3,-4")
+
+        self.assertEqual(response.status_code, 206)
+        self.assertTrue(response["Content-Type"].startswith("multipart/byteranges; boundary="))
+        body = b"".join(response.streaming_content)
+        self.assertEqual(len(body), int(response["Content-Length"]))
+        self.assertIn(self.payload[:4], body)
+        self.assertIn(f"Content-Range: bytes {len(self.payload) - 4}-{len(self.payload) - 1}/{len(self.payload)}".encode(), body)
+
+    def test_download_if_range_mismatch(self):
+        """Test that a stale If-Range validator gets the full file instead of a range."""
+        response = self.client.get(self.download_url(), HTTP_RANGE="bytes=0-3", HTTP_IF_RANGE='"stale"')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), self.payload)
+
+    def test_download_unsatisfiable_range(self):
+        """Test that a range past the end of the file gets a 416."""
+        response = self.client.get(self.download_url(), HTTP_RANGE=f"bytes={len(self.payload)}-")
+
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response["Content-Range"], f"bytes */{len(self.payload)}")
+
+    def test_download_records_access(self):
+        """Test that a download without the Redis buffer updates LastAccess directly."""
+        self.client.get(self.download_url())
+        self.client.get(self.download_url())
+
+        access = LastAccess.objects.get(curtain=self.curtain)
+        self.assertEqual(access.access_count, 2)
+
+
+    def test_download_fields(self):
+        """Test that ?fields= returns only the requested top-level keys as a JSON object."""
+        response = self.client.get(self.download_url() + "?fields=settings,raw,missing")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            json.loads(b"".join(response.streaming_content)),
+            {"settings": self.session["settings"], "raw": self.session["raw"]}
+        )
+
+
+class SessionIndexTest(TestCase):
+
+    def test_scan_top_level_spans(self):
+        """Test that spans cover exactly the top-level values, skipping nested keys and tricky strings."""
+        session = {
+            "raw": "a\t\"b\"\n{not: json}",
+            "settings": {"raw": [1, {"x": "}"}], "title": "t"},
+            "empty": {},
+            "value": None,
+            "list": ["k", ":", ","],
+        }
+        data = json.dumps(session, indent=2).encode("utf-8")
+
+        spans = scan_top_level_spans(data)
+
+        self.assertEqual(list(spans), list(session))
+        for key, (start, end) in spans.items():
+            self.assertEqual(json.loads(data[start:end]), session[key])
+
+    def test_scan_rejects_non_object(self):
+        """Test that encrypted or non-object content has no index."""
+        self.assertIsNone(scan_top_level_spans(b"[1, 2]"))
+        self.assertIsNone(scan_top_level_spans(b"U2FsdGVkX1+encrypted"))
+
+class AccessEventsTest(TestCase):
+
+    def test_apply_access_events_folds_into_latest_row(self):
+        """Test that buffered events update the latest LastAccess row instead of adding rows."""
+        curtain = Curtain.objects.create(description="test")
+        earlier = timezone.now() - timedelta(days=1)
+        LastAccess.objects.create(curtain=curtain, last_access=earlier)
+        accessed_at = timezone.now()
+
+        updated = apply_access_events({curtain.id: (accessed_at, 5), curtain.id + 1: (accessed_at, 1)})
+
+        self.assertEqual(updated, 1)
+        access = LastAccess.objects.get(curtain=curtain)
+        self.assertEqual(access.last_access, accessed_at)
+        self.assertEqual(access.access_count, 6)
+
+    @override_settings(CURTAIN_LAST_ACCESS_BUFFERED=True)
+    def test_unreachable_redis_not_retried_on_every_access(self):
+        """Test that after Redis fails accesses are written directly without trying Redis again for a while."""
+        curtain = Curtain.objects.create(description="test")
+        self.addCleanup(setattr, access_log, "_buffer_unavailable_until", 0)
+
+        with mock.patch("curtain.access_log.django_rq.get_connection", side_effect=ConnectionError) as m:
+            with self.assertLogs("curtain.access_log", "WARNING"):
+                access_log.record_access(curtain)
+            access_log.record_access(curtain)
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(LastAccess.objects.get(curtain=curtain).access_count, 2)
+
+
+class CurtainExpiryTest(TestCase):
+
+    def test_expires_at_follows_last_access(self):
+        """Test that expires_at is unset until the curtain is accessed and then ends the access window."""
+        curtain = Curtain.objects.create(description="test", permanent=False)
+        self.assertIsNone(curtain.expires_at)
+
+        accessed_at = timezone.now()
+        apply_access_events({curtain.id: (accessed_at, 1)})
+        curtain.refresh_from_db()
+        self.assertEqual(curtain.last_accessed_at, accessed_at)
+        self.assertEqual(curtain.expires_at, accessed_at + ACCESS_EXPIRY_WINDOW)
+
+        self.assertEqual(curtain.duration_expires_at, accessed_at + curtain.expiry_duration)
+
+        curtain.expiry_duration = timedelta(days=180)
+        curtain.save(update_fields=["expiry_duration"])
+        curtain.refresh_from_db()
+        self.assertEqual(curtain.expires_at, accessed_at + ACCESS_EXPIRY_WINDOW)
+        self.assertEqual(curtain.duration_expires_at, accessed_at + timedelta(days=180))
+
+    def test_expired_queryset(self):
+        """Test that expired() only returns non-permanent curtains accessed before the access window."""
+        long_ago = timezone.now() - timedelta(days=365)
+        expired = Curtain.objects.create(description="expired", permanent=False)
+        apply_access_events({expired.id: (long_ago, 1)})
+        permanent = Curtain.objects.create(description="permanent", permanent=True)
+        apply_access_events({permanent.id: (long_ago, 1)})
+        never_accessed = Curtain.objects.create(description="never accessed", permanent=False)
+        Curtain.objects.filter(id=never_accessed.id).update(created=long_ago)
+        active = Curtain.objects.create(description="active", permanent=False)
+        apply_access_events({active.id: (timezone.now(), 1)})
+
+        self.assertEqual(list(Curtain.objects.expired()), [expired])
+        self.assertEqual(set(Curtain.objects.unexpired()), {permanent, never_accessed, active})
+
+        call_command("delete_old_temp_cutain", stdout=open(os.devnull, "w"))
+        self.assertEqual(set(Curtain.objects.all()), {permanent, never_accessed, active})
+
+    def test_duration_expired_matches_is_expired(self):
+        """Test that the duration queries agree with is_expired, which counts expiry_duration from the last access."""
+        long_ago = timezone.now() - timedelta(days=365)
+        never_accessed = Curtain.objects.create(description="never accessed", permanent=False)
+        never_accessed.created = long_ago
+        never_accessed.save()
+        recent = Curtain.objects.create(description="recent", permanent=False)
+        apply_access_events({recent.id: (timezone.now(), 1)})
+        Curtain.objects.create(description="permanent", permanent=True)
+
+        self.assertTrue(Curtain.objects.get(id=never_accessed.id).is_expired)
+        self.assertEqual(list(Curtain.objects.duration_expired()), [never_accessed])
+        self.assertEqual(list(Curtain.objects.duration_unexpired()), [recent])
+        # a range on the stored column, not an expression over every row
+        self.assertNotIn("expiry_duration", str(Curtain.objects.duration_expired().query).split("WHERE")[1])
+
+
+class SignedFile:
+    """Stands in for a cloud FieldFile whose url property signs a new URL on every access."""
+
+    def __init__(self, name):
+        self.name = name
+        self.signed = 0
+
+    @property
+    def url(self):
+        self.signed += 1
+        return f"https://bucket.example/{self.name}?signature={self.signed}"
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    CURTAIN_SIGNED_URL_LIFETIME=3600,
+)
+class SignedUrlCacheTest(TestCase):
+
+    def test_signed_url_reused_until_invalidated(self):
+        """Test that the signed URL is cached per file and re-signed after the file is replaced."""
+        field_file = SignedFile("media/files/curtain_upload/test.json")
+
+        self.assertEqual(get_signed_url(field_file), get_signed_url(field_file))
+        self.assertEqual(field_file.signed, 1)
+
+        invalidate_signed_url(field_file.name)
+        self.assertTrue(get_signed_url(field_file).endswith("signature=2"))
+
+
+class UniprotAccessionTest(TestCase):
+
+    def test_matches_uniprot_sequence(self):
+        """Test that the vectorized parser finds the same accession as UniprotSequence for every id."""
+        ids = ["P12345", "sp|Q9Y6K9-2|NEMO_HUMAN", "P12345;Q99999", "A0A024RBG1", "GENE1", "", "P12345"]
+        expected = [UniprotSequence(primary_id, parse_acc=True).accession for primary_id in ids]
+
+        accessions = parse_uniprot_accessions(pd.Series(ids + [None, 42]))
+        self.assertEqual([accession if pd.notnull(accession) else None for accession in accessions],
+                         expected + [None, None])
+
+
+class GeneNameMatchTest(TestCase):
+
+    def test_first_matching_gene_wins(self):
+        """Test that each studied entry matches the stored rows of its first gene name found, in study order."""
+        stored_df = pd.DataFrame({"primaryID": ["A", "B", "C"], "Gene Names": ["GENE1 GENE2", "GENE3", "GENE2"]})
+        stored_df["gene_names_split"] = stored_df["Gene Names"].str.split(" ")
+        stored_df = stored_df.explode("gene_names_split", ignore_index=True)
+        studied_uni_df = pd.DataFrame({
+            "From": ["P2", "P1", "P3", "P4"],
+            "Gene Names": ["MISSING GENE2 GENE3", "GENE1", None, "OTHER"],
+        })
+        study_map = {"P1": "study1", "P2": "study2", "P3": "study3", "P4": "study4"}
+
+        matched = match_gene_names(stored_df, studied_uni_df, study_map)
+
+        self.assertEqual(matched["primaryID"].tolist(), ["A", "C", "A"])
+        self.assertEqual(matched["gene_names_split"].tolist(), ["GENE2", "GENE2", "GENE1"])
+        self.assertEqual(matched["source_pid"].tolist(), ["study2", "study2", "study1"])
+        self.assertTrue(match_gene_names(stored_df, studied_uni_df.iloc[2:3], study_map).empty)
+
+
+class FoldChangeTransformTest(TestCase):
+
+    def test_matches_elementwise_transform(self):
+        """Test that the vectorized transform gives what the former per-value apply gave, including 0 and NaN."""
+        values = pd.Series([4.0, 0.5, -8.0, 0.0, float("nan"), 1.0], index=[3, 5, 7, 9, 11, 13])
+        with np.errstate(divide="ignore"):
+            expected = values.apply(lambda x: np.log2(x) if x >= 0 else -np.log2(-x))
+
+        pd.testing.assert_series_equal(transform_fold_change(values), expected)
+        pd.testing.assert_series_equal(transform_fold_change(values.astype(object)), expected)
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": TEST_MEDIA_ROOT},
+        },
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+)
+class BlobCacheTest(TestCase):
+
+    def test_memory_lru_evicts_least_recently_used(self):
+        """Test that the memory tier keeps within its byte budget and skips oversized blobs."""
+        lru = MemoryLRU(max_bytes=10, max_item_bytes=6)
+        lru.put("a", b"aaaa")
+        lru.put("b", b"bbbb")
+        lru.get("a")
+        self.assertEqual(lru.put("c", b"cccc"), 1)
+        self.assertIsNone(lru.get("b"))
+        self.assertEqual(lru.get("a"), b"aaaa")
+        self.assertEqual(lru.put("d", b"ddddddd"), 0)
+        self.assertIsNone(lru.get("d"))
+
+    def test_read_through_disk_tier(self):
+        """Test that a blob is fetched from storage once and then served from the disk tier."""
+        curtain = Curtain.objects.create(description="test")
+        content_hash = curtain.save_session_file(ContentFile(b'{"settings": {}}'))
+        cache = BlobCache(0, 0, tempfile.mkdtemp(), 1024)
+
+        self.assertEqual(cache.read(content_hash, curtain.file), b'{"settings": {}}')
+        os.remove(curtain.file.path)
+        self.assertEqual(cache.read(content_hash, curtain.file), b'{"settings": {}}')
+
+    def test_disk_scanned_only_over_budget(self):
+        """Test that the disk tier counts what it writes and only scans the directory once over its budget."""
+        disk = DiskLRU(tempfile.mkdtemp(), 10)
+        self.assertEqual(disk.put("aa1", io.BytesIO(b"aaaa")), (disk.path("aa1"), 0))
+
+        with mock.patch("curtain.blob_cache.os.walk", wraps=os.walk) as walk:
+            self.assertEqual(disk.put("bb2", io.BytesIO(b"bbbb"))[1], 0)
+            walk.assert_not_called()
+            self.assertEqual(disk.put("cc3", io.BytesIO(b"cccc"))[1], 1)
+            walk.assert_called_once()
+        self.assertIsNone(disk.get("aa1"))
+        self.assertEqual(disk.size, 8)
+
+    def test_stats_buffered_in_process(self):
+        """Test that lookups add to in-process counters, sent to Redis in one round trip per interval."""
+        self.addCleanup(blob_cache._pending_stats.clear)
+        self.addCleanup(setattr, blob_cache, "_stats_flushed_at", 0)
+        connection = mock.Mock()
+        now = [1000.0]
+        with mock.patch("curtain.blob_cache.time.monotonic", side_effect=lambda: now[0]), \
+                mock.patch("curtain.blob_cache.django_rq.get_connection", side_effect=ConnectionError) as get_connection:
+            blob_cache.flush_stats()
+            for _ in range(5):
+                blob_cache.record_stat("memory_hit")
+            blob_cache.record_stat("memory_miss")
+            get_connection.assert_called_once()
+
+            now[0] += blob_cache.STATS_FLUSH_INTERVAL
+            get_connection.side_effect = None
+            get_connection.return_value = connection
+            blob_cache.record_stat("memory_hit")
+
+        pipeline = connection.pipeline.return_value
+        pipeline.hincrby.assert_has_calls([mock.call(blob_cache.BLOB_CACHE_STATS_KEY, "memory_hit", 6),
+                                           mock.call(blob_cache.BLOB_CACHE_STATS_KEY, "memory_miss", 1)], any_order=True)
+        pipeline.execute.assert_called_once()
+
+    @mock.patch("curtain.storage.STORAGE_RETRY_DELAY", 0)
+    def test_storage_read_retried(self):
+        """Test that a transient storage failure is retried while a missing file fails at once."""
+        curtain = Curtain.objects.create(description="test")
+        content_hash = curtain.save_session_file(ContentFile(b'{"settings": {}}'))
+        stored = curtain.file.storage.open(curtain.file.name, "rb")
+        cache = BlobCache(0, 0, tempfile.mkdtemp(), 1024)
+
+        with mock.patch.object(curtain.file.storage, "open", side_effect=[ConnectionResetError(), stored]) as m:
+            self.assertEqual(cache.read(content_hash, curtain.file), b'{"settings": {}}')
+        self.assertEqual(m.call_count, 2)
+
+        with mock.patch.object(curtain.file.storage, "open", side_effect=FileNotFoundError) as m:
+            with self.assertRaises(FileNotFoundError):
+                BlobCache(0, 0, tempfile.mkdtemp(), 1024).read(content_hash, curtain.file)
+        self.assertEqual(m.call_count, 1)
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": TEST_MEDIA_ROOT},
+        },
+    },
+    CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}},
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MEDIA_ROOT=TEST_MEDIA_ROOT,
+    CURTAIN_LAST_ACCESS_BUFFERED=False,
+    CURTAIN_COMPARE_SESSION_CONCURRENCY=1,
+)
+class BenchmarkTest(TestCase):
+
+    def test_synthetic_session_shape(self):
+        """Test that the generator produces tables matching the forms and sample settings."""
+        session = generate_session(rows=50, samples=7, conditions=3, comparisons=2, seed=1)
+        processed = session["processed"].splitlines()
+        raw_header = session["raw"].splitlines()[0].split("\t")
+
+        self.assertEqual(len(processed), 1 + 50 * 2)
+        self.assertIn(session["differentialForm"]["_foldChange"], processed[0].split("\t"))
+        self.assertEqual(raw_header[2:], session["rawForm"]["_samples"])
+        self.assertEqual(sum(len(names) for names in session["settings"]["sampleOrder"].values()), 7)
+        self.assertEqual(session, generate_session(rows=50, samples=7, conditions=3, comparisons=2, seed=1))
+
+    def test_benchmark_suite_runs(self):
+        """Test that every benchmark completes on a small session, including a multi-chunk upload."""
+        benchmark = SessionBenchmark(200, 6, repeat=1, chunk_size=8 * 1024, study_size=20)
+        results = benchmark.run()
+
+        self.assertEqual(
+            [result["benchmark"] for result in results],
+            ["create", "download", "download_gzip", "download_fields", "chunked_upload",
+             "compare_session_primaryID", "compare_session_primaryID-uniprot"],
+        )
+        self.assertTrue(Curtain.objects.filter(description="benchmark").exists())
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "storages.backends.s3.S3Storage",
+            "OPTIONS": {
+                "bucket_name": "curtain-test",
+                "access_key": "test",
+                "secret_key": "test",
+                "region_name": "us-east-1",
+            },
+        },
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    CURTAIN_MULTIPART_UPLOADS=True,
+    CURTAIN_MULTIPART_PART_SIZE=5 * 1024 * 1024,
+    CURTAIN_CHUNK_STAGING_DIR=tempfile.mkdtemp(),
+)
+class MultipartUploadTest(TestCase):
+
+    def setUp(self):
+        """Set up a chunked upload and a stubbed S3 client recording the uploaded part bodies."""
+        self.upload = CurtainChunkedUpload.objects.create(filename="session.json")
+        self.client = default_storage.connection.meta.client
+        self.stubber = Stubber(self.client)
+        self.part_bodies = []
+        self.client.meta.events.register(
+            "provide-client-params.s3.UploadPart", lambda params, **kwargs: self.part_bodies.append(params["Body"]))
+        self.key = self.upload._get_multipart_name()
+
+    def tearDown(self):
+        self.stubber.deactivate()
+
+    def test_chunks_streamed_as_parts(self):
+        """Test that chunks are forwarded as parts and only a sub-part remainder is spooled locally."""
+        data = os.urandom(6 * 1024 * 1024 + 100)
+        bucket = {"Bucket": "curtain-test", "Key": self.key}
+        self.stubber.add_response("create_multipart_upload", {"UploadId": "upload-1"},
+                                  {**bucket, "ContentType": "application/json"})
+        self.stubber.add_response("upload_part", {"ETag": '"etag-1"'},
+                                  {**bucket, "UploadId": "upload-1", "PartNumber": 1, "Body": ANY})
+        self.stubber.add_response("upload_part", {"ETag": '"etag-2"'},
+                                  {**bucket, "UploadId": "upload-1", "PartNumber": 2, "Body": ANY})
+        self.stubber.add_response("complete_multipart_upload", {}, {
+            **bucket, "UploadId": "upload-1",
+            "MultipartUpload": {"Parts": [{"PartNumber": 1, "ETag": '"etag-1"'}, {"PartNumber": 2, "ETag": '"etag-2"'}]},
+        })
+        self.stubber.activate()
+
+        chunk_size = 2 * 1024 * 1024
+        for start in range(0, len(data), chunk_size):
+            self.upload.append_chunk(ContentFile(data[start:start + chunk_size]))
+            self.assertLess(len(self.upload._read_multipart_spool()), 5 * 1024 * 1024)
+        self.upload.completed()
+
+        self.stubber.assert_no_pending_responses()
+        self.assertEqual(b"".join(self.part_bodies), data)
+        self.assertEqual(self.upload.file.name, self.key)
+        self.assertEqual(self.upload.file_size, len(data))
+        self.assertFalse(get_chunk_staging().exists(self.upload._get_multipart_spool_name()))
+
+    @override_settings(CURTAIN_AT_REST_COMPRESSION="gzip")
+    def test_completed_upload_queued_for_compression(self):
+        """Test that a session streamed as a multipart upload, which bypasses CompressedStorage, is compressed later."""
+        data = b'{"settings": {}}'
+        bucket = {"Bucket": "curtain-test", "Key": self.key}
+        self.stubber.add_response("create_multipart_upload", {"UploadId": "upload-1"},
+                                  {**bucket, "ContentType": "application/json"})
+        self.stubber.add_response("upload_part", {"ETag": '"etag-1"'},
+                                  {**bucket, "UploadId": "upload-1", "PartNumber": 1, "Body": ANY})
+        self.stubber.add_response("complete_multipart_upload", {}, {
+            **bucket, "UploadId": "upload-1", "MultipartUpload": {"Parts": [{"PartNumber": 1, "ETag": '"etag-1"'}]},
+        })
+        self.stubber.activate()
+
+        self.upload.append_chunk(ContentFile(data))
+        self.upload.complete_multipart_upload()
+        self.assertEqual(self.upload.checksum, hashlib.sha256(data).hexdigest())
+        curtain = Curtain.objects.create(description="test")
+        self.upload.move_to_curtain(curtain)
+        self.assertEqual(curtain.file.name, self.key)
+
+        with mock.patch("curtain.worker_tasks.compress_session_at_rest.delay") as compress, \
+                mock.patch("curtain.worker_tasks.derive_session_artifacts.delay") as derive, \
+                self.captureOnCommitCallbacks(execute=True):
+            queue_session_file_jobs(curtain)
+
+        self.stubber.assert_no_pending_responses()
+        compress.assert_called_once_with(curtain.id)
+        derive.assert_not_called()
+
+    def test_delete_aborts_open_upload(self):
+        """Test that deleting an unfinished upload aborts its multipart upload."""
+        self.stubber.add_response("create_multipart_upload", {"UploadId": "upload-1"},
+                                  {"Bucket": "curtain-test", "Key": self.key, "ContentType": "application/json"})
+        self.stubber.add_response("abort_multipart_upload", {},
+                                  {"Bucket": "curtain-test", "Key": self.key, "UploadId": "upload-1"})
+        self.stubber.activate()
+
+        self.upload.append_chunk(ContentFile(b'{"settings": {}}'))
+        self.upload.delete()
+
+        self.stubber.assert_no_pending_responses()
+        self.assertFalse(get_chunk_staging().exists(self.upload._get_multipart_spool_name()))
+
+
+class ChunkStagingTest(TestCase):
+
+    def setUp(self):
+        self.staging = FileStaging(tempfile.mkdtemp())
+
+    def test_append_checks_offset(self):
+        """Test that a chunk replaces a partly written earlier attempt and cannot skip past the staged data."""
+        self.staging.append("upload", [b"abc", b"def"], 0)
+        self.staging.append("upload", [b"XYZ"], 3)
+        self.assertEqual(self.staging.read("upload"), b"abcXYZ")
+        with self.assertRaises(StagingConflict):
+            self.staging.append("upload", [b"ghi"], 10)
+
+    def test_reaper_removes_old_data_then_oldest_over_budget(self):
+        """Test that the reaper removes data past the age limit and then the oldest data over the byte budget."""
+        for name, age in (("old", 7200), ("older", 3000), ("recent", 1000), ("new", 0)):
+            self.staging.replace(name, b"x" * 10)
+            mtime = time.time() - age
+            os.utime(self.staging.path(name), (mtime, mtime))
+
+        self.assertEqual(reap_staged_chunks(self.staging, max_age=3600, max_bytes=15), (3, 30))
+        self.assertEqual([name for _, _, name in self.staging.entries()], ["new"])
+
+    def test_redis_append_retries_interrupted_write(self):
+        """Test that a Redis write interrupted by another node is retried and gives up with a conflict."""
+        connection = mock.MagicMock()
+        pipe = connection.pipeline.return_value.__enter__.return_value
+        pipe.strlen.return_value = 3
+        pipe.getrange.return_value = b"abc"
+        pipe.execute.side_effect = [WatchError(), [True]]
+        staging = RedisStaging(1024, 60, self.staging)
+
+        with mock.patch.object(RedisStaging, "connection", new_callable=mock.PropertyMock, return_value=connection):
+            self.assertEqual(staging.append("upload", [b"de"], 3), 5)
+            pipe.set.assert_called_with(staging.key("upload"), b"abcde", ex=60)
+            self.assertEqual(pipe.execute.call_count, 2)
+
+            pipe.execute.side_effect = WatchError()
+            with self.assertRaises(StagingConflict):
+                staging.append("upload", [b"de"], 3)
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "storages.backends.s3.S3Storage",
+            "OPTIONS": {
+                "bucket_name": "curtain-test",
+                "access_key": "test",
+                "secret_key": "test",
+                "region_name": "us-east-1",
+            },
+        },
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    CURTAIN_MULTIPART_UPLOADS=False,
+    CURTAIN_CHUNK_STAGING="file",
+    CURTAIN_CHUNK_STAGING_DIR=tempfile.mkdtemp(),
+)
+class StagedChunkedUploadTest(TestCase):
+
+    def test_chunks_continue_on_another_process(self):
+        """Test that an upload staged by one process is continued from the staging by another."""
+        upload = CurtainChunkedUpload.objects.create(filename="session.json")
+        upload.append_chunk(ContentFile(b'{"settings": '))
+        discard_stream_digest(str(upload.id))
+
+        upload = CurtainChunkedUpload.objects.get(pk=upload.pk)
+        upload.append_chunk(ContentFile(b'{}}'))
+        with upload._open_assembled_file() as f:
+            self.assertEqual(f.read(), b'{"settings": {}}')
+        self.assertEqual(upload.content_digests()["sha256"], hashlib.sha256(b'{"settings": {}}').hexdigest())
+
+        upload.offset = 40
+        with self.assertRaises(ChunkedUploadError):
+            upload.append_chunk(ContentFile(b'x'), save=False)
+        name = upload._get_staging_name()
+        upload.delete()
+        self.assertFalse(get_chunk_staging().exists(name))
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": TEST_MEDIA_ROOT},
+        },
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MEDIA_ROOT=TEST_MEDIA_ROOT,
+    CURTAIN_CHUNK_STAGING_DIR=tempfile.mkdtemp(),
+)
+class ParallelChunkedUploadTest(TestCase):
+
+    def setUp(self):
+        """Set up a staff user and a session payload split into three chunks."""
+        self.user = User.objects.create_user(username="uploader", password="testpass123", is_staff=True)
+        ExtraProperties.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.payload = json.dumps({
+            "processed": "a\tb\n" * 10, "raw": "a\tb\n", "differentialForm": {}, "rawForm": {}, "settings": {},
+        }).encode("utf-8")
+        self.chunk_size = 32
+
+    def put_chunk(self, index, upload_id=None):
+        start = index * self.chunk_size
+        chunk = self.payload[start:start + self.chunk_size]
+        url = f"/curtain-chunked-upload/{upload_id}/" if upload_id else "/curtain-chunked-upload/"
+        return self.client.put(url, {
+            "file": ContentFile(chunk, name="session.json"),
+            "filename": "session.json",
+            "chunk_size": self.chunk_size,
+        }, format="multipart", HTTP_CONTENT_RANGE=f"bytes {start}-{start + len(chunk) - 1}/{len(self.payload)}")
+
+    def complete(self, upload_id):
+        return self.client.post(f"/curtain-chunked-upload/{upload_id}/", {
+            "sha256": hashlib.sha256(self.payload).hexdigest(),
+            "permanent": "False",
+        }, format="multipart")
+
+    def test_out_of_order_chunks(self):
+        """Test that chunks can arrive in any order and completion waits for full coverage."""
+        last = (len(self.payload) - 1) // self.chunk_size
+        response = self.put_chunk(last)
+        self.assertEqual(response.status_code, 200)
+        upload_id = response.data["id"]
+        self.assertEqual(response.data["missing_ranges"], [[0, last * self.chunk_size - 1]])
+
+        self.assertEqual(self.put_chunk(0, upload_id).status_code, 200)
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data["missing_ranges"], [[self.chunk_size, last * self.chunk_size - 1]])
+
+        for index in range(last - 1, 0, -1):
+            self.assertEqual(self.put_chunk(index, upload_id).status_code, 200)
+        self.assertEqual(self.put_chunk(1, upload_id).data["offset"], len(self.payload))
+
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 200)
+        curtain = Curtain.objects.get(link_id=response.data["curtain"]["link_id"])
+        with curtain.file.open("rb") as f:
+            self.assertEqual(f.read(), self.payload)
+        self.assertEqual(curtain.get_data_hash(), hashlib.sha256(self.payload).hexdigest())
+
+    def test_invalid_session_rejected(self):
+        """Test that completing an upload that is not a valid session fails and leaves no curtain behind."""
+        self.payload = json.dumps({"processed": "a\tb\n" * 10, "settings": {}}).encode("utf-8")
+        upload_id = self.put_chunk(0).data["id"]
+        for index in range(1, (len(self.payload) - 1) // self.chunk_size + 1):
+            self.put_chunk(index, upload_id)
+
+        response = self.complete(upload_id)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("differentialForm", response.data["error"])
+        self.assertFalse(Curtain.objects.exists())
+
+    def test_misaligned_chunk_rejected(self):
+        """Test that parallel chunks must start on a chunk boundary."""
+        upload_id = self.put_chunk(0).data["id"]
+        response = self.client.put(f"/curtain-chunked-upload/{upload_id}/", {
+            "file": ContentFile(self.payload[5:5 + self.chunk_size], name="session.json"),
+        }, format="multipart", HTTP_CONTENT_RANGE=f"bytes 5-{4 + self.chunk_size}/{len(self.payload)}")
+
+        self.assertEqual(response.status_code, 400)
+
+
+class SessionValidationTest(TestCase):
+
+    def setUp(self):
+        """Set up a session and its serialized form."""
+        self.session = generate_session(rows=20, samples=3, seed=5)
+        self.data = json.dumps(self.session, indent=2).encode("utf-8")
+
+    def validate(self, data, chunk_size):
+        validator = SessionValidator()
+        for start in range(0, len(data), chunk_size):
+            validator.update(data[start:start + chunk_size])
+        return validator.close()
+
+    def test_metadata_independent_of_chunking(self):
+        """Test that every chunk size yields the same metadata, including values split between chunks."""
+        expected = self.validate(self.data, len(self.data))
+        self.assertEqual(set(expected["keys"]), set(self.session))
+        self.assertEqual(expected["values"]["settings"], self.session["settings"])
+        self.assertEqual(expected["keys"]["processed"]["type"], "string")
+        for chunk_size in (1, 7, 64):
+            self.assertEqual(self.validate(self.data, chunk_size), expected)
+
+    def test_malformed_session_rejected(self):
+        """Test that broken JSON, a non-object document and missing keys are rejected."""
+        for data in (self.data[:-2], self.data + b"{}", b'["processed"]', b'{"processed": "a\x01"}',
+                     json.dumps({"processed": "", "settings": {}}).encode()):
+            with self.assertRaises(SessionValidationError):
+                self.validate(data, 5)
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": TEST_MEDIA_ROOT},
+        },
+    },
+    MEDIA_ROOT=TEST_MEDIA_ROOT,
+)
+class IncrementalChecksumTest(TestCase):
+
+    def setUp(self):
+        """Set up a local chunked upload holding its first chunk."""
+        self.chunks = [b'{"processed": "', b"a" * 1000, b'", "settings": {}}']
+        self.upload = CurtainChunkedUpload.objects.create(filename="session.json")
+        self.upload.file.save("session.json", ContentFile(self.chunks[0]))
+        self.upload.offset = len(self.chunks[0])
+        self.upload.save()
+
+    def test_checksum_does_not_reread_file(self):
+        """Test that once the digest has caught up, completion needs no read of the file."""
+        for chunk in self.chunks[1:]:
+            self.upload.append_chunk(ContentFile(chunk))
+
+        with mock.patch.object(CurtainChunkedUpload, "_open_assembled_file", side_effect=AssertionError):
+            self.assertEqual(self.upload.checksum, hashlib.sha256(b"".join(self.chunks)).hexdigest())
+
+    def test_digest_caught_up_in_another_process(self):
+        """Test that the digest is rebuilt from the file when the previous chunks were hashed elsewhere."""
+        self.upload.append_chunk(ContentFile(self.chunks[1]))
+        discard_stream_digest(str(self.upload.id))
+        self.upload.append_chunk(ContentFile(self.chunks[2]))
+
+        self.assertEqual(self.upload.checksum, hashlib.sha256(b"".join(self.chunks)).hexdigest())
+
+    def test_digest_owned_by_one_worker(self):
+        """Test that with several workers taking turns only the owner hashes, reading each byte once."""
+        payload = b"".join(self.chunks)
+        chunks = [payload[start:start + 100] for start in range(len(self.chunks[0]), len(payload), 100)]
+        registries = [OrderedDict() for _ in range(3)]
+        hashed = []
+        update = StreamDigest.update
+
+        def as_worker(index):
+            """Runs as another worker process, with its own token and its own in-memory digests."""
+            return mock.patch("curtain.chunked_upload.process_token", return_value=f"worker-{index}"), \
+                mock.patch("curtain.hashing._stream_digests", registries[index])
+
+        def counting_update(digest, data):
+            hashed.append(len(data))
+            update(digest, data)
+
+        with mock.patch.object(StreamDigest, "update", counting_update):
+            for index, chunk in enumerate(chunks):
+                token, registry = as_worker(index % len(registries))
+                with token, registry:
+                    CurtainChunkedUpload.objects.get(pk=self.upload.pk).append_chunk(ContentFile(chunk))
+            token, registry = as_worker(0)
+            with token, registry:
+                upload = CurtainChunkedUpload.objects.get(pk=self.upload.pk)
+                self.assertEqual(upload.digest_owner, "worker-0")
+                self.assertEqual(upload.checksum, hashlib.sha256(payload).hexdigest())
+
+        self.assertEqual(sum(hashed), len(payload))
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": TEST_MEDIA_ROOT},
+        },
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MEDIA_ROOT=TEST_MEDIA_ROOT,
+    CURTAIN_CONTENT_ADDRESSED_STORAGE=True,
+)
+class ContentAddressedStorageTest(TestCase):
+
+    def setUp(self):
+        """Set up a curtain whose session file is stored as a blob."""
+        self.payload = json.dumps({"processed": "a\tb\n1\t2\n", "settings": {"title": os.urandom(8).hex()}}).encode()
+        self.digest = hashlib.sha256(self.payload).hexdigest()
+        self.curtain = Curtain.objects.create(description="test")
+        self.curtain.save_session_file(ContentFile(self.payload))
+
+    def test_same_content_shares_blob(self):
+        """Test that a second upload of the same content reuses the blob without writing it again."""
+        other = Curtain.objects.create(description="copy")
+        with mock.patch.object(default_storage.__class__, "save", side_effect=AssertionError):
+            other.save_session_file(ContentFile(self.payload))
+
+        blob = SessionBlob.objects.get(hash=self.digest)
+        self.assertEqual(blob.ref_count, 2)
+        self.assertEqual(other.file.name, self.curtain.file.name)
+        self.assertEqual(other.get_data_hash(), self.digest)
+
+    def test_blob_deleted_with_last_reference(self):
+        """Test that the blob file is kept while a curtain still uses it and deleted with the last one."""
+        other = Curtain.objects.create(description="copy")
+        other.share_session_file(self.curtain)
+        name = self.curtain.file.name
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.curtain.delete()
+        self.assertTrue(default_storage.exists(name))
+        self.assertEqual(SessionBlob.objects.get(hash=self.digest).ref_count, 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            other.delete()
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(SessionBlob.objects.filter(hash=self.digest).exists())
+
+    def test_replacing_content_releases_blob(self):
+        """Test that saving new content drops the reference to the previous blob."""
+        name = self.curtain.file.name
+        with self.captureOnCommitCallbacks(execute=True):
+            self.curtain.save_session_file(ContentFile(self.payload + b" "))
+
+        self.assertFalse(default_storage.exists(name))
+        self.assertEqual(SessionBlob.objects.get(file=self.curtain.file.name).ref_count, 1)
+
+    def test_attached_duplicate_is_deleted(self):
+        """Test that a file written elsewhere is dropped in favour of the existing blob with the same content."""
+        name = default_storage.save("media/files/curtain_upload/upload.json", ContentFile(self.payload))
+        other = Curtain.objects.create(description="copy")
+        other.attach_session_file(name, self.digest)
+
+        self.assertEqual(other.file.name, self.curtain.file.name)
+        self.assertFalse(default_storage.exists(name))
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": TEST_MEDIA_ROOT},
+        },
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MEDIA_ROOT=TEST_MEDIA_ROOT,
+    CURTAIN_LAST_ACCESS_BUFFERED=False,
+    CURTAIN_AT_REST_COMPRESSION="gzip",
+)
+class AtRestCompressionTest(TestCase):
+
+    def setUp(self):
+        """Set up a public curtain whose session file is stored compressed."""
+        self.client = APIClient()
+        self.session = {"processed": "a\tb\n1\t2\n" * 100, "settings": {"title": "test"}}
+        self.payload = json.dumps(self.session).encode("utf-8")
+        self.curtain = Curtain.objects.create(description="test")
+        self.curtain.save_session_file(ContentFile(self.payload))
+
+    def download_url(self):
+        return f"/curtain/{self.curtain.link_id}/download/token=/"
+
+    def test_stored_compressed(self):
+        """Test that the file is written compressed and read back decompressed with the hash of the plain content."""
+        self.assertTrue(self.curtain.file.name.endswith(".json.gz"))
+        with open(self.curtain.file.path, "rb") as f:
+            self.assertEqual(gzip.decompress(f.read()), self.payload)
+        with self.curtain.file.storage.open(self.curtain.file.name, "rb") as f:
+            self.assertEqual(f.read(), self.payload)
+        self.assertEqual(self.curtain.get_data_hash(), hashlib.sha256(self.payload).hexdigest())
+
+    def test_download_passes_compressed_bytes_through(self):
+        """Test that clients accepting the codec get the stored bytes and others the decompressed content."""
+        response = self.client.get(self.download_url(), HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), self.payload)
+
+        response = self.client.get(self.download_url())
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(b"".join(response.streaming_content), self.payload)
+
+    def test_download_range(self):
+        """Test that byte ranges refer to the decompressed content and an If-Range ETag guards them."""
+        etag = f'"{self.curtain.get_data_hash()}"'
+        response = self.client.get(self.download_url(), HTTP_RANGE="bytes=2-9", HTTP_IF_RANGE=etag,
+                                   HTTP_ACCEPT_ENCODING="gzip")
+
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response["Content-Range"], f"bytes 2-9/{len(self.payload)}")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(b"".join(response.streaming_content), self.payload[2:10])
+
+        response = self.client.get(self.download_url(), HTTP_RANGE="bytes=-4,0-3")
+        body = b"".join(response.streaming_content)
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(len(body), int(response["Content-Length"]))
+        self.assertIn(self.payload[-4:] + b"\r\n", body)
+        self.assertIn(self.payload[:4] + b"\r\n", body)
+
+        response = self.client.get(self.download_url(), HTTP_RANGE="bytes=0-3", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Accept-Ranges"], "bytes")
+        self.assertEqual(b"".join(response.streaming_content), self.payload)
+
+    def test_download_fields(self):
+        """Test that ?fields= still works on a compressed session."""
+        response = self.client.get(self.download_url() + "?fields=settings")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content), {"settings": self.session["settings"]})
+
+    def test_compress_existing_files(self):
+        """Test that the migration command compresses plain files and switches the curtains over."""
+        with override_settings(CURTAIN_AT_REST_COMPRESSION=""):
+            plain = Curtain.objects.create(description="plain")
+            plain.save_session_file(ContentFile(self.payload))
+        old_name = plain.file.name
+
+        call_command("compress_stored_sessions", workers=1, stdout=open(os.devnull, "w"))
+
+        plain.refresh_from_db()
+        self.assertEqual(plain.file.name, old_name + ".gz")
+        self.assertFalse(default_storage.exists(old_name))
+        with plain.file.storage.open(plain.file.name, "rb") as f:
+            self.assertEqual(f.read(), self.payload)
+
+    def test_plain_file_compressed_later(self):
+        """Test that a plain file attached to a curtain, as multipart uploads do, is compressed by its file jobs."""
+        name = default_storage.save("media/files/curtain_upload/upload.json", ContentFile(self.payload))
+        curtain = Curtain.objects.create(description="multipart")
+        curtain.attach_session_file(name, hashlib.sha256(self.payload).hexdigest())
+
+        with mock.patch("curtain.worker_tasks.compress_session_at_rest.delay", side_effect=compress_session_at_rest), \
+                mock.patch("curtain.worker_tasks.compress_curtain_file.delay"), \
+                mock.patch("curtain.worker_tasks.index_curtain_file.delay"), \
+                mock.patch("curtain.worker_tasks.derive_session_artifacts.delay") as derive, \
+                self.captureOnCommitCallbacks(execute=True):
+            queue_session_file_jobs(curtain)
+
+        derive.assert_called_once_with(curtain.id)
+        curtain.refresh_from_db()
+        self.assertEqual(curtain.file.name, name + ".gz")
+        self.assertFalse(default_storage.exists(name))
+        with curtain.file.storage.open(curtain.file.name, "rb") as f:
+            self.assertEqual(f.read(), self.payload)
+
+    def test_unavailable_codec_rejected(self):
+        """Test that a codec that is unknown or whose library is missing is rejected when the app starts."""
+        with override_settings(CURTAIN_AT_REST_COMPRESSION="lz4"):
+            self.assertRaises(ImproperlyConfigured, check_at_rest_compression)
+        with override_settings(CURTAIN_AT_REST_COMPRESSION="zstd"), mock.patch("curtain.compression.zstandard", None):
+            self.assertRaises(ImproperlyConfigured, check_at_rest_compression)
+        check_at_rest_compression()
+
+    def test_datacite_snapshot_served_plain(self):
+        """Test that a DataCite snapshot of a compressed session is stored and served as the plain session."""
+        data_cite = DataCite(curtain=self.curtain, title="test", form_data={})
+        with open_curtain_file(self.curtain) as session_file:
+            data_cite.save_local_file(self.curtain.file.name, session_file)
+        data_cite.save()
+        self.addCleanup(data_cite.local_file.delete, save=False)
+
+        self.assertTrue(data_cite.local_file.name.endswith(".json"))
+        self.assertEqual(data_cite.local_file_hash, self.curtain.get_data_hash())
+        response = self.client.get(f"/datacite/file/{data_cite.id}/", HTTP_ACCEPT_ENCODING="gzip")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(gzip.decompress(b"".join(response.streaming_content)), self.payload)
+
+        response = self.client.get(f"/datacite/file/{data_cite.id}/")
+        self.assertFalse(response.has_header("Content-Encoding"))
+        self.assertEqual(b"".join(response.streaming_content), self.payload)
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": TEST_MEDIA_ROOT},
+        },
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MEDIA_ROOT=TEST_MEDIA_ROOT,
+    CURTAIN_LAST_ACCESS_BUFFERED=False,
+)
+class SessionPatchTest(TestCase):
+
+    def setUp(self):
+        """Set up a curtain owned by the client's user with a stored session file."""
+        self.user = User.objects.create_user(username="owner", password="testpass123")
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.session = generate_session(rows=20, samples=3, seed=7)
+        self.payload = json.dumps(self.session, indent=2).encode("utf-8")
+        self.curtain = Curtain.objects.create(description="test")
+        self.curtain.owners.add(self.user)
+        self.curtain.save_session_file(ContentFile(self.payload))
+
+    def patch(self, data, content_type="application/merge-patch+json", **headers):
+        return self.client.generic("PATCH", f"/curtain/{self.curtain.link_id}/session/", json.dumps(data),
+                                   content_type=content_type, **headers)
+
+    def stored_session(self):
+        self.curtain.refresh_from_db()
+        with self.curtain.file.open("rb") as f:
+            return f.read()
+
+    def test_merge_patch(self):
+        """Test that a merge patch changes only the patched keys and copies the others byte for byte."""
+        response = self.patch({"settings": {"title": "patched", "pCutoff": None}, "extra": [1]})
+
+        self.assertEqual(response.status_code, 200)
+        stored = self.stored_session()
+        session = json.loads(stored)
+        self.assertEqual(session["settings"]["title"], "patched")
+        self.assertNotIn("pCutoff", session["settings"])
+        self.assertEqual(session["settings"]["sampleOrder"], self.session["settings"]["sampleOrder"])
+        self.assertEqual(session["extra"], [1])
+        spans = scan_top_level_spans(self.payload)
+        start, end = spans["processed"]
+        self.assertIn(self.payload[start:end], stored)
+        digest = hashlib.sha256(stored).hexdigest()
+        self.assertEqual(self.curtain.get_data_hash(), digest)
+        self.assertEqual(response["ETag"], f'"{digest}"')
+
+    def test_json_patch(self):
+        """Test that JSON Patch operations are applied to nested values and a failed test leaves the file alone."""
+        response = self.patch([
+            {"op": "replace", "path": "/settings/title", "value": "patched"},
+            {"op": "add", "path": "/settings/conditionOrder/-", "value": "new"},
+        ], content_type="application/json-patch+json")
+        self.assertEqual(response.status_code, 200)
+        session = json.loads(self.stored_session())
+        self.assertEqual(session["settings"]["title"], "patched")
+        self.assertEqual(session["settings"]["conditionOrder"], self.session["settings"]["conditionOrder"] + ["new"])
+
+        stored = self.stored_session()
+        response = self.patch([{"op": "test", "path": "/settings/title", "value": "other"},
+                               {"op": "remove", "path": "/settings"}], content_type="application/json-patch+json")
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.stored_session(), stored)
+
+    def test_if_match(self):
+        """Test that a patch against an outdated ETag is refused."""
+        current = f'"{self.curtain.get_data_hash()}"'
+        self.assertEqual(self.patch({"settings": {"title": "first"}}, HTTP_IF_MATCH=current).status_code, 200)
+
+        response = self.patch({"settings": {"title": "second"}}, HTTP_IF_MATCH=current)
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(json.loads(self.stored_session())["settings"]["title"], "first")
+
+    def test_required_keys_kept(self):
+        """Test that a patch may not remove a required key."""
+        response = self.patch({"raw": None})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("raw", json.loads(self.stored_session()))
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": TEST_MEDIA_ROOT},
+        },
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MEDIA_ROOT=TEST_MEDIA_ROOT,
+)
+class BulkCreateTest(TestCase):
+
+    def setUp(self):
+        """Set up a user and a few distinct sessions."""
+        self.user = User.objects.create_user(username="pipeline", password="testpass123")
+        ExtraProperties.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.payloads = [json.dumps(generate_session(rows=10, samples=2, seed=seed)).encode("utf-8")
+                         for seed in range(3)]
+
+    def test_bulk_create_files_and_upload(self):
+        """Test that files and a finished chunked upload become curtains with owners and hashes."""
+        upload = CurtainChunkedUpload.objects.create(filename="session.json", user=self.user)
+        upload.file.save("session.json", ContentFile(self.payloads[2][:100]))
+        upload.offset = 100
+        upload.append_chunk(ContentFile(self.payloads[2][100:]))
+        entries = [{"description": "first"}, {"description": "second", "expiry_duration": 3},
+                   {"upload_id": str(upload.id), "sha256": hashlib.sha256(self.payloads[2]).hexdigest()}]
+
+        response = self.client.post("/curtain/bulk_create/", {
+            "curtains": json.dumps(entries),
+            "file": [ContentFile(self.payloads[0], name="a.json"), ContentFile(self.payloads[1], name="b.json")],
+        }, format="multipart")
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data["link_ids"]), 3)
+        for link_id, payload in zip(response.data["link_ids"], self.payloads):
+            curtain = Curtain.objects.get(link_id=link_id)
+            self.assertEqual(list(curtain.owners.all()), [self.user])
+            self.assertEqual(curtain.get_data_hash(), hashlib.sha256(payload).hexdigest())
+            self.assertIsNone(curtain.expires_at)
+            with curtain.file.open("rb") as f:
+                self.assertEqual(f.read(), payload)
+        self.assertEqual(Curtain.objects.get(link_id=response.data["link_ids"][1]).expiry_duration, timedelta(days=90))
+        self.assertFalse(CurtainChunkedUpload.objects.exists())
+
+    def test_bulk_create_all_or_nothing(self):
+        """Test that one invalid session fails the whole request before anything is created."""
+        response = self.client.post("/curtain/bulk_create/", {
+            "file": [ContentFile(self.payloads[0], name="a.json"), ContentFile(b'{"settings": {}}', name="b.json")],
+        }, format="multipart")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("b.json", response.data["error"])
+        self.assertFalse(Curtain.objects.exists())
+
+    def test_bulk_create_encryption_factors(self):
+        """Test that end-to-end encrypted entries keep their encrypted key and IV like a single create does."""
+        entries = [{"encrypted": True, "e2e": True, "encryptedKey": "key", "encryptedIV": "iv"}, {"description": "plain"}]
+
+        response = self.client.post("/curtain/bulk_create/", {
+            "curtains": json.dumps(entries),
+            "file": [ContentFile(b"ciphertext", name="a.json"), ContentFile(self.payloads[1], name="b.json")],
+        }, format="multipart")
+
+        self.assertEqual(response.status_code, 201)
+        encrypted, plain = [Curtain.objects.get(link_id=link_id) for link_id in response.data["link_ids"]]
+        factors = encrypted.encryption_factors.get()
+        self.assertEqual((factors.encrypted_decryption_key, factors.encrypted_iv), ("key", "iv"))
+        self.assertFalse(plain.encryption_factors.exists())
+
+        entries[0].pop("encryptedIV")
+        response = self.client.post("/curtain/bulk_create/", {
+            "curtains": json.dumps(entries),
+            "file": [ContentFile(b"ciphertext", name="a.json"), ContentFile(self.payloads[1], name="b.json")],
+        }, format="multipart")
+        self.assertEqual(response.status_code, 400)
+
+    def test_bulk_create_checks_entries_before_completing_uploads(self):
+        """Test that an invalid entry fails the request before any chunked upload is completed."""
+        upload = CurtainChunkedUpload.objects.create(filename="session.json", user=self.user)
+        upload.file.save("session.json", ContentFile(self.payloads[0]))
+        upload.offset = len(self.payloads[0])
+        upload.save()
+        entries = [{"upload_id": str(upload.id), "sha256": hashlib.sha256(self.payloads[0]).hexdigest()},
+                   {"upload_id": str(upload.id)}]
+
+        with mock.patch.object(CurtainChunkedUpload, "complete_multipart_upload") as complete:
+            response = self.client.post("/curtain/bulk_create/", {"curtains": json.dumps(entries)}, format="multipart")
+
+        self.assertEqual(response.status_code, 400)
+        complete.assert_not_called()
+        self.assertFalse(Curtain.objects.exists())
+
+    def test_bulk_create_rollback_deletes_files(self):
+        """Test that the files written for a request whose transaction rolls back are deleted again."""
+        names = []
+        write_session_file = Curtain.write_session_file
+
+        def write(curtain, content, digest=None):
+            digest = write_session_file(curtain, content, digest)
+            names.append(curtain.file.name)
+            return digest
+
+        with mock.patch.object(Curtain, "write_session_file", write), \
+                mock.patch.object(DataHash.objects, "bulk_create", side_effect=IntegrityError):
+            with self.assertRaises(IntegrityError):
+                self.client.post("/curtain/bulk_create/", {
+                    "file": [ContentFile(self.payloads[0], name="a.json"), ContentFile(self.payloads[1], name="b.json")],
+                }, format="multipart")
+
+        self.assertEqual(len(names), 2)
+        self.assertFalse(any(Curtain.file.field.storage.exists(name) for name in names))
+        self.assertFalse(Curtain.objects.exists())
+
+
+@override_settings(
+    STORAGES={
+        "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+        "default": {
+            "BACKEND": "django.core.files.storage.FileSystemStorage",
+            "OPTIONS": {"location": TEST_MEDIA_ROOT},
+        },
+    },
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MEDIA_ROOT=TEST_MEDIA_ROOT,
+)
+class SessionDerivationTest(TestCase):
+
+    def setUp(self):
+        """Set up a curtain with a synthetic session."""
+        self.session = generate_session(rows=30, samples=4, seed=11)
+        self.curtain = Curtain.objects.create(description="test")
+        self.digest = self.curtain.save_session_file(ContentFile(json.dumps(self.session).encode("utf-8")))
+
+    def test_derive_artifacts(self):
+        """Test that every stage writes its artifact under the content hash and a second run does nothing."""
+        self.assertEqual(run_derivations(self.curtain), {"tables": "done", "manifest": "done", "protein_ids": "done"})
+
+        with default_storage.open(artifact_name(self.digest, "processed.parquet"), "rb") as f:
+            processed = pd.read_parquet(f)
+        self.assertEqual(list(processed.columns), list(pd.read_csv(io.StringIO(self.session["processed"]), sep="\t").columns))
+        self.assertEqual(load_manifest(self.digest)["tables"]["raw"]["rows"], 30)
+        with default_storage.open(artifact_name(self.digest, "protein_ids.json"), "rb") as f:
+            protein_ids = json.load(f)
+        self.assertEqual(len(protein_ids["primaryIDs"]), 30)
+        self.assertTrue(all(accession and "-" not in accession for accession in protein_ids["accessions"]))
+
+        with mock.patch("curtain.derivations.read_curtain_file", side_effect=AssertionError):
+            run_derivations(self.curtain)
+        self.assertEqual(set(SessionDerivation.objects.values_list("attempts", flat=True)), {1})
+
+    def test_failed_stage_retried(self):
+        """Test that a failing stage is recorded, does not block the others and succeeds on the next run."""
+        with mock.patch.dict("curtain.derivations.STAGE_FUNCTIONS", {"protein_ids": mock.Mock(side_effect=OSError("storage down"))}):
+            with self.assertRaises(DerivationError):
+                run_derivations(self.curtain)
+        failed = SessionDerivation.objects.get(hash=self.digest, stage="protein_ids")
+        self.assertEqual((failed.status, failed.error), ("failed", "storage down"))
+        self.assertEqual(SessionDerivation.objects.get(hash=self.digest, stage="tables").status, "done")
+
+        self.assertEqual(run_derivations(self.curtain)["protein_ids"], "done")
+        self.assertEqual(SessionDerivation.objects.get(hash=self.digest, stage="protein_ids").attempts, 2)
+
+    def test_tables_read_from_parquet(self):
+        """Test that sessions are read from their derived tables and that replacing the file discards them."""
+        form = self.session["differentialForm"]
+        columns = [form["_primaryIDs"], form["_foldChange"], "missing"]
+        expected = pd.read_csv(io.StringIO(self.session["processed"]), sep="\t")[columns[:2]]
+        run_derivations(self.curtain)
+
+        session = open_session(self.curtain)
+        self.assertIsInstance(session, DerivedSession)
+        self.assertEqual(session.data["differentialForm"], form)
+        with mock.patch("curtain.derivations.read_curtain_file", side_effect=AssertionError):
+            pd.testing.assert_frame_equal(open_session(self.curtain).table("processed", columns), expected)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.curtain.save_session_file(ContentFile(json.dumps({**self.session, "fetchUniprot": False}).encode("utf-8")))
+        self.assertFalse(SessionDerivation.objects.filter(hash=self.digest).exists())
+        self.assertFalse(default_storage.exists(artifact_name(self.digest, "processed.parquet")))
+
+    def test_missing_artifacts_queued(self):
+        """Test that a session without derived artifacts is read from its file and has them queued only once."""
+        cache.delete(f"curtain:derivations_queued:{self.digest}")
+        with mock.patch("curtain.worker_tasks.derive_session_artifacts.delay") as derive, \
+                mock.patch("curtain.derivations.run_derivations", side_effect=AssertionError):
+            with self.captureOnCommitCallbacks(execute=True):
+                session = open_session(self.curtain)
+                open_session(self.curtain)
+        self.assertIsInstance(session, ParsedSession)
+        self.assertEqual(session.data["differentialForm"], self.session["differentialForm"])
+        derive.assert_called_once_with(self.curtain.id)
+        self.assertFalse(SessionDerivation.objects.filter(hash=self.digest).exists())
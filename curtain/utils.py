@@ -11,7 +11,7 @@ from cryptography.hazmat.primitives.asymmetric import padding
 from django.contrib.auth.models import User
 from django.db import transaction
 from rest_framework_simplejwt.tokens import AccessToken
-from uniprotparser.betaparser import UniprotParser
+from uniprotparser.betaparser import UniprotParser, acc_regex
 
 
 def get_user_from_token(request):
@@ -70,6 +70,22 @@ def check_nan_return_none(value):
         return value
     return None
 
+def parse_uniprot_accessions(values):
+    """
+    Returns the accession UniprotSequence(value, parse_acc=True) would parse from each value, as a Series aligned
+    with values that is NaN where there is none. Each distinct value is parsed once, with the same regex.
+    """
+    values = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+    search = acc_regex.search
+    accessions = {}
+    for value in values.unique():
+        # UniprotSequence only parses strings, numeric ids and missing values have no accession
+        match = search(value) if isinstance(value, str) else None
+        if match:
+            accessions[value] = match.group("accession")
+    return values.map(accessions)
+
+
 def get_uniprot_data(df, column_name):
     primary_id = df[column_name].str.split(";")
     primary_id = primary_id.explode().unique()
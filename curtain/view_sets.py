@@ -17,6 +17,7 @@ from django.core.signing import TimestampSigner
 from django.db.models import Q, Count, OuterRef, Subquery
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.cache import patch_cache_control
 from django.utils.decorators import method_decorator
 from django.views.decorators.cache import cache_page, never_cache
 # from django_sendfile import sendfile
@@ -39,16 +40,30 @@ from django.db import transaction
 import io
 
 from curtain.models import Curtain, CurtainAccessToken, KinaseLibraryModel, DataFilterList, UserPublicKey, UserAPIKey, \
-    DataAESEncryptionFactors, LastAccess, DataCite, Announcement, PermanentLinkRequest, CurtainCollection
+    DataAESEncryptionFactors, LastAccess, DataCite, Announcement, PermanentLinkRequest, CurtainCollection, DataHash, \
+    SessionDerivation
 from curtain.permissions import IsOwnerOrReadOnly, IsFileOwnerOrPublic, IsCurtainOwnerOrPublic, HasCurtainToken, \
     IsCurtainOwner, IsNonUserPostAllow, IsDataFilterListOwner, HasUserAPIKey, IsCollectionOwner
+from curtain.access_log import record_access
+from curtain.blob_cache import open_curtain_file
+from curtain.chunked_upload import CurtainChunkedUpload
+from curtain.compression import accepts_encoding, stored_encoding
+from curtain.derivations import load_manifest
+from curtain.file_serving import serve_session_file, serve_session_fields, serve_compressed_file, get_not_modified_response, \
+    make_etag, if_match_satisfied
 from curtain.pydantic_models import DataCiteForm
+from curtain.session_patch import SessionPatchError, MergePatchParser, JSONPatchParser, JSON_PATCH_MEDIA_TYPE, \
+    build_patched_session
+from curtain.session_validation import SessionValidationError, session_validation_enabled, validate_session_stream
+from curtain.signed_urls import get_signed_url
 from curtain.serializers import UserSerializer, CurtainSerializer, KinaseLibrarySerializer, DataFilterListSerializer, \
     UserPublicKeySerializer, UserAPIKeySerializer, DataCiteSerializer, AnnouncementSerializer, PermanentLinkRequestSerializer, \
     CurtainCollectionSerializer
 from curtain.utils import is_user_staff, delete_file_related_objects, calculate_boxplot_parameters, \
     check_nan_return_none, get_uniprot_data, encrypt_data
 from curtain.validations import curtain_query_schema, kinase_library_query_schema, data_filter_list_query_schema
+from curtain.worker_tasks import queue_session_file_jobs, queue_unhashed_session_file_jobs, enqueue_job, \
+    compress_datacite_file
 from curtainbe import settings
 import kinase_library as kl
 
@@ -161,29 +176,15 @@ class CurtainViewSet(FiltersMixin, viewsets.ModelViewSet):
     filter_validation_schema = curtain_query_schema
 
     def get_throttles(self):
-        if self.action in ['create', 'update', 'partial_update']:
+        if self.action in ['create', 'update', 'partial_update', 'patch_session', 'bulk_create', 'api_bulk_create']:
             return [CreateThrottle(), SustainedRateThrottle()]
         if self.action == 'upload':
             return [UploadThrottle(), SustainedRateThrottle()]
         return [BurstRateThrottle(), SustainedRateThrottle()]
 
     def get_queryset(self):
-        # Define a subquery to get the latest LastAccess for each Curtain
-        latest_last_access_subquery = LastAccess.objects.filter(
-            curtain=OuterRef('pk')
-        ).order_by('-last_access').values('last_access')[:1]
-
-        # Annotate the Curtain queryset with the latest last_access date
-        self.queryset = self.queryset.annotate(
-            latest_last_access=Subquery(latest_last_access_subquery)
-        )
-
-        # Get the date 90 days ago
-        ninety_days_ago = timezone.now() - timedelta(days=90)
-
-        # Filter the Curtain queryset based on the conditions
-        query = Q(permanent=True) | Q(latest_last_access__isnull=True) | Q(latest_last_access__gte=ninety_days_ago)
-        self.queryset = self.queryset.filter(query)
+        # Hide non-permanent curtains last accessed more than 90 days ago, curtains never accessed stay visible
+        self.queryset = self.queryset.unexpired()
 
         return self.queryset
 
@@ -193,12 +194,15 @@ class CurtainViewSet(FiltersMixin, viewsets.ModelViewSet):
     @action(methods=["get"], url_path="download/?token=(?P<token>[^/]*)", detail=True, permission_classes=[
         permissions.IsAdminUser | HasCurtainToken | IsCurtainOwnerOrPublic
     ])
-    @method_decorator(cache_page(0))
     def download(self, request, pk=None, link_id=None, token=None):
         """
         Downloads the file associated with a Curtain.
         If the storage backend is cloud-based (S3, GCloud), it returns a signed URL.
-        If the storage is local, it returns the file content directly.
+        If the storage is local, it streams the stored file content directly, using the recorded
+        content hash as ETag so that clients holding the current version get a 304.
+        Sessions stored compressed are sent as they are to clients accepting their codec. Other clients get
+        them decompressed by the server, also on cloud storage, where a signed URL would hand out the compressed bytes.
+        With ?fields=settings,rawForm (local storage only) just those top-level keys of the session are returned.
         """
 
         c = self.get_object()
@@ -210,20 +214,75 @@ class CurtainViewSet(FiltersMixin, viewsets.ModelViewSet):
         #     "Vary": "Origin",
         # }
         # logging.info(c.file.url)
-        LastAccess.objects.create(curtain=c)
+        record_access(c)
         # check if storage backend is S3 or similar
         if settings.STORAGES["default"]["BACKEND"] == "storages.backends.gcloud.GoogleCloudStorage" or settings.STORAGES["default"]["BACKEND"] == "storages.backends.s3boto3.S3Boto3Storage":
-            return Response(data={"url": c.file.url}, status=status.HTTP_200_OK)
+            encoding = stored_encoding(c.file.name)
+            if encoding and not accepts_encoding(request.META.get("HTTP_ACCEPT_ENCODING", ""), encoding):
+                response = serve_compressed_file(request, c.file, content_hash=c.get_data_hash())
+                patch_cache_control(response, private=True, no_cache=True)
+                return response
+            return Response(data={"url": get_signed_url(c.file)}, status=status.HTTP_200_OK)
         elif settings.STORAGES["default"]["BACKEND"] == "django.core.files.storage.FileSystemStorage":
+            fields = request.query_params.get("fields")
+            if fields:
+                if c.encrypted:
+                    return Response(data={"error": "fields is not supported for encrypted sessions"}, status=status.HTTP_400_BAD_REQUEST)
+                try:
+                    response = serve_session_fields(request, c.file, [i.strip() for i in fields.split(",") if i.strip()])
+                except FileNotFoundError:
+                    return Response(status=status.HTTP_404_NOT_FOUND)
+                except ValueError:
+                    return Response(data={"error": "Session file is not a JSON object"}, status=status.HTTP_400_BAD_REQUEST)
+                patch_cache_control(response, private=True, no_cache=True)
+                return response
+            content_hash = c.get_data_hash()
+            if content_hash is None:
+                queue_unhashed_session_file_jobs(c)
+            not_modified = get_not_modified_response(request, content_hash)
+            if not_modified:
+                patch_cache_control(not_modified, private=True, no_cache=True)
+                return not_modified
+            if settings.CURTAIN_DOWNLOAD_STREAMING:
+                try:
+                    response = serve_session_file(request, c.file, content_hash=content_hash)
+                except FileNotFoundError:
+                    return Response(status=status.HTTP_404_NOT_FOUND)
+                patch_cache_control(response, private=True, no_cache=True)
+                return response
             # read the file as json and return it
             try:
-                with open(c.file.path, "rb") as f:
+                with c.file.storage.open(c.file.name, "rb") as f:
                     data = json.load(f)
                 response = Response(data=data, status=status.HTTP_200_OK)
+                if content_hash:
+                    # the rendered JSON is not byte-identical to the stored file
+                    response["ETag"] = "W/" + make_etag(content_hash)
+                patch_cache_control(response, private=True, no_cache=True)
                 return response
             except FileNotFoundError:
                 return Response(status=status.HTTP_404_NOT_FOUND)
 
+    @action(methods=["get"], detail=True, url_path="derivations/?token=(?P<token>[^/]*)", permission_classes=[
+        permissions.IsAdminUser | HasCurtainToken | IsCurtainOwnerOrPublic
+    ])
+    def derivations(self, request, pk=None, link_id=None, token=None):
+        """
+        Returns the state of each stage of the background derivation pipeline for the current session content,
+        and the manifest once it has been derived.
+        """
+        c = self.get_object()
+        if c.encrypted:
+            return Response(data={"error": "Encrypted sessions are not derived"}, status=status.HTTP_400_BAD_REQUEST)
+        content_hash = c.get_data_hash()
+        stages = {}
+        manifest = None
+        for derivation in SessionDerivation.objects.filter(hash=content_hash):
+            stages[derivation.stage] = {"status": derivation.status, "attempts": derivation.attempts, "error": derivation.error}
+            if derivation.stage == "manifest" and derivation.status == "done":
+                manifest = load_manifest(content_hash)
+        return Response(data={"hash": content_hash, "stages": stages, "manifest": manifest})
+
     @action(methods=["post"], detail=True, permission_classes=[permissions.IsAdminUser | IsCurtainOwner])
     def generate_token(self, request, pk=None, link_id=None):
         """
@@ -288,10 +347,26 @@ class CurtainViewSet(FiltersMixin, viewsets.ModelViewSet):
             return Response(status=status.HTTP_200_OK)
         return Response(status=status.HTTP_400_BAD_REQUEST)
 
+    def validate_session_upload(self, curtain):
+        """
+        Checks that the uploaded session file is a well-formed session before it is saved, streaming over it in
+        constant memory. Encrypted sessions cannot be inspected. Returns an error response or None.
+        """
+        if curtain.encrypted or not session_validation_enabled():
+            return None
+        try:
+            validate_session_stream(self.request.data["file"])
+        except SessionValidationError as e:
+            return Response(data={"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return None
+
     def create(self, request, **kwargs):
         c = Curtain()
         factors = self.encrypt_data(c)
-        c.file.save(str(c.link_id) + ".json", djangoFile(self.request.data["file"]))
+        invalid = self.validate_session_upload(c)
+        if invalid:
+            return invalid
+        c.save_session_file(djangoFile(self.request.data["file"]))
         if "description" in self.request.data:
             c.description = self.request.data["description"]
 
@@ -318,6 +393,7 @@ class CurtainViewSet(FiltersMixin, viewsets.ModelViewSet):
             c.expiry_duration = timedelta(days=expiry_months * 30)
 
         c.save()
+        queue_session_file_jobs(c)
         if factors is not None:
             factors.curtain = c
             factors.save()
@@ -341,7 +417,7 @@ class CurtainViewSet(FiltersMixin, viewsets.ModelViewSet):
         A dedicated endpoint for creating an encrypted Curtain.
         """
         c = Curtain()
-        c.file.save(str(c.link_id) + ".json", djangoFile(self.request.data["file"]))
+        c.save_session_file(djangoFile(self.request.data["file"]))
         if "description" in self.request.data:
             c.description = self.request.data["description"]
 
@@ -381,6 +457,199 @@ class CurtainViewSet(FiltersMixin, viewsets.ModelViewSet):
             c.owners.add(self.request.user)
         return Response(data=curtain_json.data)
 
+    def update_link_limit(self):
+        if settings.CURTAIN_DEFAULT_USER_LINK_LIMIT != 0:
+            total_count = self.request.user.curtain.count()
+            self.request.user.extraproperties.curtain_link_limit_exceed = total_count >= settings.CURTAIN_DEFAULT_USER_LINK_LIMIT
+        else:
+            self.request.user.extraproperties.curtain_link_limit_exceed = False
+        self.request.user.extraproperties.save()
+
+    def bulk_curtain(self, entry):
+        """
+        Builds an unsaved Curtain from one entry of a bulk create request. Returns the curtain and an error response.
+        """
+        c = Curtain()
+        c.name = str(entry.get("name", ""))
+        c.description = str(entry.get("description", ""))
+        c.enable = str(entry.get("enable", "True")) == "True"
+        c.encrypted = str(entry.get("encrypted", "False")) == "True"
+        if "curtain_type" in entry:
+            if entry["curtain_type"] not in dict(Curtain.curtain_type_choices):
+                return None, Response(data={"error": f"Unknown curtain_type: {entry['curtain_type']}"}, status=status.HTTP_400_BAD_REQUEST)
+            c.curtain_type = entry["curtain_type"]
+        if "permanent" in entry:
+            if str(entry["permanent"]) == "True":
+                if not settings.CURTAIN_ALLOW_USER_SET_PERMANENT and not self.request.user.is_staff:
+                    return None, Response(data={"error": "Only staff users can set permanent to True"}, status=status.HTTP_403_FORBIDDEN)
+                c.permanent = True
+            else:
+                c.permanent = False
+        if "expiry_duration" in entry:
+            try:
+                expiry_months = int(entry["expiry_duration"])
+            except (TypeError, ValueError):
+                return None, Response(data={"error": "expiry_duration must be a number of months"}, status=status.HTTP_400_BAD_REQUEST)
+            if expiry_months not in [3, 6]:
+                if not self.request.user.is_staff:
+                    return None, Response(data={"error": "expiry_duration must be 3 or 6 months"}, status=status.HTTP_400_BAD_REQUEST)
+            c.expiry_duration = timedelta(days=expiry_months * 30)
+        return c, None
+
+    def bulk_encryption_factors(self, curtain, entry):
+        """
+        Returns the unsaved encryption factors of an end-to-end encrypted entry of a bulk create request, as create()
+        takes them from "e2e", "encryptedKey" and "encryptedIV", and an error response.
+        """
+        if not curtain.encrypted or str(entry.get("e2e", "False")) != "True":
+            return None, None
+        if "encryptedKey" not in entry or "encryptedIV" not in entry:
+            return None, Response(data={"error": "e2e entries need encryptedKey and encryptedIV"}, status=status.HTTP_400_BAD_REQUEST)
+        return DataAESEncryptionFactors(encrypted_iv=entry["encryptedIV"], encrypted_decryption_key=entry["encryptedKey"]), None
+
+    def bulk_upload_source(self, entry):
+        """
+        Returns the chunked upload an entry of a bulk create request refers to, once its chunks have all arrived,
+        and an error response. Its content is checked by check_bulk_upload.
+        """
+        upload = CurtainChunkedUpload.objects.filter(pk=entry["upload_id"], user=self.request.user).first()
+        if upload is None:
+            return None, Response(data={"error": f"Upload {entry['upload_id']} not found"}, status=status.HTTP_404_NOT_FOUND)
+        if upload.status == upload.COMPLETE or upload.expired:
+            return None, Response(data={"error": f"Upload {upload.id} is no longer open"}, status=status.HTTP_400_BAD_REQUEST)
+        if upload.missing_ranges() or (upload.file_size and upload.offset != upload.file_size):
+            return None, Response(data={"error": f"Upload {upload.id} is incomplete"}, status=status.HTTP_400_BAD_REQUEST)
+        if not entry.get(settings.DRF_CHUNKED_UPLOAD_CHECKSUM):
+            return None, Response(data={"error": f"Upload {upload.id} needs a {settings.DRF_CHUNKED_UPLOAD_CHECKSUM} checksum"}, status=status.HTTP_400_BAD_REQUEST)
+        return upload, None
+
+    def check_bulk_upload(self, upload, entry, curtain):
+        """
+        Checks that an upload matches the checksum sent with it and, unless encrypted, holds a valid session.
+        Chunks streamed to S3/GCS can only be read back once the multipart upload is committed, so this is done
+        after every other check of the request passed. Returns an error response or None.
+        """
+        upload.complete_multipart_upload()
+        if upload.checksum != entry[settings.DRF_CHUNKED_UPLOAD_CHECKSUM]:
+            return Response(data={"error": f"Checksum of upload {upload.id} does not match"}, status=status.HTTP_400_BAD_REQUEST)
+        if not curtain.encrypted:
+            is_valid, error_msg = upload.validate_session_content()
+            if not is_valid:
+                return Response(data={"error": f"Upload {upload.id}: {error_msg}"}, status=status.HTTP_400_BAD_REQUEST)
+        return None
+
+    @action(methods=["post"], detail=False, permission_classes=[permissions.IsAuthenticated])
+    def bulk_create(self, request, **kwargs):
+        """
+        Creates several Curtains in one request, for pipelines that produce many sessions per run.
+        "curtains" is a JSON list with the metadata of each session (name, description, enable, curtain_type,
+        permanent, expiry_duration, encrypted), and for end-to-end encrypted sessions "e2e" with their "encryptedKey"
+        and "encryptedIV". An entry with an "upload_id" takes the file of a chunked upload whose chunks have all been
+        sent, together with its checksum, other entries take the "file" parts in order.
+        Without "curtains" every file becomes a session with the default metadata.
+        Everything is checked before the first file is written and the curtains are inserted in one transaction,
+        so either all of them are created or none. The files written for them are deleted again if the transaction
+        rolls back. Returns their link ids in the order of the entries.
+        """
+        files = request.FILES.getlist("file")
+        try:
+            entries = json.loads(request.data["curtains"]) if "curtains" in request.data else [{} for _ in files]
+        except ValueError:
+            return Response(data={"error": "curtains must be a JSON list"}, status=status.HTTP_400_BAD_REQUEST)
+        if not entries or not isinstance(entries, list) or not all(isinstance(entry, dict) for entry in entries):
+            return Response(data={"error": "curtains must be a non-empty JSON list of objects"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(entries) > settings.CURTAIN_BULK_CREATE_MAX_SESSIONS:
+            return Response(data={"error": f"At most {settings.CURTAIN_BULK_CREATE_MAX_SESSIONS} sessions can be created at once"}, status=status.HTTP_400_BAD_REQUEST)
+        if sum(1 for entry in entries if "upload_id" not in entry) != len(files):
+            return Response(data={"error": "Each entry without an upload_id needs a file"}, status=status.HTTP_400_BAD_REQUEST)
+
+        curtains = []
+        sources = []
+        factors = []
+        remaining_files = iter(files)
+        for entry in entries:
+            c, error = self.bulk_curtain(entry)
+            if error:
+                return error
+            entry_factors, error = self.bulk_encryption_factors(c, entry)
+            if error:
+                return error
+            if "upload_id" in entry:
+                source, error = self.bulk_upload_source(entry)
+                if error:
+                    return error
+            else:
+                source = next(remaining_files)
+                if not c.encrypted and session_validation_enabled():
+                    try:
+                        validate_session_stream(source)
+                    except SessionValidationError as e:
+                        return Response(data={"error": f"{source.name}: {str(e)}"}, status=status.HTTP_400_BAD_REQUEST)
+            curtains.append(c)
+            sources.append(source)
+            factors.append(entry_factors)
+        for c, source, entry in zip(curtains, sources, entries):
+            if isinstance(source, CurtainChunkedUpload):
+                error = self.check_bulk_upload(source, entry, c)
+                if error:
+                    return error
+
+        written = []
+        try:
+            with transaction.atomic():
+                digests = []
+                for c, source in zip(curtains, sources):
+                    if isinstance(source, CurtainChunkedUpload):
+                        source.completed()
+                        # a file streamed to S3/GCS is handed over, the upload has it again if this rolls back
+                        handed_over = source.file.name if source.file else None
+                        digests.append(source.move_to_curtain(c, save=False))
+                        if c.file.name != handed_over:
+                            written.append(c)
+                    else:
+                        digests.append(c.write_session_file(djangoFile(source)))
+                        written.append(c)
+                    # bulk_create skips Curtain.save
+                    c.refresh_expiry()
+                Curtain.objects.bulk_create(curtains)
+                DataHash.objects.bulk_create([DataHash(curtain=c, hash=digest) for c, digest in zip(curtains, digests) if digest])
+                Curtain.owners.through.objects.bulk_create([Curtain.owners.through(curtain=c, user=self.request.user) for c in curtains])
+                for c, entry_factors in zip(curtains, factors):
+                    if entry_factors is not None:
+                        entry_factors.curtain = c
+                DataAESEncryptionFactors.objects.bulk_create([entry_factors for entry_factors in factors if entry_factors is not None])
+        except Exception:
+            for c in written:
+                c.discard_session_file()
+            raise
+        for source in sources:
+            if isinstance(source, CurtainChunkedUpload):
+                source.delete()
+        for c in curtains:
+            queue_session_file_jobs(c)
+        self.update_link_limit()
+        return Response(data={"link_ids": [str(c.link_id) for c in curtains]}, status=status.HTTP_201_CREATED)
+
+    @action(methods=["post"], detail=False, permission_classes=[HasAPIKey])
+    def api_bulk_create(self, request, **kwargs):
+        """
+        Creates several Curtains in one request using an API key, see bulk_create.
+        """
+        if "HTTP_AUTHORIZATION" in request.META:
+            try:
+                key = request.META["HTTP_AUTHORIZATION"].split()[1]
+                api_key = UserAPIKey.objects.get_from_key(key)
+                if not api_key.can_create:
+                    return Response(status=status.HTTP_401_UNAUTHORIZED)
+                user = api_key.user
+                self.request.user = user
+            except ValueError as e:
+                return Response(status=status.HTTP_401_UNAUTHORIZED)
+
+        else:
+            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        return self.bulk_create(request, **kwargs)
+
     @action(methods=["post"], detail=False, permission_classes=[HasAPIKey])
     def api_create(self, request, **kwargs):
         """
@@ -440,6 +709,26 @@ class CurtainViewSet(FiltersMixin, viewsets.ModelViewSet):
             return Response(status=status.HTTP_401_UNAUTHORIZED)
         return self.update(request, **kwargs)
 
+    @action(methods=["patch"], detail=True, parser_classes=[MergePatchParser, JSONPatchParser, JSONParser],
+            permission_classes=[permissions.IsAdminUser | IsCurtainOwner])
+    def api_patch_session(self, request, **kwargs):
+        """
+        Patches the session of a Curtain using an API key, see patch_session.
+        """
+        if "HTTP_AUTHORIZATION" in request.META:
+            try:
+                key = request.META["HTTP_AUTHORIZATION"].split()[1]
+                api_key = UserAPIKey.objects.get_from_key(key)
+                user = api_key.user
+                if not api_key.can_update:
+                    return Response(status=status.HTTP_401_UNAUTHORIZED)
+                self.request.user = user
+            except ValueError as e:
+                return Response(status=status.HTTP_401_UNAUTHORIZED)
+        else:
+            return Response(status=status.HTTP_401_UNAUTHORIZED)
+        return self.patch_session(request, **kwargs)
+
     def update(self, request, *args, **kwargs):
         c = self.get_object()
         factors = self.encrypt_data(c)
@@ -467,17 +756,54 @@ class CurtainViewSet(FiltersMixin, viewsets.ModelViewSet):
         except ValueError as e:
             return Response(status=status.HTTP_400_BAD_REQUEST)
         if "file" in self.request.data:
-            c.file.save(str(c.link_id) + ".json", djangoFile(self.request.data["file"]))
+            invalid = self.validate_session_upload(c)
+            if invalid:
+                return invalid
+            c.save_session_file(djangoFile(self.request.data["file"]))
         if "description" in self.request.data:
             c.description = self.request.data["description"]
 
         c.save()
+        if "file" in self.request.data:
+            queue_session_file_jobs(c)
         if factors:
             factors.curtain = c
             factors.save()
         curtain_json = CurtainSerializer(c, many=False, context={"request": request})
         return Response(data=curtain_json.data)
 
+    @action(methods=["patch"], detail=True, url_path="session", parser_classes=[MergePatchParser, JSONPatchParser, JSONParser],
+            permission_classes=[permissions.IsAdminUser | IsCurtainOwner])
+    def patch_session(self, request, pk=None, link_id=None):
+        """
+        Applies a JSON merge patch (application/merge-patch+json or application/json) or JSON Patch operations
+        (application/json-patch+json) to the top-level keys of the stored session, e.g. to change settings without
+        uploading the whole session again. Keys the patch does not touch are copied without being parsed.
+        With If-Match the patch is only applied to the session version carrying that ETag, otherwise 412 is returned.
+        """
+        c = self.get_object()
+        if c.encrypted:
+            return Response(data={"error": "Encrypted sessions cannot be patched"}, status=status.HTTP_400_BAD_REQUEST)
+        json_patch = request.content_type.startswith(JSON_PATCH_MEDIA_TYPE)
+        with transaction.atomic():
+            # concurrent patches of the same curtain are applied one after the other
+            c = Curtain.objects.select_for_update().get(pk=c.pk)
+            if not if_match_satisfied(request, c.get_data_hash()):
+                return Response(data={"error": "Session has been modified"}, status=status.HTTP_412_PRECONDITION_FAILED)
+            try:
+                patched, digest = build_patched_session(c.file, request.data, json_patch)
+            except FileNotFoundError:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            except SessionPatchError as e:
+                return Response(data={"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+            with patched:
+                c.save_session_file(djangoFile(patched, name=str(c.link_id) + ".json"), digest)
+        queue_session_file_jobs(c)
+        curtain_json = CurtainSerializer(c, many=False, context={"request": request})
+        response = Response(data=curtain_json.data)
+        response["ETag"] = make_etag(digest)
+        return response
+
     @action(methods=["get"], detail=True, permission_classes=[
         permissions.IsAdminUser | IsCurtainOwner
     ])
@@ -773,15 +1099,13 @@ class DataCiteViewSets(viewsets.ModelViewSet):
                             contact_email=self.request.data["contact_email"],
                             pii_statement=self.request.data["pii_statement"]
                         )
-                        if curtain.file:
-                            data_cite.local_file.save(
-                                curtain.file.name,
-                                curtain.file,
-                                save=False
-                            )
+                        if curtain.file and not data_cite.share_local_file(curtain.get_data_hash()):
+                            with open_curtain_file(curtain) as session_file:
+                                data_cite.save_local_file(curtain.file.name, session_file)
                         data_cite.save()
 
                         if data_cite.local_file:
+                            enqueue_job(compress_datacite_file, data_cite.id)
                             file_path = reverse('datacite_file', kwargs={'datacite_id': data_cite.id})
                             if settings.SITE_DOMAIN:
                                 file_url = f"{settings.SITE_DOMAIN.rstrip('/')}{file_path}"
@@ -828,12 +1152,14 @@ class DataCiteViewSets(viewsets.ModelViewSet):
                                         title=f"{data_cite.title} - Session {curtain_session.link_id[:8]}"
                                     )
 
-                                    session_datacite.local_file.save(
-                                        f"collection_{data_cite.collection.id}_{curtain_session.id}_{curtain_session.file.name.split('/')[-1]}",
-                                        curtain_session.file,
-                                        save=False
-                                    )
+                                    if not session_datacite.share_local_file(curtain_session.get_data_hash()):
+                                        with open_curtain_file(curtain_session) as session_file:
+                                            session_datacite.save_local_file(
+                                                f"collection_{data_cite.collection.id}_{curtain_session.id}_{curtain_session.file.name.split('/')[-1]}",
+                                                session_file
+                                            )
                                     session_datacite.save()
+                                    enqueue_job(compress_datacite_file, session_datacite.id)
 
                                 session_file_path = reverse('datacite_file', kwargs={'datacite_id': session_datacite.id})
                                 if settings.SITE_DOMAIN:
@@ -1,4 +1,5 @@
 import json
+import mimetypes
 import re
 from datetime import datetime, timedelta
 
@@ -8,7 +9,7 @@ from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
 from django.db.models import Count
 from django.db.models.functions import TruncDay, TruncWeek
-from django.http import FileResponse, Http404
+from django.http import Http404
 from rest_framework import status, serializers
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from rest_framework.views import APIView
@@ -25,6 +26,7 @@ from curtain.models import User, ExtraProperties, SocialPlatform, Curtain, UserA
 from curtainbe import settings
 import requests
 from request.models import Request
+from curtain.file_serving import serve_stored_file
 from curtain.worker_tasks import compare_session
 import kinase_library as kl
 
@@ -484,9 +486,16 @@ class DataCiteFileView(APIView):
             if not datacite.local_file:
                 raise Http404("File not found")
 
-            response = FileResponse(datacite.local_file.open('rb'))
-            response['Content-Disposition'] = f'inline; filename="{datacite.local_file.name.split("/")[-1]}"'
-            return response
+            content_type, _ = mimetypes.guess_type(datacite.local_file.name)
+            return serve_stored_file(
+                request,
+                datacite.local_file,
+                content_type=content_type or "application/octet-stream",
+                filename=datacite.local_file.name.split("/")[-1],
+                content_hash=datacite.local_file_hash
+            )
         except DataCite.DoesNotExist:
             raise Http404("DataCite not found")
+        except FileNotFoundError:
+            raise Http404("File not found")
 
@@ -1,13 +1,322 @@
 import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import numpy as np
 import pandas as pd
 from asgiref.sync import async_to_sync
 from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import File
+from django.db import connection, transaction
 from django_rq import job
-from uniprotparser.betaparser import UniprotSequence, UniprotParser
-import requests as req
-from curtain.models import Curtain
+from rq import Retry
+from uniprotparser.betaparser import UniprotParser
+from curtain.access_log import flush_access_buffer
+from curtain.chunk_staging import reap_staged_chunks as reap_chunk_staging
+from curtain.compressed_storage import at_rest_encoding
+from curtain.compression import remove_compressed_variants, stored_encoding, write_compressed_variants
+from curtain.derivations import derivations_enabled, open_session, run_derivations
+from curtain.hashing import hash_stored_file
+from curtain.session_index import build_session_index, remove_session_index
+from curtain.models import Curtain, DataCite, SessionBlob
+from curtain.signed_urls import invalidate_signed_url
+from curtain.storage import is_local_storage
+from curtain.utils import parse_uniprot_accessions
+
+logger = logging.getLogger(__name__)
+
+# The file jobs of a session without a recorded hash are queued at most once in this many seconds when it is downloaded
+UNHASHED_JOBS_QUEUED_FOR = 10 * 60
+
+
+def enqueue_job(task, *args):
+    """
+    Queues a background job once the current transaction commits.
+    Queueing failures are logged instead of raised so a Redis outage does not fail the request that saved the file.
+    """
+    def _enqueue():
+        try:
+            task.delay(*args)
+        except Exception as e:
+            logger.warning(f"Failed to queue {task.__name__}{args}: {str(e)}")
+
+    transaction.on_commit(_enqueue)
+
+
+def queue_session_file_jobs(curtain):
+    """
+    Queues the background jobs that derive artifacts from a freshly saved curtain session file.
+    """
+    if is_local_storage():
+        enqueue_job(compress_curtain_file, curtain.id)
+        if not curtain.encrypted:
+            enqueue_job(index_curtain_file, curtain.id)
+    if needs_at_rest_compression(curtain):
+        # the derivations read the file, so they are queued once it has been replaced by its compressed copy
+        enqueue_job(compress_session_at_rest, curtain.id)
+    elif not curtain.encrypted and derivations_enabled():
+        enqueue_job(derive_session_artifacts, curtain.id)
+
+
+def needs_at_rest_compression(curtain):
+    """
+    Whether the session file is stored plain although CURTAIN_AT_REST_COMPRESSION is set. This is the case for
+    files streamed to S3/GCS as a multipart upload, which are written to the backend directly instead of through
+    CompressedStorage. Encrypted content does not compress, so it is left alone.
+    """
+    return bool(at_rest_encoding() and curtain.file and not curtain.encrypted and not stored_encoding(curtain.file.name))
+
+
+def queue_unhashed_session_file_jobs(curtain):
+    """
+    Queues the file jobs of a session stored before hashes were kept, which record its hash. A cache marker keeps
+    repeated downloads from queueing them again while they are pending.
+    """
+    try:
+        queued = cache.add(f"curtain:unhashed_jobs:{curtain.id}", True, UNHASHED_JOBS_QUEUED_FOR)
+    except Exception as e:
+        logger.warning(f"Failed to mark the file jobs of curtain {curtain.id} as queued: {str(e)}")
+        return
+    if queued:
+        queue_session_file_jobs(curtain)
+
+
+@job("default")
+def compress_curtain_file(curtain_id, force=False):
+    """
+    Writes the precompressed siblings of a curtain session file kept on local storage.
+    Also records the content hash of sessions stored before hashes were kept.
+    """
+    curtain = Curtain.objects.filter(id=curtain_id).first()
+    if not curtain or not curtain.file or not is_local_storage():
+        return []
+    if not os.path.exists(curtain.file.path):
+        return []
+    if curtain.get_data_hash() is None:
+        curtain.update_data_hash()
+    if stored_encoding(curtain.file.name):
+        # already compressed at rest and passed through as it is
+        return []
+    return write_compressed_variants(curtain.file.path, force=force)
+
+
+def compress_stored_session(name):
+    """
+    Writes a compressed copy of a plain session file and points every curtain and blob that used it at the copy
+    before the original is deleted. Returns (new name, stored size, compressed size), or None when nothing used
+    the file.
+    """
+    storage = Curtain._meta.get_field("file").storage
+    if not storage.exists(name):
+        return None
+    size = storage.size(name)
+    if is_local_storage():
+        # the precompressed siblings are superseded, and the gzip/zstd ones hold the names the copy is written to
+        remove_compressed_variants(storage.path(name))
+        remove_session_index(storage.path(name))
+    with storage.open(name, "rb") as f:
+        new_name = storage.save(name, File(f, name=name))
+    with transaction.atomic():
+        updated = Curtain.objects.filter(file=name).update(file=new_name)
+        updated += SessionBlob.objects.filter(file=name).update(file=new_name)
+    if not updated:
+        # the file was replaced while it was being compressed
+        storage.delete(new_name)
+        return None
+    storage.delete(name)
+    invalidate_signed_url(name)
+    return new_name, size, storage.size(new_name)
+
+
+@job("default")
+def compress_session_at_rest(curtain_id):
+    """
+    Compresses a session file stored plain although CURTAIN_AT_REST_COMPRESSION is set (see
+    needs_at_rest_compression), then queues the derivations of the session.
+    """
+    curtain = Curtain.objects.filter(id=curtain_id).first()
+    if not curtain:
+        return None
+    result = compress_stored_session(curtain.file.name) if needs_at_rest_compression(curtain) else None
+    if not curtain.encrypted and derivations_enabled():
+        enqueue_job(derive_session_artifacts, curtain.id)
+    return result
+
+
+@job("default")
+def index_curtain_file(curtain_id):
+    """
+    Writes the sidecar index of top-level key offsets used by partial session downloads.
+    """
+    curtain = Curtain.objects.filter(id=curtain_id).first()
+    if not curtain or not curtain.file or curtain.encrypted or not is_local_storage():
+        return None
+    if stored_encoding(curtain.file.name):
+        return None
+    if not os.path.exists(curtain.file.path):
+        return None
+    index = build_session_index(curtain.file.path)
+    return list(index["keys"]) if index else None
+
+
+@job("default", retry=Retry(max=3, interval=[60, 600, 3600]))
+def derive_session_artifacts(curtain_id, stages=None):
+    """
+    Parses a session once and stores what is derived from it, keyed by its content hash: Parquet copies of the
+    processed and raw tables, a manifest and the protein id list. Stages already done are skipped, failed ones
+    make the job fail so RQ retries it.
+    """
+    curtain = Curtain.objects.filter(id=curtain_id).first()
+    if not curtain or not curtain.file or curtain.encrypted:
+        return {}
+    return run_derivations(curtain, stages)
+
+
+@job("default")
+def compress_datacite_file(datacite_id, force=False):
+    """
+    Writes the precompressed siblings of a DataCite local file.
+    Also records the content hash of files stored before hashes were kept.
+    """
+    data_cite = DataCite.objects.filter(id=datacite_id).first()
+    if not data_cite or not data_cite.local_file:
+        return []
+    if not os.path.exists(data_cite.local_file.path):
+        return []
+    if not data_cite.local_file_hash:
+        data_cite.local_file_hash = hash_stored_file(data_cite.local_file)
+        data_cite.save(update_fields=["local_file_hash"])
+    return write_compressed_variants(data_cite.local_file.path, force=force)
+
+
+@job("default")
+def flush_last_access():
+    """
+    Writes the access events buffered in Redis to LastAccess.
+    """
+    return flush_access_buffer()
+
+
+@job("default")
+def reap_staged_chunks():
+    """
+    Removes the staged chunks of abandoned uploads. Returns (items removed, bytes freed).
+    """
+    return reap_chunk_staging()
+
+
+def transform_fold_change(values):
+    """
+    Returns the signed log2 of fold changes: log2(x) for positive values and -log2(-x) for negative ones, as one
+    vectorized NumPy operation so it runs without holding the GIL.
+    """
+    values = values.astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return pd.Series(np.where(values >= 0, np.log2(values), -np.log2(-values)), index=values.index)
+
+
+def load_compared_session(curtain):
+    """
+    Loads what compare_session matches on from one session: its forms and sample map, the differential table with
+    the fold change and significance transformed and filtered to the selected comparisons, and the raw table.
+    """
+    session = open_session(curtain)
+    data = session.data
+    differential_form = data["differentialForm"]
+    if "sampleMap" in data["settings"]:
+        sample_map = data["settings"]["sampleMap"]
+    else:
+        sample_map = {}
+        for k in data["settings"]["sampleOrder"]:
+            for k2 in data["settings"]["sampleOrder"][k]:
+                sample_map[k2] = {"condition": k, "replicate": k2, "name": k2}
+    pid_col = differential_form["_primaryIDs"]
+    fc_col = differential_form["_foldChange"]
+    significant_col = differential_form["_significant"]
+    df = session.table("processed", [pid_col, fc_col, significant_col, differential_form["_comparison"]])
+    if differential_form["_transformFC"] == True:
+        logger.debug(f"Transforming fold changes of {curtain.link_id}")
+        df[fc_col] = transform_fold_change(df[fc_col])
+    if "_reverseFoldChange" in differential_form:
+        if differential_form["_reverseFoldChange"]  == True:
+            logger.debug(f"Reversing fold changes of {curtain.link_id}")
+            df[fc_col] = -df[fc_col]
+    if differential_form["_transformSignificant"]  == True:
+        logger.debug(f"Transforming significance of {curtain.link_id}")
+        df[significant_col] = -np.log10(df[significant_col])
+    raw_df = session.table("raw", list(sample_map) + [data["rawForm"]["_primaryIDs"]])
+    comparison_col = differential_form["_comparison"]
+    comparisons = []
+    if len(differential_form["_comparisonSelect"]) > 0:
+        if differential_form["_comparison"] in df.columns:
+            df[differential_form["_comparison"]] = df[differential_form["_comparison"]].astype(str)
+            if type(differential_form["_comparisonSelect"]) == str:
+                df = df[df[comparison_col] == differential_form["_comparisonSelect"]]
+                comparisons.append(differential_form["_comparisonSelect"])
+            else:
+                df = df[df[comparison_col].isin(differential_form["_comparisonSelect"])]
+                comparisons.extend(differential_form["_comparisonSelect"])
+    if differential_form["_transformSignificant"]:
+        df[significant_col] = -np.log10(df[significant_col])
+    return {
+        "differential_form": differential_form,
+        "raw_form": data["rawForm"],
+        "sample_map": sample_map,
+        "comparisons": comparisons,
+        "df": df,
+        "raw_df": raw_df,
+    }
+
+
+def _load_compared_session_in_thread(curtain):
+    try:
+        return load_compared_session(curtain)
+    finally:
+        # each pool thread has its own database connection
+        connection.close()
+
+
+def load_compared_sessions(curtains):
+    """
+    Yields (curtain, loaded session) as the sessions finish loading on a pool of CURTAIN_COMPARE_SESSION_CONCURRENCY
+    threads. Reading from storage, the Parquet and CSV readers and the vectorized transforms release the GIL, so the
+    sessions load in parallel, and no more than that many are being read and parsed at once. With a concurrency of 1 they are loaded one after
+    the other in the calling thread.
+    """
+    concurrency = min(settings.CURTAIN_COMPARE_SESSION_CONCURRENCY, len(curtains))
+    if concurrency <= 1:
+        for curtain in curtains:
+            yield curtain, load_compared_session(curtain)
+        return
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(_load_compared_session_in_thread, curtain): curtain for curtain in curtains}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+
+def match_gene_names(stored_df, studied_uni_df, study_map):
+    """
+    Returns the rows of stored_df, exploded to one gene per row in gene_names_split, that share a gene name with a
+    studied UniProt entry, each with the study id of its entry as source_pid. For every entry only its first gene
+    name found in stored_df is matched. The rows come grouped by entry in studied_uni_df order, then in stored_df
+    order, and the names are compared as they are.
+    """
+    study_genes = studied_uni_df.loc[studied_uni_df["Gene Names"].notnull(), ["From", "Gene Names"]]
+    study_genes = pd.DataFrame({
+        "study_order": np.arange(len(study_genes)),
+        "source_pid": study_genes["From"].map(study_map).to_numpy(),
+        "study_gene": study_genes["Gene Names"].astype(str).str.split(" ").to_numpy(),
+    }).explode("study_gene")
+    # explode keeps the order of the names, so the first row left per entry is its first name that matches
+    study_genes = study_genes[study_genes["study_gene"].isin(stored_df["gene_names_split"].dropna().unique())]
+    study_genes = study_genes.drop_duplicates("study_order")
+    stored = stored_df.assign(stored_order=np.arange(len(stored_df)))
+    matched = study_genes.merge(stored, left_on="study_gene", right_on="gene_names_split", how="inner")
+    matched = matched.sort_values(["study_order", "stored_order"], kind="stable", ignore_index=True)
+    return matched[list(stored_df.columns) + ["source_pid"]]
 
 
 @job("default")
@@ -27,9 +336,9 @@ def compare_session(id_list, study_list, match_type, session_id):
         'operationId': ""
     }
     if match_type == "primaryID-uniprot" or match_type == "geneNames":
-        for i in study_list:
-            if UniprotSequence(i, parse_acc=True).accession:
-                study_map[UniprotSequence(i, parse_acc=True).accession] = i
+        for i, accession in zip(study_list, parse_uniprot_accessions(study_list)):
+            if pd.notnull(accession):
+                study_map[accession] = i
             else:
                 study_map[i] = i
 
@@ -38,55 +347,22 @@ def compare_session(id_list, study_list, match_type, session_id):
     comparison_dict = {}
     for i in to_be_processed_list:
         result[i.link_id] = {}
+    for i, loaded in load_compared_sessions(to_be_processed_list):
         message_template["message"] = "Processing " + i.link_id
         async_to_sync(channel_layer.group_send)(session_id, {
             'type': 'job_message',
             'message': message_template
         })
-        data = req.get(i.file.url).json()
-        differential_form = data["differentialForm"]
-        raw_form_map[i.link_id] = data["rawForm"]
-        if "sampleMap" in data["settings"]:
-            sample_map[i.link_id] = data["settings"]["sampleMap"]
-        else:
-            sample_map[i.link_id] = {}
-            for k in data["settings"]["sampleOrder"]:
-                for k2 in data["settings"]["sampleOrder"][k]:
-                    sample_map[i.link_id][k2] = {"condition": k, "replicate": k2, "name": k2}
+        differential_form = loaded["differential_form"]
+        raw_form_map[i.link_id] = loaded["raw_form"]
+        sample_map[i.link_id] = loaded["sample_map"]
+        raw_df_map[i.link_id] = loaded["raw_df"]
+        comparisons = comparison_dict[i.link_id] = loaded["comparisons"]
+        df = loaded["df"]
         pid_col = differential_form["_primaryIDs"]
         fc_col = differential_form["_foldChange"]
         significant_col = differential_form["_significant"]
-        string_data = io.StringIO(data["processed"])
-        raw_string_data = io.StringIO(data["raw"])
-        df = pd.read_csv(string_data, sep="\t")
-        if differential_form["_transformFC"] == True:
-            print("transforming FC")
-            df[fc_col] = df[fc_col].apply(lambda x: np.log2(x) if x >= 0 else -np.log2(-x))
-        if "_reverseFoldChange" in differential_form:
-            if differential_form["_reverseFoldChange"]  == True:
-                print("reversing FC")
-                df[fc_col] = -df[fc_col]
-        if differential_form["_transformSignificant"]  == True:
-            print("transforming significant")
-            df[significant_col] = -np.log10(df[significant_col])
-        raw_df = pd.read_csv(raw_string_data, sep="\t")
-        raw_df_map[i.link_id] = raw_df
         comparison_col = differential_form["_comparison"]
-        comparisons = []
-        if len(differential_form["_comparisonSelect"]) > 0:
-            if differential_form["_comparison"] in df.columns:
-                df[differential_form["_comparison"]] = df[differential_form["_comparison"]].astype(str)
-                if type(differential_form["_comparisonSelect"]) == str:
-                    df = df[df[comparison_col] == differential_form["_comparisonSelect"]]
-                    comparisons.append(differential_form["_comparisonSelect"])
-                else:
-                    df = df[df[comparison_col].isin(differential_form["_comparisonSelect"])]
-                    comparisons.extend(differential_form["_comparisonSelect"])
-        comparison_dict[i.link_id] = comparisons
-        if differential_form["_transformFC"]:
-            df[fc_col].apply(lambda x: np.log2(x) if x >= 0 else -np.log2(-x))
-        if differential_form["_transformSignificant"]:
-            df[significant_col] = -np.log10(df[significant_col])
         if match_type == "primaryID":
             message_template["message"] = "Matching Primary ID for " + i.link_id
             async_to_sync(channel_layer.group_send)(session_id, {
@@ -112,9 +388,7 @@ def compare_session(id_list, study_list, match_type, session_id):
                 'type': 'job_message',
                 'message': message_template
             })
-            df["curtain_uniprot"] = df[pid_col].apply(
-                lambda x: UniprotSequence(x, parse_acc=True).accession if UniprotSequence(x,
-                                                                                          parse_acc=True).accession else x)
+            df["curtain_uniprot"] = parse_uniprot_accessions(df[pid_col]).fillna(df[pid_col])
             df = df[df["curtain_uniprot"].isin(uniprot_id_list)]
             cols = [pid_col,  "curtain_uniprot", fc_col, significant_col]
             if len(comparisons) > 0:
@@ -129,8 +403,7 @@ def compare_session(id_list, study_list, match_type, session_id):
                                    significant_col: "significant"}, inplace=True)
             result[i.link_id]["differential"] = df
         elif match_type == "geneNames":
-            df["curtain_uniprot"] = df[pid_col].apply(
-                lambda x: UniprotSequence(x, parse_acc=True).accession if UniprotSequence(x,parse_acc=True).accession else x)
+            df["curtain_uniprot"] = parse_uniprot_accessions(df[pid_col]).fillna(df[pid_col])
             if len(comparisons) > 0:
                 df.rename(columns={pid_col: "primaryID", "curtain_uniprot": "uniprot", fc_col: "foldChange", comparison_col: "comparison", significant_col: "significant"}, inplace=True)
             else:
@@ -173,28 +446,12 @@ def compare_session(id_list, study_list, match_type, session_id):
             stored_df["Gene Names"] = stored_df["Gene Names"].str.upper()
             stored_df["gene_names_split"] = stored_df["Gene Names"].str.split(" ")
             stored_df = stored_df.explode("gene_names_split", ignore_index=True)
-            fin_df = []
             message_template["message"] = "Matching Gene Names for " + i
             async_to_sync(channel_layer.group_send)(session_id, {
                 'type': 'job_message',
                 'message': message_template
             })
-            for i2, r in studied_uni_df.iterrows():
-
-                if pd.notnull(r["Gene Names"]):
-                    for g in r["Gene Names"].split(" "):
-                        if g in stored_df["gene_names_split"].values:
-                            stored_result = stored_df[stored_df["gene_names_split"] == g]
-                            stored_result["source_pid"] = study_map[r["From"]]
-                            fin_df.append(stored_result)
-                            break
-            if len(fin_df) == 1:
-                fin_df = fin_df[0]
-            else:
-                if len(fin_df) == 0:
-                    fin_df = pd.DataFrame(columns=stored_df.columns)
-                else:
-                    fin_df = pd.concat(fin_df, ignore_index=True)
+            fin_df = match_gene_names(stored_df, studied_uni_df, study_map)
             if not fin_df.empty:
 
                 cols = ["primaryID", "uniprot", "foldChange", "significant", "source_pid", "Gene Names"]
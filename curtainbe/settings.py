@@ -56,7 +56,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
-    'django.middleware.gzip.GZipMiddleware',
+    'curtain.middleware.RangeAwareGZipMiddleware',
     'django.middleware.security.SecurityMiddleware',
     "whitenoise.middleware.WhiteNoiseMiddleware",
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -258,6 +258,14 @@ CACHES = {
     }
 }
 
+# Lifetime in seconds of signed download URLs on S3/GCS; URLs are cached for slightly less than this
+CURTAIN_SIGNED_URL_LIFETIME = int(os.environ.get("CURTAIN_SIGNED_URL_LIFETIME", "3600"))
+# Timeouts in seconds and attempts of reads from S3/GCS; the S3 client keeps up to CURTAIN_STORAGE_MAX_CONNECTIONS pooled
+CURTAIN_STORAGE_CONNECT_TIMEOUT = float(os.environ.get("CURTAIN_STORAGE_CONNECT_TIMEOUT", "5"))
+CURTAIN_STORAGE_READ_TIMEOUT = float(os.environ.get("CURTAIN_STORAGE_READ_TIMEOUT", "60"))
+CURTAIN_STORAGE_READ_ATTEMPTS = int(os.environ.get("CURTAIN_STORAGE_READ_ATTEMPTS", "3"))
+CURTAIN_STORAGE_MAX_CONNECTIONS = int(os.environ.get("CURTAIN_STORAGE_MAX_CONNECTIONS", "20"))
+
 REST_FRAMEWORK["DEFAULT_RENDERER_CLASSES"] = (
             "rest_framework.renderers.JSONRenderer",
         )
@@ -369,6 +377,7 @@ if os.environ.get("WORKING_ENV") == "PRODUCTION":
         GS_PROJECT_ID = os.environ.get("GCS_PROJECT_ID")
         GS_BUCKET_NAME = os.environ.get("GCS_BUCKET_NAME")
         GS_CREDENTIALS = service_account.Credentials.from_service_account_file(os.environ.get("GCS_CREDENTIALS_FILE"))
+        GS_EXPIRATION = timedelta(seconds=CURTAIN_SIGNED_URL_LIFETIME)
         DBBACKUP_STORAGE = 'storages.backends.gcloud.GoogleCloudStorage'
         DBBACKUP_STORAGE_OPTIONS = {
             "bucket_name": os.environ.get("GCS_BACKUP_BUCKET_NAME"),
@@ -376,11 +385,19 @@ if os.environ.get("WORKING_ENV") == "PRODUCTION":
             "blob_chunk_size": 1024 * 1024
         }
     elif os.environ.get("STORAGE_BACKEND") == "s3":
+        from botocore.config import Config
         STORAGES["default"]["BACKEND"] = 'storages.backends.s3boto3.S3Boto3Storage'
         AWS_ACCESS_KEY_ID = os.environ.get('AWS_ACCESS_KEY_ID', 'your-spaces-access-key-id')
         AWS_SECRET_ACCESS_KEY = os.environ.get('AWS_SECRET_ACCESS_KEY', 'your-spaces-secret-access-key')
         AWS_STORAGE_BUCKET_NAME = os.environ.get('AWS_STORAGE_BUCKET_NAME', 'your-spaces-bucket-name')
         AWS_S3_ENDPOINT_URL = os.environ.get('AWS_S3_ENDPOINT_URL', 'your-spaces-endpoint-url')
+        AWS_QUERYSTRING_EXPIRE = CURTAIN_SIGNED_URL_LIFETIME
+        AWS_S3_CLIENT_CONFIG = Config(
+            connect_timeout=CURTAIN_STORAGE_CONNECT_TIMEOUT,
+            read_timeout=CURTAIN_STORAGE_READ_TIMEOUT,
+            retries={"max_attempts": CURTAIN_STORAGE_READ_ATTEMPTS, "mode": "standard"},
+            max_pool_connections=CURTAIN_STORAGE_MAX_CONNECTIONS,
+        )
         DBBACKUP_STORAGE = 'storages.backends.s3boto3.S3Boto3Storage'
         DBBACKUP_STORAGE_OPTIONS = {
             "access_key": os.environ.get('AWS_BACKUP_ACCESS_KEY_ID', AWS_ACCESS_KEY_ID),
@@ -441,6 +458,21 @@ GLOBUS_REFRESH_TOKEN = os.environ.get("GLOBUS_REFRESH_TOKEN", "")
 
 SITE_DOMAIN = os.environ.get("SITE_DOMAIN", "")
 
+# Session download settings
+# Serve local session files as stored bytes instead of parsing and re-rendering them
+CURTAIN_DOWNLOAD_STREAMING = os.environ.get("CURTAIN_DOWNLOAD_STREAMING", "True") == "True"
+# Internal nginx location mapped to the media storage root, e.g. "/protected-media/"; empty disables X-Accel-Redirect
+CURTAIN_DOWNLOAD_ACCEL_REDIRECT_PREFIX = os.environ.get("CURTAIN_DOWNLOAD_ACCEL_REDIRECT_PREFIX", "")
+# Buffer session access events in Redis and write them to LastAccess in bulk (python manage.py flush_last_access)
+CURTAIN_LAST_ACCESS_BUFFERED = os.environ.get("CURTAIN_LAST_ACCESS_BUFFERED", "True") == "True"
+
+# Read-through cache for session files on S3/GCS (in-process LRU -> local disk -> storage), keyed by content hash
+CURTAIN_BLOB_CACHE_MEMORY_BYTES = int(os.environ.get("CURTAIN_BLOB_CACHE_MEMORY_BYTES", str(256 * 1024 * 1024)))
+# Only sessions up to this size are kept in memory
+CURTAIN_BLOB_CACHE_MEMORY_ITEM_BYTES = int(os.environ.get("CURTAIN_BLOB_CACHE_MEMORY_ITEM_BYTES", str(32 * 1024 * 1024)))
+CURTAIN_BLOB_CACHE_DIR = os.environ.get("CURTAIN_BLOB_CACHE_DIR", str(BASE_DIR / "blob_cache"))
+CURTAIN_BLOB_CACHE_DISK_BYTES = int(os.environ.get("CURTAIN_BLOB_CACHE_DISK_BYTES", str(10 * 1024 * 1024 * 1024)))
+
 DRF_CHUNKED_UPLOAD_PATH = "chunked_uploads"
 DRF_CHUNKED_UPLOAD_ABSTRACT_MODEL = False
 DRF_CHUNKED_UPLOAD_MAX_BYTES = 1024 * 1024 * 1024 * 2
@@ -449,6 +481,31 @@ DRF_CHUNKED_UPLOAD_COMPLETE_EXT = ".done"
 DRF_CHUNKED_UPLOAD_INCOMPLETE_EXT = ".part"
 DRF_CHUNKED_UPLOAD_CHECKSUM = "sha256"
 
+# Stream chunked uploads to S3/GCS as native multipart/resumable uploads instead of assembling them locally
+CURTAIN_MULTIPART_UPLOADS = os.environ.get("CURTAIN_MULTIPART_UPLOADS", "True") == "True"
+CURTAIN_MULTIPART_PART_SIZE = int(os.environ.get("CURTAIN_MULTIPART_PART_SIZE", str(8 * 1024 * 1024)))
+# Where chunks of uploads to S3/GCS are staged between requests: "file" (CURTAIN_CHUNK_STAGING_DIR, which every web
+# node must share when there is more than one) or "redis" for uploads up to CURTAIN_CHUNK_STAGING_REDIS_MAX_BYTES
+CURTAIN_CHUNK_STAGING = os.environ.get("CURTAIN_CHUNK_STAGING", "file")
+CURTAIN_CHUNK_STAGING_DIR = os.environ.get("CURTAIN_CHUNK_STAGING_DIR", str(BASE_DIR / "temp_uploads"))
+CURTAIN_CHUNK_STAGING_REDIS_MAX_BYTES = int(os.environ.get("CURTAIN_CHUNK_STAGING_REDIS_MAX_BYTES", str(16 * 1024 * 1024)))
+# Staged data is reaped once it has not been written to for this many seconds, or when the staging outgrows its budget
+CURTAIN_CHUNK_STAGING_MAX_AGE = int(os.environ.get("CURTAIN_CHUNK_STAGING_MAX_AGE", str(24 * 60 * 60)))
+CURTAIN_CHUNK_STAGING_MAX_BYTES = int(os.environ.get("CURTAIN_CHUNK_STAGING_MAX_BYTES", str(20 * 1024 * 1024 * 1024)))
+
+# Store each distinct session file once under its sha256 and let curtains with the same content share it
+CURTAIN_CONTENT_ADDRESSED_STORAGE = os.environ.get("CURTAIN_CONTENT_ADDRESSED_STORAGE", "False") == "True"
+# Compress session files at rest with this codec ("zstd" or "gzip"); empty stores them as they are
+CURTAIN_AT_REST_COMPRESSION = os.environ.get("CURTAIN_AT_REST_COMPRESSION", "")
+# Reject uploaded sessions that are not well-formed JSON objects with the required top-level keys
+CURTAIN_VALIDATE_SESSION_UPLOADS = os.environ.get("CURTAIN_VALIDATE_SESSION_UPLOADS", "True") == "True"
+# Most sessions accepted by one bulk create request
+CURTAIN_BULK_CREATE_MAX_SESSIONS = int(os.environ.get("CURTAIN_BULK_CREATE_MAX_SESSIONS", "100"))
+# Derive columnar tables, a manifest and the protein id list of every saved unencrypted session in the background
+CURTAIN_DERIVE_SESSION_ARTIFACTS = os.environ.get("CURTAIN_DERIVE_SESSION_ARTIFACTS", "True") == "True"
+# Sessions compare_session reads and parses at once, which bounds its peak memory
+CURTAIN_COMPARE_SESSION_CONCURRENCY = int(os.environ.get("CURTAIN_COMPARE_SESSION_CONCURRENCY", "4"))
+
 JWT_ACCESS_TOKEN_LIFETIME_MINUTES = int(os.environ.get("JWT_ACCESS_TOKEN_LIFETIME_MINUTES", "60"))
 JWT_REFRESH_TOKEN_LIFETIME_DAYS = int(os.environ.get("JWT_REFRESH_TOKEN_LIFETIME_DAYS", "1"))
 JWT_REMEMBER_ME_ACCESS_TOKEN_LIFETIME_DAYS = int(os.environ.get("JWT_REMEMBER_ME_ACCESS_TOKEN_LIFETIME_DAYS", "30"))